@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+"""Benchmark of the sync phases on generated (synthetic) trees.
+
+A seeded random source tree is created together with an identical target and
+a saved state in a temporary database, as if the pair had just been synced.
+Churn (modifications, additions and deletions on both sides) is then applied
+and a full two way sync is run while each phase is timed separately:
+
+    excluder    Excluder creation for both sides
+    state_load  Saved_state (dirs of saved state)
+    scan        scan_trees of source and target (Tree_index of both)
+    syncer      Syncer constructor (sync decisions)
+    delete      Syncer.delete
+    transfer    Syncer.sync
+    state_save  save_folder_state
+
+Every repetition uses freshly generated trees and the median per phase is
+reported. One extra run is made with tracemalloc active to measure the peak
+memory (Python allocations) during each phase. Its timings are not used since
+tracing slows everything down. Results are written as JSON and can be compared
+with a stored baseline, in which case phases slower (or using more memory)
+than the tolerance are reported as regressions (exit code 1).
+
+With --memory-fs the trees are generated in a Memory_filesystem (see
+filesystem.py) instead of on disk, so scan, syncer and delete can be measured
+on trees of millions of files. --latency and --queue-depth make it behave
+like a slow device (ie "default=0.0005" with queue depth 1 for a usb disk).
+Transfers need the real disk and aren't run (transfer is always 0).
+
+Example:
+    ./benchmark.py --files 50000 --backend native --output result.json --baseline baseline.json
+    ./benchmark.py --files 2000000 --memory-fs --latency default=0.0002 --scan-workers 32
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import tracemalloc
+from time import perf_counter
+
+import create_db
+import db_helpers
+from helpers import Excluder, Syncer
+from filesystem import LOCAL_FILESYSTEM, Memory_filesystem
+from vector_diff import DIFF_ENGINES, DEFAULT_DIFF_ENGINE
+from scanner import Tree_scanner, scan_trees, DEFAULT_SCAN_WORKERS
+from rsync_runner import DEFAULT_RSYNC_WORKERS
+from transfer import BACKENDS, DEFAULT_BACKEND
+
+PHASES = ["excluder", "state_load", "scan", "syncer", "delete", "transfer", "state_save"]
+
+DEFAULT_EXCLUDES = ["**/*.tmp", "**/cache"]
+# Weighted file sizes, "size:weight,..."
+DEFAULT_SIZES = "0:10,1024:50,65536:35,1048576:5"
+BASE_MTIME_NS = 1_600_000_000 * 10**9
+
+
+def parse_sizes(sizes):
+    """Parses weighted sizes, ie "0:10,1024:50" --> ([0, 1024], [10.0, 50.0])"""
+    pairs = [item.split(":") for item in sizes.split(",") if item]
+    return [int(size) for size, _ in pairs], [float(weight) for _, weight in pairs]
+
+
+def parse_latency(latency):
+    """Parses latency per operation, ie "default=0.001,scan_dir=0.01" -->
+    {"default": 0.001, "scan_dir": 0.01}"""
+    pairs = [item.split("=") for item in latency.split(",") if item]
+    return {operation.strip(): float(seconds) for operation, seconds in pairs}
+
+
+class Synthetic_pair:
+    """
+    Summary:
+        Generated source and target trees plus saved state of a folder pair.
+
+    Properties:
+        self.source, self.target {string} = Top dirs (ending with os.sep)
+        self.state {dictionary} = State before churn (dirs as keys, file lists as values)
+        self.counts {dictionary} = Number of generated items per kind
+        self.fs {Memory_filesystem} = Filesystem of the trees, None if on disk
+    """
+
+    def __init__(self, base_dir, config):
+        self.config = config
+        self.rng = random.Random(config["seed"])
+        self.source = os.path.join(base_dir, "source") + os.sep
+        self.target = os.path.join(base_dir, "target") + os.sep
+        self.state = {}
+        self.counts = {"dirs": 0, "files": 0, "excluded": 0, "bytes": 0}
+        self.fs = None
+        if config["memory_fs"]:
+            self.fs = Memory_filesystem(queue_depth=config["queue_depth"])
+            # Empty top dirs on disk, add_folder_pair only accepts existing dirs
+            os.makedirs(self.source)
+            os.makedirs(self.target)
+        sizes, weights = parse_sizes(config["sizes"])
+        self.sizes, self.weights = sizes, weights
+        self.data = self.rng.randbytes(max(sizes) + 4096)
+
+        self.dirs = self.__create_dirs()
+        self.__create_files()
+        self.churn = self.__apply_churn()
+        if self.fs:
+            # Generating the trees isn't slowed down
+            self.fs.latency = config["latency"]
+            self.fs.calls.clear()
+
+    def __write(self, path, size, mtime_ns):
+        if self.fs:
+            self.fs.add_file(path, size, mtime_ns)
+            return
+        offset = self.rng.randrange(4096)
+        with open(path, "wb") as a_file:
+            a_file.write(self.data[offset:offset + size])
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+
+    def __makedirs(self, path):
+        if self.fs:
+            self.fs.makedirs(path)
+        else:
+            os.makedirs(path, exist_ok=True)
+
+    def __create_dirs(self):
+        dirs, level = ["."], ["."]
+        for _ in range(self.config["depth"]):
+            next_level = []
+            for parent in level:
+                for index in range(self.config["fanout"]):
+                    name = "cache" if index == 0 and self.rng.random() < 0.05 else f"dir_{index}"
+                    next_level.append(name if parent == "." else os.path.join(parent, name))
+            dirs.extend(next_level)
+            level = next_level
+
+        # Excluded dirs (and everything below them) are not part of the state
+        excl_obj = Excluder(self.source, self.config["excludes"])
+        for rel_dir in dirs:
+            for top in (self.source, self.target):
+                self.__makedirs(os.path.join(top, rel_dir))
+            parent = os.path.dirname(rel_dir) or "."
+            if rel_dir == "." or (parent in self.state and not excl_obj.excludes(rel_dir)):
+                self.state[rel_dir] = []
+        self.excl_obj = excl_obj
+        self.counts["dirs"] = len(dirs)
+        return dirs
+
+    def __create_files(self):
+        for index in range(self.config["files"]):
+            rel_dir = self.rng.choice(self.dirs)
+            name = f"file_{index}" + (".tmp" if self.rng.random() < 0.02 else ".bin")
+            size = self.rng.choices(self.sizes, self.weights)[0]
+            mtime_ns = BASE_MTIME_NS + self.rng.randrange(10**15)
+            for top in (self.source, self.target):
+                self.__write(os.path.join(top, rel_dir, name), size, mtime_ns)
+            if not rel_dir in self.state or self.excl_obj.excludes(os.path.join(rel_dir, name)):
+                self.counts["excluded"] += 1
+            else:
+                self.state[rel_dir].append(name)
+                self.counts["files"] += 1
+                self.counts["bytes"] += size
+
+    def __apply_churn(self):
+        """Modifies, deletes and adds config["churn"] * files files, equally
+        divided on both sides."""
+        files = [(rel_dir, name) for rel_dir, names in self.state.items() for name in names]
+        count = min(len(files), int(len(files) * self.config["churn"]))
+        changed = self.rng.sample(files, count)
+        churn = {"modified": 0, "deleted": 0, "added": 0}
+        later_ns = BASE_MTIME_NS + 2 * 10**15
+
+        for index, (rel_dir, name) in enumerate(changed):
+            top = self.source if index % 2 else self.target
+            path = os.path.join(top, rel_dir, name)
+            if index % 3 == 0:
+                (self.fs or LOCAL_FILESYSTEM).unlink(path)
+                churn["deleted"] += 1
+            else:
+                self.__write(path, self.rng.choices(self.sizes, self.weights)[0], later_ns + index)
+                churn["modified"] += 1
+
+        for index in range(count):
+            top = self.source if index % 2 else self.target
+            rel_dir = self.rng.choice(self.dirs)
+            if index % 5 == 0:
+                # Some additions are in new dirs
+                rel_dir = os.path.join(rel_dir, f"new_dir_{index}")
+                self.__makedirs(os.path.join(top, rel_dir))
+            self.__write(os.path.join(top, rel_dir, f"added_{index}.bin"),
+                         self.rng.choices(self.sizes, self.weights)[0], later_ns + index)
+            churn["added"] += 1
+        return churn
+
+
+def run_phases(pair, db_path, config, trace_memory=False):
+    """Syncs pair the same way two_way_sync does and times each phase.
+
+    Args:
+        trace_memory {bool}: Peak memory of each phase is measured. tracemalloc
+        must have been started by the caller.
+
+    Returns:
+        {tuple}: (timings, peaks) with phase as key and seconds (timings) or
+        bytes (peaks, empty unless trace_memory) as value.
+    """
+    timings, peaks = {}, {}
+
+    def timed(phase, func):
+        if trace_memory:
+            tracemalloc.reset_peak()
+        start = perf_counter()
+        result = func()
+        timings[phase] = perf_counter() - start
+        if trace_memory:
+            peaks[phase] = tracemalloc.get_traced_memory()[1]
+        return result
+
+    con = sqlite3.connect(db_path, isolation_level=None)
+    cur = con.cursor()
+    try:
+        create_db.create_db(cur)
+        cur.execute("PRAGMA journal_mode=WAL")
+        cur.execute("PRAGMA synchronous=NORMAL")
+        pair_id = db_helpers.add_folder_pair(cur, pair.source, pair.target)
+        db_helpers.save_folder_state(cur, pair_id, pair.state)
+
+        excl_src, excl_tar = timed("excluder", lambda: (Excluder(pair.source, config["excludes"]),
+                                                        Excluder(pair.target, config["excludes"])))
+        saved_state = timed("state_load", lambda: db_helpers.Saved_state(cur, pair_id))
+
+        filesystem = pair.fs or LOCAL_FILESYSTEM
+        src_scanner = Tree_scanner(pair.source, excl_src, filesystem=filesystem)
+        tar_scanner = Tree_scanner(pair.target, excl_tar, filesystem=filesystem)
+        src_index, tar_index = timed("scan", lambda: scan_trees([src_scanner, tar_scanner],
+                                                                config["scan_workers"]))
+
+        # Output of deletions and transfers isn't part of what is measured
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            sync_obj = timed("syncer", lambda: Syncer(pair_id, pair.source, pair.target,
+                             src_index, tar_index, True, False, False, saved_state,
+                             config["rsync_workers"], False, config["backend"],
+                             filesystem=filesystem, diff_engine=config["diff_engine"]))
+            timed("delete", sync_obj.delete)
+            sync_obj.remove_doubles()
+            # Transfers only work on the real disk
+            timed("transfer", sync_obj.sync if pair.fs is None else lambda: None)
+
+        dir_caches = [("source", src_scanner.dir_cache, src_scanner.old_cache),
+                      ("target", tar_scanner.dir_cache, tar_scanner.old_cache)]
+        timed("state_save", lambda: db_helpers.save_folder_state(
+            cur, pair_id, sync_obj.get_new_state_dict(), dir_caches))
+    finally:
+        con.close()
+
+    return timings, peaks
+
+
+def run_benchmark(config, work_dir=None, print_progress=True):
+    """Generates trees and runs all phases config["repeat"] times.
+
+    Returns:
+        {dictionary}: Result (see module docstring), JSON serializable.
+    """
+    runs = []
+    for repetition in range(config["repeat"]):
+        with tempfile.TemporaryDirectory(prefix="folder_sync_bench_", dir=work_dir) as base_dir:
+            start = perf_counter()
+            pair = Synthetic_pair(base_dir, dict(config, seed=config["seed"] + repetition))
+            generate_time = perf_counter() - start
+            runs.append(run_phases(pair, os.path.join(base_dir, "bench.db"), config)[0])
+            if print_progress:
+                total = sum(runs[-1].values())
+                print(f"Run {repetition + 1}/{config['repeat']}: {total:.3f} s "
+                      f"(trees generated in {generate_time:.1f} s)", file=sys.stderr)
+
+    peak_memory = {}
+    if config["memory"]:
+        # Same trees as first run. Generated before tracing starts.
+        with tempfile.TemporaryDirectory(prefix="folder_sync_bench_", dir=work_dir) as base_dir:
+            pair = Synthetic_pair(base_dir, config)
+            tracemalloc.start()
+            try:
+                peak_memory = run_phases(pair, os.path.join(base_dir, "bench.db"), config, True)[1]
+            finally:
+                tracemalloc.stop()
+            if print_progress:
+                print(f"Memory run: peak {max(peak_memory.values()) / 2**20:.1f} MB", file=sys.stderr)
+
+    phases = {phase: statistics.median(run[phase] for run in runs) for phase in PHASES}
+    return {
+        "config": config,
+        "platform": {"python": platform.python_version(), "system": platform.platform()},
+        "counts": dict(pair.counts, **pair.churn),
+        "phases": phases,
+        "total": sum(phases.values()),
+        "peak_memory": peak_memory,
+        "runs": runs,
+        "fs_calls": dict(pair.fs.calls) if pair.fs else {},
+    }
+
+
+def compare_to_baseline(result, baseline, tolerance):
+    """Returns:
+        {list}: (phase, unit, baseline value, value, ratio) for phases slower
+        (unit "s") or with higher peak memory (unit "bytes") than
+        baseline * (1 + tolerance).
+    """
+    if baseline.get("config") != result["config"]:
+        print("Warning: baseline was run with another configuration", file=sys.stderr)
+
+    regressions = []
+    for key, unit in (("phases", "s"), ("peak_memory", "bytes")):
+        for phase, value in result.get(key, {}).items():
+            base_value = baseline.get(key, {}).get(phase)
+            if not base_value:
+                continue
+            ratio = value / base_value
+            if ratio > 1 + tolerance:
+                regressions.append((phase, unit, base_value, value, ratio))
+    return regressions
+
+
+def print_result(result, baseline=None):
+    peak_memory = result.get("peak_memory", {})
+    base_memory = baseline.get("peak_memory", {}) if baseline else {}
+    print(f"\n{'phase':<12}{'seconds':>10}" + (f"{'baseline':>10}{'ratio':>8}" if baseline else "")
+          + (f"{'peak MB':>10}" if peak_memory else "") + (f"{'baseline':>10}" if base_memory else ""))
+    for phase, seconds in result["phases"].items():
+        line = f"{phase:<12}{seconds:>10.4f}"
+        if baseline:
+            base_seconds = baseline.get("phases", {}).get(phase)
+            line += f"{base_seconds:>10.4f}{seconds / base_seconds:>8.2f}" if base_seconds else f"{'-':>18}"
+        if peak_memory:
+            line += f"{peak_memory[phase] / 2**20:>10.1f}"
+            if base_memory:
+                line += f"{base_memory[phase] / 2**20:>10.1f}" if phase in base_memory else f"{'-':>10}"
+        print(line)
+    print(f"{'total':<12}{result['total']:>10.4f}")
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description="Times the sync phases on generated trees")
+    parser.add_argument("--files", type=int, default=10000, help="number of files per side")
+    parser.add_argument("--depth", type=int, default=3, help="depth of dir tree")
+    parser.add_argument("--fanout", type=int, default=6, help="subdirs per dir")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="weighted file sizes in bytes, ie '0:10,4096:90'")
+    parser.add_argument("--churn", type=float, default=0.05, help="fraction of files modified/deleted and added")
+    parser.add_argument("--excludes", nargs="*", default=DEFAULT_EXCLUDES, help="exclude patterns")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3, help="number of runs (median is reported)")
+    parser.add_argument("--backend", default=DEFAULT_BACKEND, choices=BACKENDS)
+    parser.add_argument("--diff-engine", default=DEFAULT_DIFF_ENGINE, choices=DIFF_ENGINES, help="engine of syncer phase (see vector_diff.py)")
+    parser.add_argument("--scan-workers", type=int, default=DEFAULT_SCAN_WORKERS)
+    parser.add_argument("--rsync-workers", type=int, default=DEFAULT_RSYNC_WORKERS)
+    parser.add_argument("--no-memory", action="store_true", help="skip the extra run measuring peak memory")
+    parser.add_argument("--work-dir", default=None, help="where trees are generated (filesystem matters!)")
+    parser.add_argument("--memory-fs", action="store_true", help="generate trees in memory instead of on disk (no transfers)")
+    parser.add_argument("--latency", default="", help="memory fs: seconds per operation, ie 'default=0.0005,scan_dir=0.002'")
+    parser.add_argument("--queue-depth", type=int, default=None, help="memory fs: max operations at the same time (1 = usb disk)")
+    parser.add_argument("--output", default=None, help="write result as JSON to this file")
+    parser.add_argument("--baseline", default=None, help="compare with result JSON from earlier run")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown per phase (0.2 = 20%%)")
+    return parser.parse_args()
+
+
+def main():
+    options = get_arguments()
+    config = {
+        "files": options.files,
+        "depth": options.depth,
+        "fanout": options.fanout,
+        "sizes": options.sizes,
+        "churn": options.churn,
+        "excludes": options.excludes,
+        "seed": options.seed,
+        "repeat": max(1, options.repeat),
+        "backend": options.backend,
+        "diff_engine": options.diff_engine,
+        "scan_workers": options.scan_workers,
+        "rsync_workers": options.rsync_workers,
+        "memory": not options.no_memory,
+        "memory_fs": options.memory_fs,
+        "latency": parse_latency(options.latency),
+        "queue_depth": options.queue_depth,
+    }
+    result = run_benchmark(config, options.work_dir)
+
+    baseline = None
+    if options.baseline:
+        with open(options.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    print_result(result, baseline)
+
+    if options.output:
+        with open(options.output, "w") as output_file:
+            json.dump(result, output_file, indent=2)
+
+    if baseline:
+        regressions = compare_to_baseline(result, baseline, options.tolerance)
+        for phase, unit, base_value, value, ratio in regressions:
+            if unit == "bytes":
+                print(f"MEMORY REGRESSION in {phase}: {base_value / 2**20:.1f} MB --> "
+                      f"{value / 2**20:.1f} MB ({ratio:.2f}x)")
+            else:
+                print(f"REGRESSION in {phase}: {base_value:.4f} s --> {value:.4f} s ({ratio:.2f}x)")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
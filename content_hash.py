@@ -0,0 +1,104 @@
+"""This module compares file contents for content verification mode
+(--verify-content in folder_sync.py).
+
+Files existing on both sides with different mtimes but the same size are
+hashed instead of copied right away. If the contents are identical only the
+mtime needs to be aligned (see Syncer.sync in helpers), which saves full copies
+after backup restores, touch and tools rewriting identical files.
+
+Digests are saved in table hash_cache keyed on (device, inode) together with
+size and mtime_ns, so a file is only read again when it has changed.
+"""
+import hashlib
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from db_helpers import read_hashes, save_hashes
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_HASH_WORKERS = 4
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file(path, entry):
+    """Hashes content of a file with blake2b.
+
+    Args:
+        path {string}: Absolute path to file.
+        entry {Entry_stat}: Metadata of file from the scan (see scanner.py).
+
+    Returns:
+        {bytes}: Digest. None if file couldn't be read or has changed since
+        the scan (a digest that doesn't belong to entry must never be cached).
+    """
+    digest = hashlib.blake2b(digest_size=32)
+    try:
+        with open(path, "rb", buffering=0) as a_file:
+            st = os.fstat(a_file.fileno())
+            if st.st_size != entry.size or st.st_mtime_ns != entry.mtime_ns:
+                return None
+            buffer = bytearray(HASH_CHUNK_SIZE)
+            view = memoryview(buffer)
+            while True:
+                count = a_file.readinto(buffer)
+                if not count:
+                    break
+                digest.update(view[:count])
+            st = os.fstat(a_file.fileno())
+    except OSError as error:
+        LOGGER.debug(f"Couldn't hash {path}: {error}")
+        return None
+
+    if st.st_size != entry.size or st.st_mtime_ns != entry.mtime_ns:
+        return None
+    return digest.digest()
+
+
+class Hash_cache:
+    """
+    Summary:
+        Gives content digests of files, from table hash_cache when possible
+        and otherwise by hashing the files on a thread pool. Database is only
+        used from the thread calling get_digests.
+
+    Properties:
+        self.cur {object} = Cursor of db
+        self.workers {int} = Number of threads hashing files
+        self.hashed {int} = Number of files hashed (cache misses)
+        self.cached {int} = Number of digests read from cache
+    """
+
+    def __init__(self, cur, workers=DEFAULT_HASH_WORKERS):
+        self.cur = cur
+        self.workers = max(1, workers)
+        self.hashed = 0
+        self.cached = 0
+
+    def __repr__(self):
+        return f"Hash_cache(hashed: {self.hashed}, cached: {self.cached})"
+
+    def get_digests(self, files):
+        """Args:
+            files {list}: Tuples (absolute path, Entry_stat).
+
+        Returns:
+            {list}: Digest {bytes} or None (unreadable or changed) per file,
+            same order as files.
+        """
+        cached = read_hashes(self.cur, (entry for _, entry in files))
+        missing = [(path, entry) for path, entry in files if not entry in cached]
+
+        new_digests = {}
+        if missing:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                results = executor.map(lambda file: hash_file(*file), missing)
+                for (_, entry), digest in zip(missing, results):
+                    if digest is not None:
+                        new_digests[entry] = digest
+            save_hashes(self.cur, new_digests)
+
+        self.cached += len(files) - len(missing)
+        self.hashed += len(missing)
+        LOGGER.debug(f"Content hashes: {len(files) - len(missing)} from cache, {len(missing)} hashed")
+        return [cached.get(entry, new_digests.get(entry)) for _, entry in files]
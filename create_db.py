@@ -9,6 +9,139 @@ sql_createindexfolder_pairs = """
     CREATE UNIQUE INDEX folder_pair_index ON folder_pairs (source, target)
     ;"""
 
+# Tables below are created with IF NOT EXISTS so that update_db can add them
+# to databases created before they existed.
+
+# One row per directory and one row per file existing on both sides after last sync.
+sql_createtablestate_dirs = """
+    CREATE TABLE IF NOT EXISTS state_dirs (
+    folder_pair_id INTEGER NOT NULL,
+    dir TEXT NOT NULL,
+    PRIMARY KEY (folder_pair_id, dir),
+    FOREIGN KEY (folder_pair_id)
+        REFERENCES folder_pairs (id)
+    ) WITHOUT ROWID;"""
+
+sql_createtablestate_files = """
+    CREATE TABLE IF NOT EXISTS state_files (
+    folder_pair_id INTEGER NOT NULL,
+    dir TEXT NOT NULL,
+    name TEXT NOT NULL,
+    PRIMARY KEY (folder_pair_id, dir, name),
+    FOREIGN KEY (folder_pair_id)
+        REFERENCES folder_pairs (id)
+    ) WITHOUT ROWID;"""
+
+# Directory metadata and listing from last scan of each side (see scanner.py).
+# files and dirs are names joined with "/" (which can't be part of a name).
+sql_createtabledir_cache = """
+    CREATE TABLE IF NOT EXISTS dir_cache (
+    folder_pair_id INTEGER NOT NULL,
+    side TEXT NOT NULL,
+    dir TEXT NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    ctime_ns INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    files TEXT NOT NULL,
+    dirs TEXT NOT NULL,
+    PRIMARY KEY (folder_pair_id, side, dir),
+    FOREIGN KEY (folder_pair_id)
+        REFERENCES folder_pairs (id)
+    ) WITHOUT ROWID;"""
+
+# Content hashes of files (see content_hash.py). Not tied to a folder pair since
+# a file is identified by device and inode. size and mtime_ns tell if digest
+# is still valid.
+sql_createtablehash_cache = """
+    CREATE TABLE IF NOT EXISTS hash_cache (
+    dev INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    digest BLOB NOT NULL,
+    PRIMARY KEY (dev, ino)
+    ) WITHOUT ROWID;"""
+
+# Block signatures of large files (see delta.py). Keyed like hash_cache.
+# signature is the digests of all blocks of block_size bytes concatenated.
+sql_createtableblock_signatures = """
+    CREATE TABLE IF NOT EXISTS block_signatures (
+    dev INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    block_size INTEGER NOT NULL,
+    signature BLOB NOT NULL,
+    PRIMARY KEY (dev, ino)
+    ) WITHOUT ROWID;"""
+
+# Digest of the listing of every dir of each side (see dir_digest.py). Only
+# present while both sides are unchanged since the state was saved.
+sql_createtabledir_digests = """
+    CREATE TABLE IF NOT EXISTS dir_digests (
+    folder_pair_id INTEGER NOT NULL,
+    side TEXT NOT NULL,
+    dir TEXT NOT NULL,
+    digest BLOB NOT NULL,
+    PRIMARY KEY (folder_pair_id, side, dir),
+    FOREIGN KEY (folder_pair_id)
+        REFERENCES folder_pairs (id)
+    ) WITHOUT ROWID;"""
+
+# Write-ahead journal of state changes of a sync in progress (see journal.py).
+# op is "add" or "remove", name is NULL for a dir. Rows are replayed into
+# state_dirs/state_files in id order if a sync was interrupted, and deleted
+# when the state of a finished sync is saved. op "update" and "updated" mark
+# the start and end of an update in place, dir is absolute then.
+sql_createtablesync_journal = """
+    CREATE TABLE IF NOT EXISTS sync_journal (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    folder_pair_id INTEGER NOT NULL,
+    op TEXT NOT NULL,
+    dir TEXT NOT NULL,
+    name TEXT,
+    FOREIGN KEY (folder_pair_id)
+        REFERENCES folder_pairs (id)
+    );"""
+
+sql_createindexsync_journal = """
+    CREATE INDEX IF NOT EXISTS sync_journal_index ON sync_journal (folder_pair_id, id)
+    ;"""
+
+# One row per (non dryrun) sync of a folder pair, see metrics.py. metrics has
+# all timers, counters and errors as JSON (use json_extract for trends).
+sql_createtablesync_runs = """
+    CREATE TABLE IF NOT EXISTS sync_runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    folder_pair_id INTEGER NOT NULL,
+    started_at REAL NOT NULL,
+    duration REAL NOT NULL,
+    files_scanned INTEGER NOT NULL,
+    bytes_transferred INTEGER NOT NULL,
+    errors INTEGER NOT NULL,
+    metrics TEXT NOT NULL,
+    FOREIGN KEY (folder_pair_id)
+        REFERENCES folder_pairs (id)
+    );"""
+
+sql_createindexsync_runs = """
+    CREATE INDEX IF NOT EXISTS sync_runs_index ON sync_runs (folder_pair_id, started_at)
+    ;"""
+
 def create_db(cur):
     cur.execute(sql_createtablefolder_pairs)
-    cur.execute(sql_createindexfolder_pairs)
\ No newline at end of file
+    cur.execute(sql_createindexfolder_pairs)
+    update_db(cur)
+
+def update_db(cur):
+    """Adds tables missing in databases created by earlier versions."""
+    cur.execute(sql_createtablestate_dirs)
+    cur.execute(sql_createtablestate_files)
+    cur.execute(sql_createtabledir_cache)
+    cur.execute(sql_createtablehash_cache)
+    cur.execute(sql_createtableblock_signatures)
+    cur.execute(sql_createtablesync_runs)
+    cur.execute(sql_createindexsync_runs)
+    cur.execute(sql_createtablesync_journal)
+    cur.execute(sql_createindexsync_journal)
+    cur.execute(sql_createtabledir_digests)
\ No newline at end of file
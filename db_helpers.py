@@ -5,15 +5,29 @@ import logging
 import json
 
 """
-Module saves most of its data in json files in folder:
-./folder_sync_config/folder_pair_states
+Module handles the sqlite database file ./folder_sync_config/folder_sync.db
+
+Folder pairs, configuration data and the saved state of each folder pair
+(files existing on both sides after last sync and the dir_cache used by the
+scanner) are saved in the database. State is stored as one row per dir and
+file so that saving only writes the rows that changed.
 
-Folder pairs and configuration data is saved in sqlite database file.
+Older versions saved folder pair states as json files in folder:
+./folder_sync_config/folder_pair_states
+These are migrated into the database once by setup_db.
 """
 
 LOGGER = logging.getLogger(__name__)
 SCRIPT_PATH = pathlib.Path(__file__).parent.absolute()
 
+# Number of host parameters used in a single "IN (...)" query
+SQL_CHUNK_SIZE = 500
+
+
+# Seconds a connection waits for another connection's write transaction
+# (folder pairs synced concurrently in batch mode, see scheduler.py)
+BUSY_TIMEOUT = 60
+
 
 def setup_db():
     db_filepath = SCRIPT_PATH / ".folder_sync_config" / "folder_sync.db"
@@ -24,8 +38,29 @@ def setup_db():
         create_db(cur)
     else: 
         # Duplicate is necessarry since sqlite3.connect creates file if it doesnt exist
+        from create_db import update_db
         con = sqlite3.connect(db_filepath, isolation_level=None)
         cur = con.cursor()
+        update_db(cur)
+
+    # WAL lets readers continue while a state is saved and makes commits cheaper
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT * 1000}")
+    migrate_json_states(cur)
+    return con, cur
+
+
+def connect_db():
+    """Opens another connection to the database already set up by setup_db.
+    sqlite3 connections can only be used by the thread that created them, so
+    every thread syncing a folder pair opens its own."""
+    db_filepath = SCRIPT_PATH / ".folder_sync_config" / "folder_sync.db"
+    con = sqlite3.connect(db_filepath, isolation_level=None, timeout=BUSY_TIMEOUT)
+    cur = con.cursor()
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute("PRAGMA temp_store=MEMORY")
     return con, cur
 
 
@@ -35,20 +70,493 @@ def get_json_path(folder_pair_id):
     return config_path / "folder_pair_states" / file_name
 
 
-def save_folder_state(source, target, item_dict, folder_pair_id) -> None:
+def migrate_json_states(cur):
+    """Moves folder pair states saved as json files (older versions) into the
+    database. Migrated files are renamed to folder_pair_N.json.migrated.
+    Files belonging to folder pairs that aren't registered are left as they are.
+    """
+    states_dir = SCRIPT_PATH / ".folder_sync_config" / "folder_pair_states"
+    if not states_dir.is_dir():
+        return
+
+    for json_file_path in states_dir.glob("folder_pair_*.json"):
+        try:
+            folder_pair_id = int(json_file_path.stem[len("folder_pair_"):])
+        except ValueError:
+            continue
+
+        cur.execute("SELECT id FROM folder_pairs WHERE id = ?;", (folder_pair_id,))
+        if not cur.fetchone():
+            continue
+        cur.execute("SELECT 1 FROM state_dirs WHERE folder_pair_id = ? LIMIT 1;", (folder_pair_id,))
+        if cur.fetchone():
+            continue
+
+        try:
+            with json_file_path.open("r") as json_file:
+                state_dict = json.load(json_file)
+            item_dict = state_dict["items"]
+        except Exception as error:
+            LOGGER.warning(f"Couldn't migrate {json_file_path}: {error}")
+            continue
+
+        dir_cache = state_dict.get("dir_cache", {})
+        dir_caches = [(side, dir_cache[side], {}) for side in dir_cache]
+        if save_folder_state(cur, folder_pair_id, item_dict, dir_caches) == 0:
+            json_file_path.rename(json_file_path.with_suffix(".json.migrated"))
+            LOGGER.info(f"Migrated saved state of folder pair {folder_pair_id} into database")
+
+
+class Saved_state:
+    """
+    Summary:
+        Read access to the saved state of a folder pair. Can be used as the
+        state dictionary (dirs as keys, sets of files as values) but only dir
+        names are read upfront. Files are read when a dir is accessed or in
+        batches with prefetch.
+
+    Properties:
+        self.dirs {set}: All dirs in saved state.
+        self.files {dictionary}: Dirs read so far with set of files as value.
+    """
+
+    def __init__(self, cur, folder_pair_id):
+        self.cur = cur
+        self.id = folder_pair_id
+        cur.execute("SELECT dir FROM state_dirs WHERE folder_pair_id = ?;", (folder_pair_id,))
+        self.dirs = {row[0] for row in cur.fetchall()}
+        self.files = {}
+
+    def __contains__(self, dir):
+        return dir in self.dirs
+
+    def __len__(self):
+        return len(self.dirs)
+
+    def __bool__(self):
+        return bool(self.dirs)
+
+    def __repr__(self):
+        return f"Saved_state({self.id}, dirs: {len(self.dirs)})"
+
+    def keys(self):
+        return self.dirs
+
+    def get(self, dir, default=None):
+        if not dir in self.dirs:
+            return default
+        if not dir in self.files:
+            self.prefetch([dir])
+        return self.files[dir]
+
+    def prefetch(self, dirs):
+        """Reads files of all dirs in iterable dirs with as few queries as possible."""
+        missing = [dir for dir in dirs if dir in self.dirs and not dir in self.files]
+        for dir in missing:
+            self.files[dir] = set()
+
+        for index in range(0, len(missing), SQL_CHUNK_SIZE):
+            chunk = missing[index:index + SQL_CHUNK_SIZE]
+            sql = f"""
+            SELECT dir, name
+            FROM state_files
+            WHERE folder_pair_id = ?
+            AND dir IN ({", ".join("?" * len(chunk))});
+            """
+            self.cur.execute(sql, [self.id] + chunk)
+            for dir, name in self.cur.fetchall():
+                self.files[dir].add(name)
+
+
+def read_dir_cache(cur, folder_pair_id, side):
+    """Reads dir_cache (see Tree_scanner in scanner.py) of one side of a folder pair.
+
+    Args:
+        side {string}: "source" or "target"
+
+    Return:
+        {dictionary}: Relative dir as key and [mtime_ns, ctime_ns, inode, files, dirs] as value.
+    """
+    sql = """
+    SELECT dir, mtime_ns, ctime_ns, inode, files, dirs
+    FROM dir_cache
+    WHERE folder_pair_id = ?
+    AND side = ?;
+    """
+    cur.execute(sql, (folder_pair_id, side))
+    dir_cache = {}
+    for dir, mtime_ns, ctime_ns, inode, files, dirs in cur.fetchall():
+        files = files.split("/") if files else []
+        dirs = dirs.split("/") if dirs else []
+        dir_cache[dir] = [mtime_ns, ctime_ns, inode, files, dirs]
+    return dir_cache
+
+
+def _save_dir_cache(cur, folder_pair_id, side, dir_cache, old_dir_cache):
+    # Only writes entries that differ from the cache read before the scan
+    sql_upsert = """
+    INSERT OR REPLACE INTO dir_cache
+    (folder_pair_id, side, dir, mtime_ns, ctime_ns, inode, files, dirs)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?);
+    """
+    sql_delete = "DELETE FROM dir_cache WHERE folder_pair_id = ? AND side = ? AND dir = ?;"
+
+    changed = (
+        (folder_pair_id, side, dir, meta[0], meta[1], meta[2], "/".join(meta[3]), "/".join(meta[4]))
+        for dir, meta in dir_cache.items()
+        if old_dir_cache.get(dir) != meta)
+    cur.executemany(sql_upsert, changed)
+
+    removed = ((folder_pair_id, side, dir) for dir in old_dir_cache if not dir in dir_cache)
+    cur.executemany(sql_delete, removed)
+
+
+def read_dir_digests(cur, folder_pair_id, side):
+    """Reads dir digests (see dir_digest.py) of one side of a folder pair.
+
+    Return:
+        {dictionary}: Relative dir as key and digest {bytes} as value. Empty
+        if the folder pair changed since its state was saved.
+    """
+    cur.execute("SELECT dir, digest FROM dir_digests WHERE folder_pair_id = ? AND side = ?;",
+                (folder_pair_id, side))
+    return dict(cur.fetchall())
+
+
+def _save_dir_digests(cur, folder_pair_id, dir_digests):
+    # Digests are only valid with the state they were saved with
+    cur.execute("DELETE FROM dir_digests WHERE folder_pair_id = ?;", (folder_pair_id,))
+    for side, digests in dir_digests or ():
+        cur.executemany("INSERT INTO dir_digests (folder_pair_id, side, dir, digest) VALUES (?, ?, ?, ?);",
+                        ((folder_pair_id, side, dir, digest) for dir, digest in digests.items()))
+
+
+def read_hashes(cur, entries):
+    """Reads cached content hashes (see content_hash.py).
+
+    Args:
+        entries {iterable}: Entry_stat instances (see scanner.py).
+
+    Return:
+        {dictionary}: Entry_stat as key and digest {bytes} as value for entries
+        with a valid (same size and mtime_ns) cached digest.
+    """
+    sql = "SELECT size, mtime_ns, digest FROM hash_cache WHERE dev = ? AND ino = ?;"
+    digests = {}
+    for entry in entries:
+        cur.execute(sql, (entry.dev, entry.ino))
+        row = cur.fetchone()
+        if row and row[0] == entry.size and row[1] == entry.mtime_ns:
+            digests[entry] = row[2]
+    return digests
+
+
+def save_hashes(cur, digests):
+    """Saves content hashes in one transaction (or the active one).
+
+    Args:
+        digests {dictionary}: Entry_stat as key and digest {bytes} as value.
+    """
+    if not digests:
+        return
+    own_transaction = not cur.connection.in_transaction
+    if own_transaction:
+        cur.execute("BEGIN")
+    cur.executemany("""
+    INSERT OR REPLACE INTO hash_cache (dev, ino, size, mtime_ns, digest)
+    VALUES (?, ?, ?, ?, ?);
+    """, ((entry.dev, entry.ino, entry.size, entry.mtime_ns, digest)
+          for entry, digest in digests.items()))
+    if own_transaction:
+        cur.execute("COMMIT")
+
+
+def read_signatures(cur, keys, block_size):
+    """Reads cached block signatures (see delta.py).
+
+    Args:
+        keys {iterable}: File_key instances (see delta.py).
+        block_size {int}: Signatures made with another block size are ignored.
+
+    Return:
+        {dictionary}: File_key as key and signature {bytes} as value for keys
+        with a valid (same size, mtime_ns and block_size) cached signature.
+    """
+    sql = "SELECT size, mtime_ns, block_size, signature FROM block_signatures WHERE dev = ? AND ino = ?;"
+    signatures = {}
+    for key in keys:
+        cur.execute(sql, (key.dev, key.ino))
+        row = cur.fetchone()
+        if row and row[0] == key.size and row[1] == key.mtime_ns and row[2] == block_size:
+            signatures[key] = row[3]
+    return signatures
+
+
+def save_signatures(cur, signatures, block_size):
+    """Saves block signatures in one transaction (or the active one).
+
+    Args:
+        signatures {dictionary}: File_key as key and signature {bytes} as value.
+        block_size {int}: Block size the signatures were made with.
+    """
+    if not signatures:
+        return
+    own_transaction = not cur.connection.in_transaction
+    if own_transaction:
+        cur.execute("BEGIN")
+    cur.executemany("""
+    INSERT OR REPLACE INTO block_signatures (dev, ino, size, mtime_ns, block_size, signature)
+    VALUES (?, ?, ?, ?, ?, ?);
+    """, ((key.dev, key.ino, key.size, key.mtime_ns, block_size, signature)
+          for key, signature in signatures.items()))
+    if own_transaction:
+        cur.execute("COMMIT")
+
 
-    json_file_path = get_json_path(folder_pair_id)
-    state_dict = {"source": source, "target": target, "id": folder_pair_id, "items": item_dict}
+def append_journal(cur, folder_pair_id, entries):
+    """Appends entries to sync_journal in one transaction (see journal.py).
+
+    Args:
+        entries {list}: Tuples (op, dir, name) with op "add" or "remove" and
+        name None for a dir, or op "update" or "updated" and the absolute dir
+        of a file updated in place.
 
+    Return:
+        {integer}: 0 on success. 1 on failure.
+    """
+    own_transaction = not cur.connection.in_transaction
     try:
-        with json_file_path.open("w") as outfile:
-            json.dump(state_dict, outfile)
-            return 0
+        if own_transaction:
+            cur.execute("BEGIN")
+        cur.executemany("INSERT INTO sync_journal (folder_pair_id, op, dir, name) VALUES (?, ?, ?, ?);",
+                        ((folder_pair_id, op, dir, name) for op, dir, name in entries))
+        if own_transaction:
+            cur.execute("COMMIT")
+        return 0
+    except sqlite3.Error as error:
+        if own_transaction and cur.connection.in_transaction:
+            cur.execute("ROLLBACK")
+        LOGGER.warning(f"Couldn't write sync journal: {error}")
+        return 1
+
+
+def clear_journal(cur, folder_pair_id):
+    cur.execute("DELETE FROM sync_journal WHERE folder_pair_id = ?;", (folder_pair_id,))
+
+
+def replay_journal(cur, folder_pair_id):
+    """Applies the journal left by an interrupted sync of the folder pair
+    to its saved state and clears it, in one transaction. Files whose
+    update in place was started but not done get mtime 0 (see journal.py).
+
+    Return:
+        {integer}: Number of journal entries replayed.
+    """
+    cur.execute("SELECT op, dir, name FROM sync_journal WHERE folder_pair_id = ? ORDER BY id;",
+                (folder_pair_id,))
+    entries = cur.fetchall()
+    if not entries:
+        return 0
+
+    # Half written files are older than the other side after this
+    half_updated = set()
+    for op, dir, name in entries:
+        if op == "update":
+            half_updated.add(os.path.join(dir, name))
+        elif op == "updated":
+            half_updated.discard(os.path.join(dir, name))
+    for path in sorted(half_updated):
+        try:
+            os.utime(path, ns=(os.lstat(path).st_atime_ns, 0), follow_symlinks=False)
+            LOGGER.warning(f"Update of {path} was interrupted, it is replaced next sync")
+        except OSError as error:
+            LOGGER.error(f"Couldn't reset mtime of half updated {path}: {error}")
+
+    own_transaction = not cur.connection.in_transaction
+    try:
+        if own_transaction:
+            cur.execute("BEGIN")
+        for op, dir, name in entries:
+            if op in ("update", "updated"):
+                continue
+            elif op == "add":
+                cur.execute("INSERT OR IGNORE INTO state_dirs (folder_pair_id, dir) VALUES (?, ?);",
+                            (folder_pair_id, dir))
+                if name is not None:
+                    cur.execute("INSERT OR IGNORE INTO state_files (folder_pair_id, dir, name) "
+                                "VALUES (?, ?, ?);", (folder_pair_id, dir, name))
+            elif name is not None:
+                cur.execute("DELETE FROM state_files WHERE folder_pair_id = ? AND dir = ? AND name = ?;",
+                            (folder_pair_id, dir, name))
+            else:
+                cur.execute("DELETE FROM state_files WHERE folder_pair_id = ? AND dir = ?;",
+                            (folder_pair_id, dir))
+                cur.execute("DELETE FROM state_dirs WHERE folder_pair_id = ? AND dir = ?;",
+                            (folder_pair_id, dir))
+        clear_journal(cur, folder_pair_id)
+        _save_dir_digests(cur, folder_pair_id, None)
+        if own_transaction:
+            cur.execute("COMMIT")
+        return len(entries)
+    except sqlite3.Error as error:
+        # Journal is left as is, the state saved after next sync replaces it
+        if own_transaction and cur.connection.in_transaction:
+            cur.execute("ROLLBACK")
+        LOGGER.warning(f"Couldn't replay sync journal: {error}")
+        return 0
+
+
+def save_folder_state(cur, folder_pair_id, item_dict, dir_caches=None, dir_digests=None):
+    """Saves state of folder pair. The new state is written to temporary tables
+    and only the differences are applied to state_dirs and state_files, in one
+    transaction. If a transaction is already active it is used instead (and
+    left for the caller to commit).
+
+    Args:
+        cur {object}: Cursor of db.
+        folder_pair_id {int}: id in folder_pairs.
+        item_dict {dictionary}: Dirs as keys and iterables with files existing on both sides as values.
+        dir_caches {list}: Optional. Tuples (side, dir_cache, old_dir_cache) with
+        side being "source" or "target". See Tree_scanner in scanner.py.
+        dir_digests {list}: Optional. Tuples (side, digests) replacing the dir
+        digests of the folder pair (see dir_digest.py). Without them the saved
+        digests are deleted.
+
+    Return:
+        {integer}: 0 on success. 1 on failure.
+    """
+    own_transaction = not cur.connection.in_transaction
+
+    try:
+        if own_transaction:
+            cur.execute("BEGIN")
+
+        cur.execute("CREATE TEMP TABLE IF NOT EXISTS new_state_dirs (dir TEXT PRIMARY KEY) WITHOUT ROWID;")
+        cur.execute("""CREATE TEMP TABLE IF NOT EXISTS new_state_files (dir TEXT NOT NULL,
+                    name TEXT NOT NULL, PRIMARY KEY (dir, name)) WITHOUT ROWID;""")
+        cur.execute("DELETE FROM temp.new_state_dirs;")
+        cur.execute("DELETE FROM temp.new_state_files;")
+
+        cur.executemany("INSERT INTO temp.new_state_dirs (dir) VALUES (?);",
+                        ((dir,) for dir in item_dict))
+        cur.executemany("INSERT INTO temp.new_state_files (dir, name) VALUES (?, ?);",
+                        ((dir, name) for dir in item_dict for name in item_dict[dir]))
+
+        cur.execute("""
+        DELETE FROM state_files
+        WHERE folder_pair_id = ?
+        AND NOT EXISTS (
+            SELECT 1 FROM temp.new_state_files AS new
+            WHERE new.dir = state_files.dir AND new.name = state_files.name);
+        """, (folder_pair_id,))
+        deleted = cur.rowcount
+        cur.execute("""
+        DELETE FROM state_dirs
+        WHERE folder_pair_id = ?
+        AND NOT EXISTS (
+            SELECT 1 FROM temp.new_state_dirs AS new
+            WHERE new.dir = state_dirs.dir);
+        """, (folder_pair_id,))
+        deleted += cur.rowcount
+
+        cur.execute("""
+        INSERT OR IGNORE INTO state_dirs (folder_pair_id, dir)
+        SELECT ?, dir FROM temp.new_state_dirs;
+        """, (folder_pair_id,))
+        added = cur.rowcount
+        cur.execute("""
+        INSERT OR IGNORE INTO state_files (folder_pair_id, dir, name)
+        SELECT ?, dir, name FROM temp.new_state_files;
+        """, (folder_pair_id,))
+        added += cur.rowcount
+
+        cur.execute("DELETE FROM temp.new_state_dirs;")
+        cur.execute("DELETE FROM temp.new_state_files;")
+
+        if dir_caches:
+            for side, dir_cache, old_dir_cache in dir_caches:
+                _save_dir_cache(cur, folder_pair_id, side, dir_cache, old_dir_cache)
+        _save_dir_digests(cur, folder_pair_id, dir_digests)
+
+        if own_transaction:
+            cur.execute("COMMIT")
+        LOGGER.debug(f"Saved state of folder pair {folder_pair_id}: {added} rows added, {deleted} rows deleted")
+        return 0
+
     except Exception as error:
+        if own_transaction and cur.connection.in_transaction:
+            cur.execute("ROLLBACK")
         LOGGER.warning(error)
         return 1
         
 
+def update_folder_state(cur, folder_pair_id, scope, item_dict):
+    """Replaces the saved state of the dirs in scope only (the rest of the
+    state is left as is). Used by watch mode (see watcher.py) after syncing a
+    batch of dirty dirs.
+
+    Args:
+        cur {object}: Cursor of db.
+        folder_pair_id {int}: id in folder_pairs.
+        scope {iterable}: Dirs whose state is replaced.
+        item_dict {dictionary}: New state of dirs in scope (dirs as keys and
+        iterables with files as values). Dirs in scope missing in item_dict
+        are removed from the state.
+
+    Return:
+        {integer}: 0 on success. 1 on failure.
+    """
+    own_transaction = not cur.connection.in_transaction
+    scope = list(scope)
+
+    try:
+        if own_transaction:
+            cur.execute("BEGIN")
+
+        cur.executemany("DELETE FROM state_files WHERE folder_pair_id = ? AND dir = ?;",
+                        ((folder_pair_id, dir) for dir in scope))
+        cur.executemany("DELETE FROM state_dirs WHERE folder_pair_id = ? AND dir = ?;",
+                        ((folder_pair_id, dir) for dir in scope))
+        cur.executemany("INSERT INTO state_dirs (folder_pair_id, dir) VALUES (?, ?);",
+                        ((folder_pair_id, dir) for dir in scope if dir in item_dict))
+        cur.executemany("INSERT INTO state_files (folder_pair_id, dir, name) VALUES (?, ?, ?);",
+                        ((folder_pair_id, dir, name) for dir in scope if dir in item_dict
+                         for name in item_dict[dir]))
+        _save_dir_digests(cur, folder_pair_id, None)
+
+        if own_transaction:
+            cur.execute("COMMIT")
+        return 0
+
+    except Exception as error:
+        if own_transaction and cur.connection.in_transaction:
+            cur.execute("ROLLBACK")
+        LOGGER.warning(error)
+        return 1
+
+
+def save_sync_run(cur, folder_pair_id, metrics_dict):
+    """Saves metrics of a sync run (see Metrics_registry.as_dict in metrics.py)
+    in table sync_runs.
+
+    Return:
+        {integer}: 0 on success. 1 on failure.
+    """
+    counters = metrics_dict["counters"]
+    try:
+        cur.execute("""
+        INSERT INTO sync_runs
+        (folder_pair_id, started_at, duration, files_scanned, bytes_transferred, errors, metrics)
+        VALUES (?, ?, ?, ?, ?, ?, ?);
+        """, (folder_pair_id, metrics_dict["started_at"], metrics_dict["duration"],
+              counters.get("files_scanned", 0), counters.get("bytes_transferred", 0),
+              sum(metrics_dict["errors"].values()), json.dumps(metrics_dict)))
+        return 0
+    except sqlite3.Error as error:
+        LOGGER.warning(f"Couldn't save metrics of sync run: {error}")
+        return 1
+
+
 def adjust_dirname(dirname):
     """adjust dirname to always end with separator (in linux = /)"""
     return str(pathlib.Path(dirname).absolute()) + os.path.sep
@@ -92,6 +600,24 @@ def get_folder_pair_id(cur, source, target):
         return run_sql(target, source)
         
 
+def get_folder_pairs(cur, pair_ids=None):
+    """Returns registered folder pairs.
+
+    Args:
+        cur {object}: Object of active cursor
+        pair_ids {iterable}: ids to return. None returns all folder pairs.
+
+    Return:
+        {list}: Tuples (id, source, target) ordered by id.
+    """
+    cur.execute("SELECT id, source, target FROM folder_pairs ORDER BY id;")
+    folder_pairs = cur.fetchall()
+    if pair_ids is not None:
+        pair_ids = set(pair_ids)
+        folder_pairs = [pair for pair in folder_pairs if pair[0] in pair_ids]
+    return folder_pairs
+
+
 def add_folder_pair(cur, source, target):
     """
     Creates folder pair in db table folder_pairs. If not already there a
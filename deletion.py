@@ -0,0 +1,210 @@
+"""This module contains the deletion engine used by Syncer (see helpers).
+
+Planned deletions of one side are grouped by parent dir. Each group opens its
+parent dir once and unlinks the files relative to the dir file descriptor
+(dir_fd), so the kernel doesn't resolve the full path of every file again.
+Dirs planned for deletion (a subtree that vanished on the other side) are
+removed in one bottom-up walk from the topmost planned dir, opening each dir
+relative to its parent. Dirs are opened with O_NOFOLLOW, so a dir replaced by
+a symlink since the scan is never descended into.
+
+Only planned items are deleted. A dir that isn't empty when its planned
+content is gone (new or excluded files) is left with an error, the same way a
+plain rmdir would fail. Groups run on a thread pool while results are
+returned to the calling thread, one group at a time.
+
+Dirs are opened and entries removed through a filesystem (see filesystem.py),
+dir file descriptors on the real disk.
+"""
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from filesystem import LOCAL_FILESYSTEM
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_DELETE_WORKERS = 4
+
+
+def join_rel(dir, name):
+    # Same as join_rel_path in helpers (helpers imports this module)
+    return name if dir == "." else dir + os.path.sep + name
+
+
+class Delete_result:
+    """
+    Summary:
+        Outcome of deleting one group (files and subtrees in one parent dir).
+
+    Properties:
+        self.files {dictionary} = Relative dir as key and list of deleted file names as value
+        self.dirs {list} = Relative paths of deleted dirs
+        self.failed {list} = Tuples (relative path, OSError) of items that couldn't be deleted
+        self.lines {list} = Output lines
+    """
+
+    __slots__ = ["files", "dirs", "failed", "lines"]
+
+    def __init__(self):
+        self.files = {}
+        self.dirs = []
+        self.failed = []
+        self.lines = []
+
+    def __repr__(self):
+        return f"Delete_result(files: {self.file_count()}, dirs: {len(self.dirs)}, failed: {len(self.failed)})"
+
+    def file_count(self):
+        return sum(len(names) for names in self.files.values())
+
+
+class Bulk_deleter:
+    """
+    Summary:
+        Deletes planned files and dirs of one side (see module docstring).
+
+    Properties:
+        self.workers {int} = Number of groups deleted concurrently
+        self.print_output {bool} = Wether deletions are printed
+        self.fs {object} = Filesystem deleted from (see filesystem.py)
+    """
+
+    def __init__(self, workers=DEFAULT_DELETE_WORKERS, print_output=True, filesystem=LOCAL_FILESYSTEM):
+        self.workers = max(1, workers)
+        self.print_output = print_output
+        self.fs = filesystem
+
+    def __repr__(self):
+        return f"Bulk_deleter(workers: {self.workers})"
+
+    def run(self, root, files, dirs):
+        """Deletes files and dirs below root.
+
+        Args:
+            root {string}: Absolute path of side.
+            files {dictionary}: Relative dir as key and list of file names as value.
+            dirs {iterable}: Relative dirs to delete. Everything planned below
+            them must be in files or dirs.
+
+        Yields:
+            {Delete_result}: One per group, in the order groups finish.
+        """
+        doomed = set(dirs)
+        # Planned subdirs of each planned dir, and the work per surviving parent dir
+        children = {}
+        groups = {}
+        for rel_dir in doomed:
+            parent = os.path.dirname(rel_dir) or "."
+            if parent in doomed:
+                children.setdefault(parent, []).append(rel_dir)
+            else:
+                groups.setdefault(parent, ([], []))[1].append(rel_dir)
+        for rel_dir, names in files.items():
+            if not rel_dir in doomed:
+                groups.setdefault(rel_dir, ([], []))[0].extend(names)
+
+        plan = (root, files, children)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(self.delete_group, plan, parent, names, subtrees)
+                       for parent, (names, subtrees) in groups.items()]
+            for future in as_completed(futures):
+                result = future.result()
+                if self.print_output and result.lines:
+                    print(os.linesep.join(result.lines))
+                yield result
+
+    def delete_group(self, plan, parent, names, subtrees):
+        """Runs in worker thread. Deletes files names in parent and the
+        planned subtrees (relative dirs) in parent."""
+        root, files, children = plan
+        result = Delete_result()
+        try:
+            parent_fd = self.fs.open_dir(os.path.join(root, parent))
+        except OSError as error:
+            # Nothing in parent can be deleted
+            result.failed.extend((join_rel(parent, name), error) for name in names)
+            for rel_dir in subtrees:
+                self.__fail_subtree(plan, rel_dir, error, result)
+            return result
+
+        try:
+            deleted = self.__unlink_files(parent_fd, parent, names, result)
+            result.lines.extend(f"Deleted file: {os.path.join(root, join_rel(parent, name))}"
+                                for name in sorted(deleted))
+            for rel_dir in sorted(subtrees):
+                self.__delete_subtree(plan, parent_fd, rel_dir, result)
+        finally:
+            self.fs.close_dir(parent_fd)
+        return result
+
+    def __unlink_files(self, dir_fd, rel_dir, names, result):
+        deleted = []
+        for name in names:
+            try:
+                self.fs.unlink(name, dir_fd)
+                deleted.append(name)
+            except OSError as error:
+                result.failed.append((join_rel(rel_dir, name), error))
+        if deleted:
+            result.files.setdefault(rel_dir, []).extend(deleted)
+        return deleted
+
+    def __delete_subtree(self, plan, parent_fd, top, result):
+        # Walks the planned subtree (not the filesystem). Dirs are opened on
+        # the way down and removed on the way up.
+        root, files, children = plan
+        files_before, dirs_before = result.file_count(), len(result.dirs)
+        failed_before = len(result.failed)
+        # (relative dir, fd of parent, (fd, iterator of planned subdirs) once opened)
+        stack = [(top, parent_fd, None)]
+        try:
+            while stack:
+                rel_dir, dir_parent_fd, opened = stack[-1]
+                name = os.path.basename(rel_dir)
+                if opened is None:
+                    try:
+                        dir_fd = self.fs.open_dir(name, dir_parent_fd)
+                    except OSError as error:
+                        stack.pop()
+                        self.__fail_subtree(plan, rel_dir, error, result)
+                        continue
+                    stack[-1] = (rel_dir, dir_parent_fd, (dir_fd, iter(children.get(rel_dir, ()))))
+                    self.__unlink_files(dir_fd, rel_dir, files.get(rel_dir, ()), result)
+                    continue
+
+                dir_fd, subdirs = opened
+                subdir = next(subdirs, None)
+                if subdir is not None:
+                    stack.append((subdir, dir_fd, None))
+                    continue
+
+                stack.pop()
+                self.fs.close_dir(dir_fd)
+                try:
+                    self.fs.rmdir(name, dir_parent_fd)
+                    result.dirs.append(rel_dir)
+                except OSError as error:
+                    result.failed.append((rel_dir, error))
+        finally:
+            for _, _, opened in stack:
+                if opened is not None:
+                    self.fs.close_dir(opened[0])
+
+        path = os.path.join(root, top)
+        file_count, dir_count = result.file_count() - files_before, len(result.dirs) - dirs_before
+        if len(result.failed) == failed_before:
+            result.lines.append(f"Deleted directory: {path}{os.path.sep} "
+                                f"({file_count} files, {dir_count - 1} subdirs)")
+        elif file_count or dir_count:
+            result.lines.append(f"Deleted {file_count} files and {dir_count} dirs in "
+                                f"{path}{os.path.sep} (rest couldn't be deleted)")
+
+    def __fail_subtree(self, plan, top, error, result):
+        # Everything planned in and below top fails with error
+        _, files, children = plan
+        stack = [top]
+        while stack:
+            rel_dir = stack.pop()
+            result.failed.extend((join_rel(rel_dir, name), error) for name in files.get(rel_dir, ()))
+            result.failed.append((rel_dir, error))
+            stack.extend(children.get(rel_dir, ()))
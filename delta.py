@@ -0,0 +1,132 @@
+"""This module contains block level delta updates for the native transfer
+backend (--delta-min-size in folder_sync.py).
+
+Large files that change a little at a time (VM images, Lightroom catalogs,
+mailbox files) are normally rewritten completely when they are updated. With
+delta updates a file existing on both sides and at least min_size bytes is
+compared block by block instead, and only the blocks that differ are written
+on the receiving side. The file is updated in place (like rsync --inplace), so
+unchanged blocks are never written again.
+
+A block signature is the blake2b digest of every block of a file. Signatures
+are saved in table block_signatures keyed on (device, inode) together with
+size and mtime_ns (like hash_cache, see content_hash.py). When the receiving
+file has a valid cached signature it isn't read at all, only the sending file
+is. After an update both files have the same content, size and mtime, so the
+signature is saved for both and the next update of either side only needs to
+read the side that changed.
+
+Blocks are compared at fixed offsets. Data inserted in the middle of a file
+makes every later block differ, which costs the same as a full copy.
+"""
+import hashlib
+import logging
+import os
+from collections import namedtuple
+from db_helpers import read_signatures, save_signatures
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_DELTA_MIN_SIZE = 64 * 1024 * 1024
+BLOCK_SIZE = 1024 * 1024
+DIGEST_SIZE = 16
+
+# Identity of a file in block_signatures (see Signature_cache)
+File_key = namedtuple("File_key", ["dev", "ino", "size", "mtime_ns"])
+
+
+def file_key(st):
+    return File_key(st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def block_digest(data):
+    return hashlib.blake2b(data, digest_size=DIGEST_SIZE).digest()
+
+
+def update_blocks(src_fd, dst_fd, src_size, dst_size, dst_signature=None):
+    """Makes content of dst_fd equal to src_fd by writing only the blocks
+    that differ (and truncating or extending dst_fd to src_size).
+
+    Args:
+        src_fd, dst_fd {int}: Open file descriptors (dst_fd writable).
+        src_size, dst_size {int}: Current sizes of the files.
+        dst_signature {bytes}: Optional. Valid signature of dst_fd. Without it
+        the blocks of dst_fd are read and compared directly.
+
+    Returns:
+        {tuple}: (bytes_written, signature) where signature {bytes} is the new
+        signature of both files.
+    """
+    written = 0
+    digests = []
+    for offset in range(0, src_size, BLOCK_SIZE):
+        data = os.pread(src_fd, BLOCK_SIZE, offset)
+        if not data:
+            break
+        digest = block_digest(data)
+        digests.append(digest)
+
+        if offset >= dst_size:
+            same = False
+        elif dst_signature is not None:
+            start = (offset // BLOCK_SIZE) * DIGEST_SIZE
+            # Last block of dst is shorter, its digest differs unless it has the same data
+            same = dst_signature[start:start + DIGEST_SIZE] == digest
+        else:
+            same = os.pread(dst_fd, len(data), offset) == data
+        if same:
+            continue
+
+        view = memoryview(data)
+        position = offset
+        while view:
+            count = os.pwrite(dst_fd, view, position)
+            view = view[count:]
+            position += count
+        written += len(data)
+
+    if dst_size != src_size:
+        os.ftruncate(dst_fd, src_size)
+    return written, b"".join(digests)
+
+
+class Signature_cache:
+    """
+    Summary:
+        Block signatures of files, read from and saved to table
+        block_signatures. Database is only used from the thread calling
+        load and save, the worker threads doing updates use self.signatures.
+
+    Properties:
+        self.cur {object} = Cursor of db
+        self.min_size {int} = Files smaller than this are copied completely
+        self.signatures {dictionary} = File_key as key and signature {bytes} as value
+        self.new_signatures {dictionary} = Signatures computed since last save
+    """
+
+    def __init__(self, cur, min_size=DEFAULT_DELTA_MIN_SIZE):
+        self.cur = cur
+        self.min_size = min_size
+        self.signatures = {}
+        self.new_signatures = {}
+
+    def __repr__(self):
+        return f"Signature_cache(min_size: {self.min_size}, loaded: {len(self.signatures)})"
+
+    def load(self, keys):
+        """Reads cached signatures of keys (File_key of receiving files)."""
+        self.signatures.update(read_signatures(self.cur, keys, BLOCK_SIZE))
+
+    def get(self, key):
+        return self.signatures.get(key)
+
+    def add(self, keys, signature):
+        # Called from worker threads (dict assignment is atomic)
+        for key in keys:
+            self.new_signatures[key] = signature
+
+    def save(self):
+        new_signatures, self.new_signatures = self.new_signatures, {}
+        save_signatures(self.cur, new_signatures, BLOCK_SIZE)
+        self.signatures.update(new_signatures)
+        LOGGER.debug(f"Saved {len(new_signatures)} block signatures")
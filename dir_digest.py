@@ -0,0 +1,110 @@
+"""This module contains the directory digests used to find out quickly that
+nothing changed since last sync (see two_way_sync in sync_functions).
+
+The digest of a dir is the blake2b digest of its listing as Syncer sees it:
+name, type, size and mtime of every non excluded file and the names of the
+non excluded subdirs. As the digest of a dir covers the names of its subdirs
+and each subdir has a digest of its own, the digests of one side together
+describe the whole tree (like a Merkle tree without hashing the hashes).
+
+Digests of both sides are saved in table dir_digests together with the state
+of a sync that found nothing to do, ie when both sides were known to match
+the saved state. Any sync that changes something replaces the state and
+deletes them (see save_folder_state in db_helpers), so they are only valid
+as long as nothing has changed.
+
+The next sync compares each dir with its saved digest while both trees are
+scanned (Digest_check gets every listing from scan_trees), so nothing is
+listed twice. Listings come from the dir_cache when the metadata of a dir is
+unchanged (see Tree_scanner), but every file is still lstat'ed: modifying a
+file doesn't change the metadata of its dir, so no subtree can be skipped.
+When every dir matches, the sync is done after the scan without Syncer or a
+new state. Otherwise the indexes of the scan are used for the regular sync.
+"""
+import hashlib
+import logging
+import os
+import stat
+
+LOGGER = logging.getLogger(__name__)
+
+DIGEST_SIZE = 16
+
+
+def dir_digest(files, sub_dirs):
+    """Returns the digest {bytes} of one dir.
+
+    Args:
+        files {iterable}: Tuples (name, size, mtime_ns, mode) sorted by name.
+        sub_dirs {iterable}: Names of subdirs sorted.
+    """
+    # One update per dir, hashing line by line costs more than the hashing
+    lines = [f"{name}\0{stat.S_IFMT(mode)}\0{size}\0{mtime_ns}\n"
+             for name, size, mtime_ns, mode in files]
+    lines.extend(f"{name}/\n" for name in sub_dirs)
+    data = "".join(lines).encode("utf-8", "surrogateescape")
+    return hashlib.blake2b(data, digest_size=DIGEST_SIZE).digest()
+
+
+def index_digests(index):
+    """Returns digests of all dirs of a Tree_index (see tree_index.py).
+
+    Returns:
+        {dictionary}: Relative dir as key and digest {bytes} as value.
+    """
+    sub_dirs = {}
+    for rel_dir in index.dirs:
+        if rel_dir != ".":
+            parent, name = os.path.split(rel_dir)
+            sub_dirs.setdefault(parent or ".", []).append(name)
+
+    return {rel_dir: indexed_dir_digest(index, dir_id, sorted(sub_dirs.get(rel_dir, ())))
+            for dir_id, rel_dir in enumerate(index.dirs)}
+
+
+def indexed_dir_digest(index, dir_id, sub_dirs):
+    # Digest of a dir of a Tree_index. sub_dirs {list}: Names of its subdirs sorted.
+    first, end = index.dir_range(dir_id)
+    files = zip(index.names[first:end], index.size[first:end],
+                index.mtime_ns[first:end], index.mode[first:end])
+    return dir_digest(files, sub_dirs)
+
+
+class Digest_check:
+    """
+    Summary:
+        Compares every dir listed by scan_trees (pass on_listing to it) with
+        its saved digest.
+
+    Properties:
+        self.saved {dictionary} = Tree_scanner as key and saved digests of
+            its side (see index_digests) as value
+        self.dirs_checked {int} = Number of dirs that matched their digest
+        self.changed {bool} = A dir didn't match its digest (or has none)
+    """
+
+    def __init__(self, scanners, saved_digests):
+        self.saved = dict(zip(scanners, saved_digests))
+        self.dirs_checked = 0
+        self.changed = False
+
+    def __repr__(self):
+        return f"Digest_check(checked: {self.dirs_checked}, changed: {self.changed})"
+
+    def on_listing(self, scanner, basedir, sub_dirs):
+        """Called by scan_trees when basedir was added to the index of scanner."""
+        if self.changed:
+            return
+        index = scanner.index
+        names = sorted(os.path.basename(sub_dir) for sub_dir in sub_dirs)
+        if self.saved[scanner].get(basedir) != indexed_dir_digest(index, index.dir_ids[basedir], names):
+            LOGGER.debug(f"{scanner.abs_path(basedir)} changed since last sync")
+            self.changed = True
+            return
+        self.dirs_checked += 1
+
+    def unchanged(self):
+        """Returns True if every dir of every tree matched its saved digest.
+        Call when the scan is done."""
+        # Every saved dir must have been listed, otherwise the digests are stale
+        return not self.changed and self.dirs_checked == sum(map(len, self.saved.values()))
@@ -0,0 +1,391 @@
+"""This module contains the filesystems the scanner, Syncer and the deletion
+engine work on.
+
+Local_filesystem is the real disk and is used unless another filesystem is
+passed on (LOCAL_FILESYSTEM). Memory_filesystem keeps a whole tree in memory,
+so planning and deleting can be measured on trees far larger than what fits
+on a test disk (see benchmark.py). It can add latency to every operation and
+limit how many operations run at the same time, which simulates a network
+share (high latency, many requests in flight) or a usb disk (one request at a
+time). That shows how scan and delete workers scale on slow devices.
+
+Both raise OSError (FileNotFoundError, NotADirectoryError...) where os does,
+so callers handle errors the same way. Transfers (rsync and Native_transfer)
+and content hashing always work on the real disk.
+
+Methods used:
+    scan_dir(abs_dir)                       Names of files and dirs (see scan_dir)
+    lstat_files(abs_dir, names, entries)    lstat of files in one dir
+    lstat(path), lexists(path)
+    set_mtime(path, mtime_ns)               Like touch, symlinks aren't followed
+    open_dir(path, dir_fd), close_dir(dir_fd)
+    unlink(name, dir_fd), rmdir(name, dir_fd)
+"""
+import errno
+import logging
+import os
+import stat
+import threading
+from collections import namedtuple
+from itertools import count
+from time import sleep, time_ns
+
+LOGGER = logging.getLogger(__name__)
+
+# Dirs are opened without following symlinks (see deletion.py)
+DIR_FLAGS = os.O_RDONLY | getattr(os, "O_DIRECTORY", 0) | getattr(os, "O_NOFOLLOW", 0)
+
+
+def scan_dir(abs_dir):
+    """Lists a single directory with os.scandir. Only uses the information
+    in the DirEntry objects, ie no extra stat calls on linux.
+
+    Args:
+        abs_dir {string}: Absolute path to directory.
+
+    Returns:
+        {tuple}: (files, dirs, entries) where files {list} contains names of
+        everything that is not a real directory (symlinks to dirs included),
+        dirs {list} contains names of real subdirectories and entries {dictionary}
+        has the DirEntry of each file (name as key). None if dir couldn't be
+        listed (os.walk silently skips those as well).
+    """
+    files, dirs, entries = [], [], {}
+    try:
+        with os.scandir(abs_dir) as dir_entries:
+            for entry in dir_entries:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+
+                if not is_dir:
+                    files.append(entry.name)
+                    entries[entry.name] = entry
+                    continue
+
+                try:
+                    is_symlink = entry.is_symlink()
+                except OSError:
+                    is_symlink = False
+
+                if is_symlink:
+                    # Symlinks to dirs are synced as files and never descended into.
+                    files.append(entry.name)
+                    entries[entry.name] = entry
+                else:
+                    dirs.append(entry.name)
+    except OSError as error:
+        LOGGER.debug(f"Couldn't list {abs_dir}: {error}")
+        return None
+
+    return files, dirs, entries
+
+
+class Local_filesystem:
+    """
+    Summary:
+        The real disk. Thin wrappers of os, dir_fd's are file descriptors.
+    """
+
+    def __repr__(self):
+        return "Local_filesystem()"
+
+    def scan_dir(self, abs_dir):
+        return scan_dir(abs_dir)
+
+    def lstat_files(self, abs_dir, names, entries=None):
+        """lstats names in abs_dir. Uses the DirEntry objects of scan_dir if
+        given, otherwise names are lstat'ed relative to an fd of the dir,
+        which skips resolving the whole path for every file.
+
+        Returns:
+            {dictionary}: Name as key and stat_result as value. Files that
+            couldn't be lstat'ed (removed since listing) are left out.
+        """
+        dir_fd = None
+        if entries is None and os.lstat in os.supports_dir_fd:
+            try:
+                dir_fd = os.open(abs_dir, DIR_FLAGS)
+            except OSError:
+                dir_fd = None
+
+        stats = {}
+        try:
+            for name in names:
+                try:
+                    if entries is not None:
+                        stats[name] = entries[name].stat(follow_symlinks=False)
+                    elif dir_fd is not None:
+                        stats[name] = os.lstat(name, dir_fd=dir_fd)
+                    else:
+                        stats[name] = os.lstat(os.path.join(abs_dir, name))
+                except OSError:
+                    continue
+        finally:
+            if dir_fd is not None:
+                os.close(dir_fd)
+        return stats
+
+    def lstat(self, path):
+        return os.lstat(path)
+
+    def lexists(self, path):
+        return os.path.lexists(path)
+
+    def set_mtime(self, path, mtime_ns):
+        os.utime(path, ns=(os.lstat(path).st_atime_ns, mtime_ns), follow_symlinks=False)
+
+    def open_dir(self, path, dir_fd=None):
+        return os.open(path, DIR_FLAGS, dir_fd=dir_fd)
+
+    def close_dir(self, dir_fd):
+        os.close(dir_fd)
+
+    def unlink(self, name, dir_fd=None):
+        os.unlink(name, dir_fd=dir_fd)
+
+    def rmdir(self, name, dir_fd=None):
+        os.rmdir(name, dir_fd=dir_fd)
+
+
+LOCAL_FILESYSTEM = Local_filesystem()
+
+Mem_stat = namedtuple("Mem_stat", ["st_mode", "st_ino", "st_dev", "st_nlink", "st_size",
+                                   "st_atime_ns", "st_mtime_ns", "st_ctime_ns"])
+
+
+class Mem_node:
+    """
+    Summary:
+        File, symlink or dir of a Memory_filesystem.
+
+    Properties:
+        self.mode {int} = st_mode (type and permissions)
+        self.ino {int} = Inode number, unique within the filesystem
+        self.size {int} = Size in bytes (0 for dirs)
+        self.mtime_ns, self.ctime_ns {int} = Times in ns
+        self.children {dictionary} = Name as key and Mem_node as value. None
+            unless dir
+    """
+
+    __slots__ = ["mode", "ino", "size", "mtime_ns", "ctime_ns", "children"]
+
+    def __init__(self, mode, ino, size=0, mtime_ns=None):
+        self.mode = mode
+        self.ino = ino
+        self.size = size
+        self.mtime_ns = time_ns() if mtime_ns is None else mtime_ns
+        self.ctime_ns = time_ns()
+        self.children = {} if stat.S_ISDIR(mode) else None
+
+    def __repr__(self):
+        return f"Mem_node({stat.filemode(self.mode)}, ino: {self.ino}, size: {self.size})"
+
+    def touch_dir(self):
+        # Adding or removing an entry updates mtime and ctime like on disk
+        self.mtime_ns = self.ctime_ns = time_ns()
+
+
+class Memory_filesystem:
+    """
+    Summary:
+        Tree kept in memory with optional latency per operation (see module
+        docstring). Paths are absolute like on disk, dir_fd's are the Mem_node
+        of the dir. Symlinks are never followed. Thread safe.
+
+    Properties:
+        self.latency {dictionary} = Operation (method name) as key and seconds
+            each call sleeps as value. Key "default" applies to operations
+            without a value of their own
+        self.queue_depth {int} = Max number of operations running at the same
+            time, None if unlimited
+        self.dev {int} = st_dev of all nodes
+        self.calls {dictionary} = Operation as key and number of calls as value
+    """
+
+    def __init__(self, latency=None, queue_depth=None, dev=1):
+        self.latency = dict(latency) if latency else {}
+        self.queue_depth = queue_depth
+        self.dev = dev
+        self.calls = {}
+        self.__lock = threading.Lock()
+        self.__slots = threading.BoundedSemaphore(queue_depth) if queue_depth else None
+        self.__inodes = count(1)
+        self.__root = Mem_node(stat.S_IFDIR | 0o755, next(self.__inodes))
+
+    def __repr__(self):
+        return f"Memory_filesystem(latency: {self.latency}, queue_depth: {self.queue_depth})"
+
+    # Building trees (not timed, no latency)
+
+    def makedirs(self, path, exist_ok=True):
+        with self.__lock:
+            node = self.__root
+            for name in self.__split(path):
+                child = node.children.get(name)
+                if child is None:
+                    child = Mem_node(stat.S_IFDIR | 0o755, next(self.__inodes))
+                    node.children[name] = child
+                    node.touch_dir()
+                elif not stat.S_ISDIR(child.mode):
+                    raise NotADirectoryError(errno.ENOTDIR, os.strerror(errno.ENOTDIR), path)
+                elif not exist_ok:
+                    raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), path)
+                node = child
+
+    def add_file(self, path, size=0, mtime_ns=None, mode=stat.S_IFREG | 0o644):
+        """Adds (or replaces) file at path. Missing parent dirs are created."""
+        parent, name = os.path.split(path)
+        self.makedirs(parent)
+        with self.__lock:
+            dir_node = self.__lookup(parent)
+            old = dir_node.children.get(name)
+            if old is not None and old.children is not None:
+                raise IsADirectoryError(errno.EISDIR, os.strerror(errno.EISDIR), path)
+            dir_node.children[name] = Mem_node(mode, next(self.__inodes), size, mtime_ns)
+            dir_node.touch_dir()
+
+    def add_symlink(self, path, link_target, mtime_ns=None):
+        self.add_file(path, len(os.fsencode(link_target)), mtime_ns, stat.S_IFLNK | 0o777)
+
+    # Operations used by the scanner, Syncer and deletion engine
+
+    def scan_dir(self, abs_dir):
+        """Same as scan_dir but entries has the Mem_node of each file."""
+        self.__io("scan_dir")
+        with self.__lock:
+            try:
+                node = self.__lookup(abs_dir)
+            except OSError as error:
+                LOGGER.debug(f"Couldn't list {abs_dir}: {error}")
+                return None
+            if node.children is None:
+                return None
+            files, dirs, entries = [], [], {}
+            for name, child in node.children.items():
+                if child.children is None:
+                    files.append(name)
+                    entries[name] = child
+                else:
+                    dirs.append(name)
+        return files, dirs, entries
+
+    def lstat_files(self, abs_dir, names, entries=None):
+        stats = {}
+        if entries is None:
+            with self.__lock:
+                try:
+                    entries = self.__lookup(abs_dir).children or {}
+                except OSError:
+                    entries = {}
+        # Each file costs one lstat on disk, listed or not
+        self.__io("lstat", len(names))
+        dev = self.dev
+        for name in names:
+            node = entries.get(name)
+            if node is not None:
+                stats[name] = Mem_stat(node.mode, node.ino, dev, 1, node.size,
+                                       node.mtime_ns, node.mtime_ns, node.ctime_ns)
+        return stats
+
+    def lstat(self, path):
+        self.__io("lstat")
+        with self.__lock:
+            return self.__stat(self.__lookup(path))
+
+    def lexists(self, path):
+        try:
+            self.lstat(path)
+        except OSError:
+            return False
+        return True
+
+    def set_mtime(self, path, mtime_ns):
+        self.__io("set_mtime")
+        with self.__lock:
+            node = self.__lookup(path)
+            node.mtime_ns = mtime_ns
+            node.ctime_ns = time_ns()
+
+    def open_dir(self, path, dir_fd=None):
+        self.__io("open_dir")
+        with self.__lock:
+            node = self.__lookup(path, dir_fd)
+        if stat.S_ISLNK(node.mode):
+            raise OSError(errno.ELOOP, os.strerror(errno.ELOOP), path)
+        if node.children is None:
+            raise NotADirectoryError(errno.ENOTDIR, os.strerror(errno.ENOTDIR), path)
+        return node
+
+    def close_dir(self, dir_fd):
+        pass
+
+    def unlink(self, name, dir_fd=None):
+        self.__io("unlink")
+        with self.__lock:
+            parent, node, name = self.__lookup_entry(name, dir_fd)
+            if node.children is not None:
+                raise IsADirectoryError(errno.EISDIR, os.strerror(errno.EISDIR), name)
+            del parent.children[name]
+            parent.touch_dir()
+
+    def rmdir(self, name, dir_fd=None):
+        self.__io("rmdir")
+        with self.__lock:
+            parent, node, name = self.__lookup_entry(name, dir_fd)
+            if node.children is None:
+                raise NotADirectoryError(errno.ENOTDIR, os.strerror(errno.ENOTDIR), name)
+            if node.children:
+                raise OSError(errno.ENOTEMPTY, os.strerror(errno.ENOTEMPTY), name)
+            del parent.children[name]
+            parent.touch_dir()
+
+    def __io(self, operation, calls=1):
+        # Counts calls and waits for their latency, calls in a row hold one
+        # slot of the queue
+        if not calls:
+            return
+        with self.__lock:
+            self.calls[operation] = self.calls.get(operation, 0) + calls
+        latency = self.latency.get(operation, self.latency.get("default", 0)) * calls
+        if not latency:
+            return
+        if self.__slots is None:
+            sleep(latency)
+            return
+        with self.__slots:
+            sleep(latency)
+
+    def __split(self, path):
+        return [name for name in os.path.normpath(path).split(os.sep) if name]
+
+    def __lookup(self, path, dir_fd=None):
+        # Caller holds self.__lock. Relative paths start at dir_fd.
+        node = dir_fd if dir_fd is not None and not os.path.isabs(path) else self.__root
+        for name in self.__split(path):
+            if node.children is None:
+                raise NotADirectoryError(errno.ENOTDIR, os.strerror(errno.ENOTDIR), path)
+            node = node.children.get(name)
+            if node is None:
+                raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+        return node
+
+    def __lookup_entry(self, path, dir_fd=None):
+        # Caller holds self.__lock. Returns (parent node, node, name).
+        parent_path, name = os.path.split(path)
+        if parent_path:
+            parent = self.__lookup(parent_path, dir_fd)
+        else:
+            parent = dir_fd if dir_fd is not None else self.__root
+        if parent.children is None:
+            raise NotADirectoryError(errno.ENOTDIR, os.strerror(errno.ENOTDIR), path)
+        node = parent.children.get(name)
+        if node is None:
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+        return parent, node, name
+
+    def __stat(self, node):
+        nlink = 2 if node.children is not None else 1
+        return Mem_stat(node.mode, node.ino, self.dev, nlink, node.size,
+                        node.mtime_ns, node.mtime_ns, node.ctime_ns)
@@ -5,11 +5,17 @@ import logging
 import sys
 import sync_functions
 import db_helpers
-
-# TODO Make it so folder sync can be run with and without arguments.
-# If run with arguments use get_arguments func as per below. Check if folder pair
-# exist in db. Otherwise offer to add it. If folder sync is run without arguments
-# user should be presented with a cli menu of which folder pairs currently exists
+import watcher
+import scheduler
+from profiler import Profiler
+from scanner import DEFAULT_SCAN_WORKERS
+from rsync_runner import DEFAULT_RSYNC_WORKERS
+from transfer import BACKENDS, DEFAULT_BACKEND
+
+# If run with source and target, check if folder pair exist in db. Otherwise
+# offer to add it. If run without source and target (or without arguments) all
+# registered folder pairs (or the ones given with --pairs) are synced in batch
+# mode (see scheduler.py).
 
 # TODO change debug level when not in development
 logging.basicConfig(stream=sys.stdout, level=logging.DEBUG, format="\nLogger %(name)s - %(levelname)s:\n%(message)s")
@@ -21,71 +27,86 @@ def main():
 
         if len(sys.argv) > 1:
             # Getting, controlling and adjusting arguments!
-            source, target, delete, dry_run, verbose, interactive = get_arguments()
+            (source, target, delete, dry_run, verbose, interactive,
+             scan_workers, rsync_workers, stream_output, backend, verify_content, watch,
+             metrics_dir, pair_ids, batch_workers, per_device, delta_min_size, pipeline,
+             profile) = get_arguments()
+            if source is None and target is None:
+                if watch:
+                    print("Watch mode needs source and target!")
+                    sys.exit(4)
+                if profile:
+                    print("Profiling needs source and target of a single folder pair!")
+                    sys.exit(4)
+                failed = scheduler.batch_sync(cur, pair_ids, batch_workers, per_device, delete,
+                                              dry_run, verbose, scan_workers, rsync_workers,
+                                              stream_output, backend, verify_content, metrics_dir,
+                                              delta_min_size, pipeline)
+                sys.exit(1 if failed else 0)
             check_arguments(source, target)
             source = db_helpers.adjust_dirname(source)
             target = db_helpers.adjust_dirname(target)
             pair_id = db_helpers.get_folder_pair_id(cur, source, target)
             #if True:
-            if pair_id:
-                sync_functions.two_way_sync(pair_id, source, target, delete, 
-                                            dry_run, verbose, interactive)
+            if profile and (watch or not pair_id):
+                print("Profiling is only possible when syncing an existing folder pair once (not in watch mode)!")
+                sys.exit(4)
+            if pair_id and watch:
+                if dry_run:
+                    print("Dry run not possible in watch mode!")
+                    sys.exit(4)
+                watcher.watch_pair(cur, pair_id, source, target, delete, verbose, interactive,
+                                   scan_workers, rsync_workers, backend, metrics_dir, delta_min_size)
+            elif pair_id:
+                if pipeline and (interactive or dry_run):
+                    print("Pipelined sync needs '-i false' and can't be a dry run!")
+                    sys.exit(4)
+                # Reports are written even if the sync fails or exits (see profiler.py)
+                profiler = Profiler(pair_id) if profile else None
+                if profiler:
+                    profiler.start()
+                try:
+                    sync_functions.two_way_sync(cur, pair_id, source, target, delete, 
+                                                dry_run, verbose, interactive, scan_workers,
+                                                rsync_workers, stream_output, backend, verify_content,
+                                                metrics_dir, delta_min_size, pipeline, profiler)
+                finally:
+                    if profiler:
+                        profiler.stop()
             else:
                 if dry_run:
                     print("Dry run not possible when syncing folder pair for the first time. Even without the '-n' flag dryrun will run once (you can abort) when setting up!")
                     sys.exit(4)
-                setup_new_folder_pair(cur, source, target)
+                setup_new_folder_pair(cur, source, target, stream_output, scan_workers,
+                                      rsync_workers, backend, delta_min_size)
         else:
-            # TODO Add cli interface
-            pass
+            failed = scheduler.batch_sync(cur)
+            sys.exit(1 if failed else 0)
     finally:
         con.close()
 
 
-def setup_new_folder_pair(cur, source, target):
+def setup_new_folder_pair(cur, source, target, stream_output=False, scan_workers=DEFAULT_SCAN_WORKERS,
+                          rsync_workers=DEFAULT_RSYNC_WORKERS, backend=DEFAULT_BACKEND, delta_min_size=0):
 
     user_input = ""
     while not user_input in {"y", "yes", "n", "no"}:
-        print(f"\nFOLDER PAIR DOESN'T EXIST.\nTo create it you will need to perform an initial rsync\n\nfrom source: {source}\nto target: {target}")
-        print(f"\nrsync is NOT a two way sync so target will be a perfect copy of source when finished!")
+        print(f"\nFOLDER PAIR DOESN'T EXIST.\nTo create it you will need to perform an initial one way sync\n\nfrom source: {source}\nto target: {target}")
+        print(f"\nThe initial sync is NOT a two way sync so target will be a perfect copy of source when finished!")
         user_input = normalize_input(input(f"\nDo you want to continue? (y/yes, n/no)\n--> "))
     
     if user_input == "n" or user_input == "no":
         print("Exiting program...")
         sys.exit(3)
     
-    print("\nPerforming rsync dryrun!\n")
-    # Since user_interaction in below call is true. Rsync will be called twice
-    # with first run being dryrun. User gets chance to bail out.
-    return_value = sync_functions.rsync(source, target, True, False, True, True)
-    if not return_value == 0: # 0 = correct execution.
-        if return_value == 49: # 49 = User aborted interactively!
-            sys.exit(1)
-        elif return_value == 50: # 50 = Folders already synced!
-            # Do nothing. Allow program to continue exection below.
-            pass
-        else:
-            print("\nSomething went wrong with rsync. Exiting program!")
-            sys.exit(1)
-
-    # If program hasn't exited due to error below code runs!
-    cur.execute("BEGIN")
-    pair_id = db_helpers.add_folder_pair(cur, source, target)
-    if not pair_id:
-        cur.execute("ROLLBACK")
-        print("Failed to add folder pair. Exiting!")
+    print("\nScanning source and target!\n")
+    # Source and target are scanned once and the plan is shown as a trial run
+    # first. User gets chance to bail out (see bootstrap_pair).
+    pair_id = sync_functions.bootstrap_pair(cur, source, target, True, scan_workers, rsync_workers,
+                                            stream_output, backend, delta_min_size)
+    if not pair_id: # 0 = aborted by user or folder pair couldn't be saved
         sys.exit(1)
-    else:
-        items = sync_functions.get_existing_items(source, target)
-        if items == "error":
-            cur.execute("ROLLBACK")
-            print(f"Initial sync failed. Required file permissions? Cant save folder state.")
-        if db_helpers.save_folder_state(source, target, items, pair_id) == 0:
-            cur.execute("COMMIT")
-            print("Succesfully added folder pair for future syncing!")
-        else:
-            cur.execute("ROLLBACK")
-            print(f"Couldn't save folder state. Folder pair will have to be reinitialized before next sync!")
+    print("Succesfully added folder pair for future syncing!")
 
 
 def normalize_input(user_input):
@@ -94,6 +115,9 @@ def normalize_input(user_input):
 
 
 def check_arguments(source, target):
+    if source is None or target is None:
+        print(f"Both source and target are needed (or neither to sync all folder pairs)!")
+        sys.exit(2)
     if source == target:
         print(f"Source cannot equal target!")
         sys.exit(2)
@@ -104,20 +128,51 @@ def check_arguments(source, target):
 
 def get_arguments():
     parser = argparse.ArgumentParser()
-    parser.add_argument("-s", "--source", dest="source_dir", help="source directory", required=True)
-    parser.add_argument("-t", "--target", dest="target_dir", help="target directory", required=True)
+    parser.add_argument("-s", "--source", dest="source_dir", help="source directory (leave out source and target to sync all folder pairs)", required=False)
+    parser.add_argument("-t", "--target", dest="target_dir", help="target directory", required=False)
     parser.add_argument("-d", "--delete", dest="delete", default="False", help="set to true to enable deletions", required=False)
     parser.add_argument("-n", "--dry-run", dest="dry_run", default="False", help="set to true to do dryrun", required=False)
     parser.add_argument("-v", "--verbose", dest="verbose", default="True", help="set to false to sync without output", required=False)
     parser.add_argument("-i", "--interactive", dest="interactive", default="True", help="True --> syncs twice (first time = dryrun). Can abort after dryrun", required=False)
+    parser.add_argument("-w", "--scan-workers", dest="scan_workers", default=DEFAULT_SCAN_WORKERS, type=int, help="number of threads scanning source and target", required=False)
+    parser.add_argument("-r", "--rsync-workers", dest="rsync_workers", default=DEFAULT_RSYNC_WORKERS, type=int, help="max number of concurrent rsync processes (copy threads with native backend)", required=False)
+    parser.add_argument("-o", "--stream-output", dest="stream_output", default="False", help="True --> rsync output is printed unsorted while syncing", required=False)
+    parser.add_argument("-b", "--backend", dest="backend", default=DEFAULT_BACKEND, choices=BACKENDS, help="native --> copy in process instead of with rsync (local folders only)", required=False)
+    parser.add_argument("-c", "--verify-content", dest="verify_content", default="False", help="True --> files differing only in mtime are compared by content. Identical files only get mtime updated", required=False)
+    parser.add_argument("-W", "--watch", dest="watch", default="False", help="True --> keep running and sync changes as they happen (inotify, linux only)", required=False)
+    parser.add_argument("-m", "--metrics-dir", dest="metrics_dir", default=None, help="dir to write prometheus textfile with metrics of each run to (ie node_exporter textfile dir)", required=False)
+    parser.add_argument("-p", "--pairs", dest="pairs", default=None, help="comma separated ids of folder pairs to sync in batch mode (default all)", required=False)
+    parser.add_argument("-j", "--jobs", dest="jobs", default=scheduler.DEFAULT_BATCH_WORKERS, type=int, help="max number of folder pairs synced concurrently in batch mode", required=False)
+    parser.add_argument("-D", "--pairs-per-device", dest="per_device", default=scheduler.DEFAULT_PAIRS_PER_DEVICE, type=int, help="max number of folder pairs using the same disk concurrently in batch mode", required=False)
+    parser.add_argument("-x", "--delta-min-size", dest="delta_min_size", default=0, type=int, help="native backend: files of at least this many MB existing on both sides are updated block by block (0 = off)", required=False)
+    parser.add_argument("-P", "--pipeline", dest="pipeline", default="False", help="True --> start transferring while scanning (not interactive)", required=False)
+    parser.add_argument("-f", "--profile", dest="profile", default="False", help="True --> write cpu profile, memory per phase and slowest dirs to .folder_sync_config/profiles", required=False)
     options = parser.parse_args()
+    if options.delta_min_size > 0 and options.backend != "native":
+        parser.error("--delta-min-size needs --backend native")
+    if options.pairs is not None and (options.source_dir or options.target_dir):
+        parser.error("--pairs can't be combined with source and target")
+    try:
+        pair_ids = None if options.pairs is None else [int(pair_id) for pair_id in options.pairs.split(",") if pair_id.strip()]
+    except ValueError:
+        parser.error("--pairs takes comma separated folder pair ids (ie 1,3,4)")
     source_dir = options.source_dir
     target_dir = options.target_dir
     deletions_enabled = True if (options.delete.lower() == "true") else False
     dry_run = False if (options.dry_run.lower() == "false") else True
     verbose = False if (options.verbose.lower() == "false") else True
     interactive = False if (options.interactive.lower() == "false") else True
-    return source_dir, target_dir, deletions_enabled, dry_run, verbose, interactive
+    scan_workers = max(1, options.scan_workers)
+    rsync_workers = max(1, options.rsync_workers)
+    stream_output = True if (options.stream_output.lower() == "true") else False
+    verify_content = True if (options.verify_content.lower() == "true") else False
+    watch = True if (options.watch.lower() == "true") else False
+    pipeline = True if (options.pipeline.lower() == "true") else False
+    profile = True if (options.profile.lower() == "true") else False
+    return (source_dir, target_dir, deletions_enabled, dry_run, verbose, interactive,
+            scan_workers, rsync_workers, stream_output, options.backend, verify_content, watch,
+            options.metrics_dir, pair_ids, max(1, options.jobs), max(1, options.per_device),
+            max(0, options.delta_min_size) * 1024 * 1024, pipeline, profile)
 
 
 if __name__ == "__main__":
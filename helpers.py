@@ -1,487 +1,650 @@
 """This module contains classes and function format_rsync_output"""
 import os
 import sys
+import stat
 from time import time
 import pathlib
 import subprocess
 import logging
 import json
+import hashlib
+import re
 from shutil import rmtree
-from db_helpers import get_json_path
+from concurrent.futures import ThreadPoolExecutor
+import rsync_runner
+from transfer import Native_transfer, DEFAULT_BACKEND
+from metrics import Metrics_registry
+from tree_index import Pair_state
+from deletion import Bulk_deleter, DEFAULT_DELETE_WORKERS
+from filesystem import LOCAL_FILESYSTEM
+import vector_diff
+from vector_diff import DEFAULT_DIFF_ENGINE
 
 LOGGER = logging.getLogger(__name__)
 SCRIPT_PATH = pathlib.Path(__file__).parent.absolute()
 
+RSYNC_FILE_TYPES = {
+    "f": "file: ", 
+    "d": "directory: ", 
+    "L": "symlink: ",
+    "D": "DEVICE: ",
+    "S": "SPECIAL FILE: "}
+
+
+def format_itemized(item):
+    """Formats an Itemized record (see parse_itemize_line in rsync_runner) for display.
+
+    Returns:
+        {tuple}: (category, formatted_line) where category is "message",
+        "created" or "modified". None for unchanged items (skipped).
+    """
+    if item.category == "unchanged":
+        return None
+    if item.category == "message":
+        return ("message", item.line)
+
+    new_prefix = "Created " if item.category == "created" else "Updated "
+    filetype = RSYNC_FILE_TYPES.get(item.file_type, "")
+    lacking_whitespace = 30 - (len(new_prefix) + len(filetype))
+    if lacking_whitespace > 0:
+        spaces = ' ' * lacking_whitespace
+    else:
+        spaces = ""
+    return (item.category, new_prefix + filetype + spaces + item.name)
+
+
+def format_rsync_line(line):
+    """Formats a single line of rsync --itemize-changes output (see format_itemized)."""
+    return format_itemized(rsync_runner.parse_itemize_line(line))
+
+
+def format_itemized_output(items):
+    """Formats Itemized records grouped by category (messages, created,
+    modified). Within a group lines are in the order rsync reported them, they
+    aren't sorted."""
+    lists = {"message": [], "created": [], "modified": []}
+    for item in items:
+        formatted = format_itemized(item)
+        if formatted:
+            lists[formatted[0]].append(formatted[1])
+    return_list = lists["message"] + [""] + lists["created"] + [""] + lists["modified"]
+    return (os.linesep).join(return_list)
+
+
 def format_rsync_output(st_ouput):
     # This formating function will only work reliable if not using -v or -P for rsync call.
     # You also have to use --itemize-changes flag.
-    output_list = st_ouput.split(os.linesep)
-    if output_list[-1] == "":
-        output_list.pop()
-
-    msg_list, created, modified = [], [], []
-    file_types = {
-        "f": "file: ", 
-        "d": "directory: ", 
-        "L": "symlink: ",
-        "D": "DEVICE: ",
-        "S": "SPECIAL FILE: "}
-    
-    for line in output_list:
-        words = line.split()
-
-        len_words = len(words)
-        if len_words == 2:
-            prefix, file = words[0], words[1]
-        elif len_words > 2:
-            # Below join is needed for filenames with whitespace in them
-            prefix, file = words[0], " ".join(words[1:])
-        else:
-            # This shouldnt happen!
-            msg_list.append(line)
-            continue
+    return format_itemized_output(rsync_runner.parse_itemize_line(line)
+                                  for line in st_ouput.splitlines())
 
-        change = prefix[0]
-        if change == "*": # Message (often deletion)
-            msg_list.append(line)
-            continue
-        elif change == "<" or change == ">":
-            if prefix[2:] == "+++++++++":
-                new_prefix = "Created "
-                choosen_list = created
-            else:
-                new_prefix = "Updated "
-                choosen_list = modified
-        elif change == "c":
-            new_prefix = "Created "
-            choosen_list = created
-        elif change == ".":
-            # File not updated. Skip.
-            continue
-        else:
-            # Cannot cleanup.
-            msg_list.append(line)
-            continue
-        
-        filetype = ""
-        type_of_file = prefix[1]
-        if type_of_file in file_types:
-            filetype = file_types[type_of_file]
-
-        lacking_whitespace = 30 - (len(new_prefix) + len(filetype))
-        if lacking_whitespace > 0:
-            spaces = ' ' * lacking_whitespace
-        else:
-            spaces = ""
-        choosen_list.append((new_prefix + filetype + spaces + file))
 
-    msg_list.sort()
-    created.sort()
-    modified.sort()
-    return_list = msg_list + [""] + created + [""] + modified
-    return (os.linesep).join(return_list)
+def format_size(size):
+    """Returns size in bytes as human readable string, ie "1.5 MB". Negative
+    sizes (differences) keep their sign."""
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(size) < 1024:
+            return f"{size} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+
+def join_rel_path(dir, name):
+    """Joins relative dir (as used in file_dicts, "." is top dir) and name the
+    same way as str(pathlib.Path(dir) / name) but without creating a Path."""
+    if dir == ".":
+        return name
+    return dir + os.path.sep + name
+
+
+def split_rel_path(rel_path):
+    """Reverse of join_rel_path. Returns (dir, name)."""
+    dir, name = os.path.split(rel_path)
+    return (dir if dir else "."), name
 
 
 class Excluder:
+    """
+    Summary:
+        Compiled exclude list of one side of a folder pair. Every line in the
+        exclude file is a path (relative to top_dir or absolute) or a glob
+        pattern (same syntax as pathlib glob, ie "**/*.tmp"). All lines are
+        compiled into one regular expression matched against relative paths
+        while the tree is scanned (see Tree_scanner in scanner.py). Excluded
+        dirs are never descended into. Nothing is stored per matching path, so
+        memory use doesn't depend on how many items are excluded.
+
+        The compiled expression is cached in folder_pair_<id>.cache.json next
+        to the exclude file, keyed by a fingerprint of the exclude file.
+
+    Properties:
+        self.top_dir {PosixPath} = Absolute path to top directory
+        self.pattern {string} = Source of compiled regular expression ("" if
+            nothing is excluded)
+    """
+    # Bump when compile_exclude_list changes so cached patterns are rebuilt
+    COMPILER_VERSION = 2
+
     @classmethod
     def create_excluder(cls, top_dir, pair_id):
         dir_path = SCRIPT_PATH / ".folder_sync_config" / "folder_pair_excludes"
         file_path = dir_path / ("folder_pair_" + str(pair_id) + ".txt")
+        cache_path = dir_path / ("folder_pair_" + str(pair_id) + ".cache.json")
 
-        excl_list = []
         try:
-            with file_path.open('r') as excl_file:
-                excl_list = [line.strip() for line in excl_file.readlines()]
-            excl_list = list(filter(lambda row: bool(row), excl_list))
-        except:
+            content = file_path.read_bytes()
+        except OSError:
             return None
 
-        if excl_list:
-            return cls(top_dir, excl_list)
+        top_dir = str(pathlib.Path(top_dir).absolute())
+        fingerprint = f"{cls.COMPILER_VERSION}:{hashlib.sha256(content).hexdigest()}"
+        try:
+            with cache_path.open("r") as cache_file:
+                cache = json.load(cache_file)
+            if cache.get("fingerprint") != fingerprint:
+                cache = {"fingerprint": fingerprint, "patterns": {}}
+        except (OSError, ValueError):
+            cache = {"fingerprint": fingerprint, "patterns": {}}
+
+        pattern = cache["patterns"].get(top_dir)
+        if pattern is None:
+            excl_list = [line.strip() for line in content.decode(errors="surrogateescape").splitlines()]
+            pattern = compile_exclude_list(top_dir, [line for line in excl_list if line])
+            cache["patterns"][top_dir] = pattern
+            try:
+                tmp_path = cache_path.with_name(cache_path.name + ".tmp")
+                with tmp_path.open("w") as cache_file:
+                    json.dump(cache, cache_file)
+                os.replace(tmp_path, cache_path)
+            except OSError as error:
+                LOGGER.debug(f"Couldn't save compiled excludes: {error}")
+
+        if pattern:
+            return cls(top_dir, pattern=pattern)
         return None
 
-    def __init__(self, top_dir, exclude_list):
-        # TODO maybe reade excludes from file instead of list.
+    def __init__(self, top_dir, exclude_list=(), pattern=None):
         self.top_dir = pathlib.Path(top_dir).absolute()
-        self.dirs = set()
-        self.excl_dict = {}
+        if pattern is None:
+            pattern = compile_exclude_list(self.top_dir, exclude_list)
+        self.pattern = pattern
+        self.__match = re.compile(pattern).fullmatch if pattern else None
 
-        for item in exclude_list:
-                path = pathlib.Path(item)
-                if self.__add_item(path):
-                    continue
-                    
-                self.__glob_item(item)
-        
     def __bool__(self):
-        return bool(self.dirs) or bool(self.excl_dict) 
+        return bool(self.pattern)
 
-    def __glob_item(self, item):
-        try:
-            for path in self.top_dir.glob(item):
-                self.__add_item(path)
-        except Exception as error:
-            LOGGER.error(error)
+    def __repr__(self):
+        return f"Excluder({self.top_dir}, pattern: {self.pattern!r})"
 
-    def __add_item(self, path):
-        """
-        Args: 
-        item {string}: Possibly path to item.
-        
-        Return {boolean}: True if matching item (link, file, dir) otherwise False
-        """
-        try:
-            if not path.is_absolute():
-                # pathlib allows joining of path with / operator
-                path = self.top_dir / path
-
-            if path.is_file() or path.is_symlink():
-                dir_path = str(path.parent.relative_to(self.top_dir))
-                if dir_path == ".":
-                    dir_path = ""
-                    
-                file_name = path.name
-                if not dir_path in self.excl_dict:
-                    self.excl_dict[dir_path] = set()
-                self.excl_dict[dir_path].add(file_name)
-
-            elif path.is_dir():
-                self.dirs.add(str(path.relative_to(self.top_dir)))
+    def excludes(self, rel_path):
+        """rel_path {string}: Path of file or dir relative to top_dir."""
+        return bool(self.__match and self.__match(rel_path))
 
+    def get_non_excl_file_set(self, base_dir, file_list):
+        if not self.__match:
+            return set(file_list)
+        match = self.__match
+        prefix = "" if base_dir == "." else base_dir + os.path.sep
+        return {name for name in file_list if not match(prefix + name)}
+
+
+def glob_to_regex(pattern):
+    """Translates glob pattern (relative, "/" separated) to a regular
+    expression matching relative paths the way pathlib glob would. "**" matches
+    any number of dirs (also none), "*" and "?" never match "/"."""
+    parts = [part for part in pattern.split("/") if part and part != "."]
+    regex = []
+    for index, part in enumerate(parts):
+        last = index == len(parts) - 1
+        if part == "**" and last:
+            # Like pathlib, trailing "**" matches the dir itself (and everything below)
+            if regex:
+                regex[-1] = regex[-1][:-1] + "(?:/.*)?"
             else:
-                return False
+                regex.append(".*")
+            continue
+        if part == "**":
+            regex.append("(?:[^/]*/)*")
+            continue
 
-            return True
+        index_char, part_regex = 0, ""
+        while index_char < len(part):
+            char = part[index_char]
+            index_char += 1
+            if char == "*":
+                part_regex += "[^/]*"
+            elif char == "?":
+                part_regex += "[^/]"
+            elif char == "[":
+                # Character class, "]" first in class is literal (like fnmatch)
+                end = index_char + 1 if part[index_char:index_char + 1] == "!" else index_char
+                end = part.find("]", end + 1)
+                if end == -1:
+                    part_regex += "\\["
+                    continue
+                # "[" is escaped, unescaped it would start a nested set in future versions of re
+                char_class = part[index_char:end].replace("\\", "\\\\").replace("[", "\\[")
+                if char_class.startswith("!"):
+                    char_class = "^" + char_class[1:]
+                elif char_class.startswith("^"):
+                    char_class = "\\" + char_class
+                part_regex += f"[{char_class}]"
+                index_char = end + 1
+            else:
+                part_regex += re.escape(char)
+        regex.append(part_regex if last else part_regex + "/")
+    return "".join(regex)
 
-        except:
-            return False
-                
-    def __repr__(self):
-        return f"\nexcl-dirs: {self.dirs}\n\nexcl_dict: {self.excl_dict}\n"
-    
-    def get_non_excl_file_set(self, base_dir, file_list):
-        if self.excl_dict.get(base_dir, None):
-            return set(file_list) - self.excl_dict.get(base_dir, set())
-        return set(file_list)
+
+def compile_exclude_list(top_dir, exclude_list):
+    """Compiles lines of an exclude file (see Excluder) into the source of one
+    regular expression. Absolute paths outside top_dir are ignored.
+
+    Returns:
+        {string}: Regular expression source. "" if nothing can be excluded.
+    """
+    top_dir = str(pathlib.Path(top_dir).absolute())
+    alternatives = []
+    for item in exclude_list:
+        if os.path.isabs(item):
+            item = os.path.relpath(item, top_dir)
+            if item == "." or item.startswith(".."):
+                continue
+        regex = glob_to_regex(item)
+        if regex:
+            alternatives.append(regex)
+    if not alternatives:
+        return ""
+    return "(?:" + "|".join(alternatives) + ")"
 
 
 class Items:
-    """[summary]
+    """
+    Summary:
+        Files and dirs of one side to add or delete. Files are kept per dir
+        (names are the same objects as in the Tree_index) and relative paths
+        are only joined when asked for.
 
-        Properties:
-        files {dictionary}: path as string is key. PosixPath is value.
-        dirs {dictionary}: path as string is key. PosixPath is value.
+    Properties:
+        self.root {string} = Absolute path of the side
+        self.files {dictionary} = Relative dir as key and list of file names as value
+        self.dirs {set} = Relative dirs
     """
-    def __init__(self, root) -> None:
-        self.files = {}
-        self.dirs = {}
+
+    def __init__(self, root):
         self.root = root
-        
-    def add_file(self, item):
-        if isinstance(item, pathlib.Path):
-            self.files[str(item)] = item
-        elif isinstance(item, str):
-            self.files[item] = pathlib.Path(item)
-        else:
-            raise NotImplementedError
+        self.files = {}
+        self.dirs = set()
+
+    def __len__(self):
+        return self.file_count() + len(self.dirs)
+
+    def __bool__(self):
+        return bool(self.files or self.dirs)
+
+    def add_file(self, dir, name):
+        self.files.setdefault(dir, []).append(name)
+
+    def add_files(self, dir, names):
+        if names:
+            self.files.setdefault(dir, []).extend(names)
+
+    def add_dir(self, dir):
+        self.dirs.add(dir)
+
+    def remove_paths(self, rel_paths):
+        # Removes relative paths of files and dirs
+        names_by_dir = {}
+        for rel_path in rel_paths:
+            if rel_path in self.dirs:
+                self.dirs.discard(rel_path)
+            else:
+                dir, name = split_rel_path(rel_path)
+                names_by_dir.setdefault(dir, set()).add(name)
+        for dir, names in names_by_dir.items():
+            kept = [name for name in self.files.get(dir, ()) if not name in names]
+            if kept:
+                self.files[dir] = kept
+            else:
+                self.files.pop(dir, None)
+
+    def iter_files(self):
+        # (dir, name) of each file
+        for dir, names in self.files.items():
+            for name in names:
+                yield dir, name
+
+    def file_count(self):
+        return sum(len(names) for names in self.files.values())
 
-    def add_dir(self, item):
-        if isinstance(item, pathlib.Path):
-            self.dirs[str(item)] = item
-        elif isinstance(item, str):
-            self.dirs[item] = pathlib.Path(item)
-        else:
-            raise NotImplementedError
-        
     def get_file_set(self):
-        return set(self.files.keys())
+        return {join_rel_path(dir, name) for dir, name in self.iter_files()}
 
     def get_dir_set(self):
-        return set(self.dirs.keys())
-    
+        return set(self.dirs)
+
     def get_item_set(self):
-        return self.dirs.keys() | self.files.keys()
-    
+        return self.get_file_set() | self.dirs
+
     def print_items(self):
-        item_set = self.get_item_set()
-        for item in item_set:
-            print(item)
-    
+        for item in sorted(self.get_item_set()):
+            print(os.path.join(self.root, item))
+
     def get_dir_list(self):
-        try:
-            dir_list = self.dir_list
-        except AttributeError:
-            self.dir_list = list(self.dirs.values())
-            self.dir_list.sort(reverse=True)
-            dir_list = self.dir_list
-
-        return dir_list
-    
+        # Deepest dirs first
+        return sorted(self.dirs, reverse=True)
+
     def __repr__(self):
         return f"Items({self.root})"
 
 
-class Dir_class:
+class Syncer:
     """
     Summary:
-        Each instance of a Dir_item represents a file or a dir.
+        Decides and performs the sync of a folder pair from the scan of both
+        sides (Tree_index of source and target, see tree_index.py) and the
+        saved state of last sync.
+
+        Dirs are walked in the order of the source index. Files of a dir are
+        sorted by name in the index, so files existing on both sides (mutual)
+        and on one side only (exclusive) are found by comparing or merging the
+        two name ranges. Nothing is copied for mutual files, they are flags in
+        self.new_state. Exclusive items are added to the other side when new
+        since last sync, and deleted otherwise (see sync_dict).
+
+        With mirror the saved state isn't used and target is made a copy of
+        source (like rsync -a --delete): differing mutual files are updated
+        from source, source only items are added and target only items are
+        deleted. Used for the initial sync of a new folder pair (see
+        bootstrap_pair in sync_functions).
 
     Properties:
-        self.name {string} = Name of dir
-        self.excl_dir {bool} = Wether dir is new or not
-
-    Methods:
-        Mostly self explanatory. 
-        __lt__ is included to add sort capability when instance is in list.
-    """
-
-    __slots__ = ["name", "excl_dir"] 
-
-    def __init__(self, name, is_excl):
-        self.name = name
-        self.excl_dir = is_excl
-    
-    def __eq__(self, obj: object) -> bool:
-        if isinstance(obj, Dir_class):
-            return self.name == obj.name
-        elif isinstance(obj, str):
-            return self.name == obj
-        else:
-            return False
-    
-    def __repr__(self):
-        if self.excl_dir:
-            return f"excl-dir: '{self.name}'"
-        else:
-            return f"mutual-dir: '{self.name}'"
-
-    
-    def __lt__(self, obj):
-        return self.name < obj.name
-    
-
-class Syncer:
-    """Input: src_dict and tar_dict which are dictionaries containing all
-    non excluded dirs (as keys) with files as values in set corresponding to parent
-    dirs.
-
-    Intermediary variables:
-        Created with set operations (intersection and subtraction) on dictionary
-        keys and the sets in each directory:
-        
-
-    Properties: Created from input variables above upon execution of __init__:
         self.source {string} : abs path to source dir
         self.target {string} : abs path to target dir
         self.id {int} : int representing the pair_id of the folders to sync.
-        self.excl_src_items {list} : Nested list [[]]
-        self.excl_tar_items {list} : Nested list [[]]
-        self.mutual_items {list} : Nested list [[]]
-    
-    These 3 properties have the same structure which is basically a nested list
-    of sync items: [[Sync_item("dir1", action), Sync_item("file1_in_dir1", action), ...],
-    [Sync_item("dir2", action), Sync_item("file2_in_dir2", action), ...]]    
-    Note that each "inner-list" represents a directory where the directory itself
-    comes first.
-   
-    Methods:
-
+        self.mirror {bool} : Target is made a copy of source
+        self.src_index {Tree_index} : Scan of source
+        self.tar_index {Tree_index} : Scan of target
+        self.sync_dict {dictionary} : Planned updates, additions and deletions
+        self.new_state {Pair_state} : State to save after sync (see get_new_state_dict)
+        self.in_sync {bool} : Nothing was planned when the plan was made
+        self.journal {Sync_journal} : Optional. Additions and deletions are
+            journaled as they succeed, so an interrupted sync can be resumed
+        self.fs {object} : Filesystem of source and target for deletions and
+            checks (see filesystem.py). Transfers always use the real disk
+        self.diff_engine {string} : "python" or "numpy" (see vector_diff.py),
+            both make the same decisions. numpy is only used by benchmark.py
     """
 
-    def __init__(self, pair_id, source, target, src_dict, tar_dict, deletions, dryrun, print_output):
+    def __init__(self, pair_id, source, target, src_index, tar_index, deletions, dryrun, print_output,
+                 saved_state, rsync_workers=rsync_runner.DEFAULT_RSYNC_WORKERS,
+                 stream_output=False, transfer_backend=DEFAULT_BACKEND, hash_cache=None, metrics=None,
+                 mirror=False, signature_cache=None, journal=None, filesystem=LOCAL_FILESYSTEM,
+                 diff_engine=DEFAULT_DIFF_ENGINE):
         self.id = pair_id
+        self.mirror = mirror
         self.source = source
         self.target = target
-        self.src_dict = src_dict
-        self.tar_dict = tar_dict
+        self.src_index = src_index
+        self.tar_index = tar_index
+        # Relative paths of items whose deletion failed
+        self.failed_deletes = set()
         self.deletions = deletions
         self.dryrun = dryrun
         self.print_output = print_output
-        self.textfiles_created = False
-        # self.state_dict = {} # Created by read_saved_state()
-        self.read_saved_state()
+        self.rsync_workers = rsync_workers
+        self.stream_output = stream_output
+        self.transfer_backend = transfer_backend
+        # Hash_cache instance (see content_hash.py) enables content verification
+        self.hash_cache = hash_cache
+        # Signature_cache instance (see delta.py) enables delta updates with native backend
+        self.signature_cache = signature_cache
+        # Metrics_registry (see metrics.py) that counts deletions, transfers and errors
+        self.metrics = metrics if metrics is not None else Metrics_registry()
+        # Saved_state instance (see db_helpers) or dictionary with sets as values
+        self.state_dict = saved_state
+        # Sync_journal (see journal.py) that gets state changes as they happen
+        self.journal = journal
+        self.fs = filesystem
+        if diff_engine == "numpy" and not vector_diff.numpy_available():
+            LOGGER.warning("numpy isn't installed, the python diff engine is used instead")
+            diff_engine = "python"
+        self.diff_engine = diff_engine
         self.sync_dict = {
             # Contains strings representing paths (rel to source/tar)
             "upd_lr": set(),
             "upd_rl": set(),
+            # Identical content, only mtime is copied (content verification)
+            "touch_lr": set(),
+            "touch_rl": set(),
             "add_to_src": Items(self.source),
             "add_to_tar": Items(self.target),
-
-            # src_deletes and tar_deletes contain path objects and are therefore lists
             "src_deletes": Items(self.source),
             "tar_deletes": Items(self.target),
         }
+        # Mutual items and items to be deleted (removed upon deletion). Items
+        # added during sync are added after succesful syncing.
+        self.new_state = Pair_state(src_index)
 
-        self.excl_src_items = []
-        self.excl_tar_items = []
-        self.mutual_items = []
-
-        self.create_sync_lists()
         self.decide_sync_actions()
-        self.create_new_state_dict()
-
-    def create_sync_lists(self):
-        def get_dir_list(dir, file_set, new_dir):
-            dir_as_list = [Dir_class(dir, new_dir)]
-            files_in_dir = []
-            for file in file_set:
-                files_in_dir.append(file)
 
-            files_in_dir.sort()
-            return (dir_as_list + files_in_dir)
+        sync_dict = self.sync_dict
+        # Nothing planned, both sides match the saved state (see dir_digest.py)
+        self.in_sync = not any(sync_dict.values())
+        self.metrics.add("planned_updates", len(sync_dict["upd_lr"]) + len(sync_dict["upd_rl"]))
+        self.metrics.add("planned_touches", len(sync_dict["touch_lr"]) + len(sync_dict["touch_rl"]))
+        self.metrics.add("planned_additions", len(sync_dict["add_to_tar"]) + len(sync_dict["add_to_src"]))
+        self.metrics.add("planned_deletions", len(sync_dict["src_deletes"]) + len(sync_dict["tar_deletes"]))
 
-        mutual_dirs = self.src_dict.keys() & self.tar_dict.keys()
-        src_dirs = self.src_dict.keys() - mutual_dirs
-        tar_dirs = self.tar_dict.keys() - mutual_dirs
-        
-        # Add src_dirs and corresponding files in scr_dict to self.excl_src_items
-        for dir in src_dirs:
-            dir_content = get_dir_list(dir, self.src_dict[dir], True)
-            self.excl_src_items.append(dir_content)
-
-        # Add tar_dirs and corresponding files in tar_dict to self.excl_tar_items
-        for dir in tar_dirs:
-            dir_content = get_dir_list(dir, self.tar_dict[dir], True)
-            self.excl_tar_items.append(dir_content)
-        
-        # Add all dirs in mutual_dirs, including mutual files, to self.mutual_items.
-        # If there are files in mutual dirs on only one side then
-        # add dir with files to the corresponding side
-
-        for dir in mutual_dirs:
-            mutual_files = self.src_dict[dir] & self.tar_dict[dir]
-            src_files = self.src_dict[dir] - mutual_files
-            tar_files = self.tar_dict[dir] - mutual_files
-            self.mutual_items.append(get_dir_list(dir, mutual_files, False))
-
-            if src_files: # Files existing only on source side!
-                self.excl_src_items.append(get_dir_list(dir, src_files, False))
-            if tar_files: # Files existing only on source side!
-                self.excl_tar_items.append(get_dir_list(dir, tar_files, False))
-        
-        return
-    
-    def read_saved_state(self):
-        json_filepath = get_json_path(self.id)
-        try:
-            with json_filepath.open("r") as json_file:
-                state_dict = json.load(json_file)
-            self.state_dict = state_dict["items"]
-        except Exception as error:
-            LOGGER.critical("Couldn't read previous sync state")
-            LOGGER.critical(error)
-            print("\n")
-            sys.exit(1)
-        
-        return True
-    
     def decide_sync_actions(self):
-        def decide_action_for_excl_items(items, add_obj, del_obj):
-            for dir_content in items:
-                dir = dir_content[0]
-                dir_rel_path = pathlib.Path(dir.name)
-                if dir.excl_dir:
-                    # Entire folder exists exclusively on one side
-                    if str(dir_rel_path) in saved_dirs: # Previously existed on both sides
-                        for item in dir_content[1:]:
-                            path_obj = dir_rel_path / item
-                            del_obj.add_file(path_obj)
-                        del_obj.add_dir(dir_rel_path)
-                    else: # Added since last sync
-                        for item in dir_content[1:]:
-                            path_obj = dir_rel_path / item
-                            add_obj.add_file(path_obj)
-                        add_obj.add_dir(dir_rel_path)
-                else:
-                    # Files exists exclusively but dir exists on both sides
-                    saved_files = set(self.state_dict.get(str(dir_rel_path), set()))
-                    for item in dir_content[1:]:
-                        file_path = dir_rel_path / item
-                        if item in saved_files: # Previously existed on both sides
-                            del_obj.add_file(file_path)
-                        else: # Added since last sync
-                            add_obj.add_file(file_path)
-                            
-        # Goes through mutual items see if they differ(modification time)
-        for dir_content in self.mutual_items:
-            dir_rel_path = dir_content[0].name
-            for file in dir_content[1:]:
-                file_rel_path = pathlib.Path(dir_rel_path) / file
-                file_src = pathlib.Path(self.source) / file_rel_path
-                file_tar = pathlib.Path(self.target) / file_rel_path
-                src_modified = file_src.lstat().st_mtime
-                tar_modified = file_tar.lstat().st_mtime
-                if src_modified > tar_modified:
-                    self.sync_dict["upd_lr"].add(str(file_rel_path))
-                elif tar_modified > src_modified:
-                    self.sync_dict["upd_rl"].add(str(file_rel_path))
-
-        if self.excl_src_items or self.excl_tar_items:
-            # OBS saved_dirs are accessed by outer scope from inner func decide_action...
-            saved_dirs = set(self.state_dict.keys())
-            decide_action_for_excl_items(self.excl_src_items, 
-            self.sync_dict["add_to_tar"], self.sync_dict["src_deletes"])
-            decide_action_for_excl_items(self.excl_tar_items,
-            self.sync_dict["add_to_src"], self.sync_dict["tar_deletes"])
-
-    def create_new_state_dict(self):
-        # This sub only adds mutual items and items to be deleted.
-        # The latter will be removed upon delition.
-        # Items to be added during sync are added after succesful syncing
-        self.new_state_dict = {}
-        
-        # Adds mutual items
-        for dir in self.mutual_items:
-            self.new_state_dict[dir[0].name] = set()
-            for file in dir[1:]:
-                self.new_state_dict[dir[0].name].add(file)
-        
-        # Adds dirs to be deleted
-        delete_dirs = self.sync_dict["src_deletes"].dirs.keys() | self.sync_dict["tar_deletes"].dirs.keys()
-        for dir in delete_dirs:
-            if not dir in self.new_state_dict:
-                self.new_state_dict[dir] = set()
-
-        # Adds files to be deleted
-        src_delete_files = set(self.sync_dict["src_deletes"].files.values())
-        tar_delete_files = set(self.sync_dict["tar_deletes"].files.values())
-        delete_files = src_delete_files | tar_delete_files
-
-        for item in delete_files:
-            dir = str(item.parent)
-            try:
-                self.new_state_dict[dir].add(item.name)
-            except KeyError:
-                self.new_state_dict[dir] = set()
-                self.new_state_dict[dir].add(item.name)
+        if self.diff_engine == "numpy":
+            self.__decide_vectorised()
+            return
+
+        src, tar = self.src_index, self.tar_index
+        new_state = self.new_state
+        saved_dirs = self.state_dict.keys()
+        # (dir, names, add key, delete key) of exclusive files in mutual dirs
+        exclusive_files = []
+        verify_candidates = []
+
+        for src_id, dir in enumerate(src.dirs):
+            tar_id = tar.dir_ids.get(dir)
+            if tar_id is None:
+                was_synced = not self.mirror and dir in saved_dirs
+                self.__decide_exclusive_dir(src, src_id, was_synced, "add_to_tar", "src_deletes")
+                continue
 
-    def deletions_necessary(self):
-        return (bool(self.sync_dict["delete_from_source"]) or 
-                bool(self.sync_dict["delete_from_tar"]))
+            new_state.mutual_dirs[src_id] = 1
+            src_first, src_end = src.dir_range(src_id)
+            tar_first, tar_end = tar.dir_range(tar_id)
+            if src.names[src_first:src_end] == tar.names[tar_first:tar_end]:
+                # Same files on both sides (the common case). Mtimes are compared as arrays.
+                new_state.mutual[src_first:src_end] = b"\x01" * (src_end - src_first)
+                if (src.mtime_ns[src_first:src_end] != tar.mtime_ns[tar_first:tar_end] or
+                        self.mirror and src.size[src_first:src_end] != tar.size[tar_first:tar_end]):
+                    for offset in range(src_end - src_first):
+                        self.__compare_mutual(dir, src_first + offset, tar_first + offset,
+                                              verify_candidates)
+                continue
 
-    def delete_files(self):
-        del_obj1, del_obj2 = self.sync_dict["src_deletes"], self.sync_dict["tar_deletes"]
+            src_only, tar_only = [], []
+            i, j = src_first, tar_first
+            while i < src_end and j < tar_end:
+                src_name, tar_name = src.names[i], tar.names[j]
+                if src_name == tar_name:
+                    new_state.mutual[i] = 1
+                    self.__compare_mutual(dir, i, j, verify_candidates)
+                    i += 1
+                    j += 1
+                elif src_name < tar_name:
+                    src_only.append(src_name)
+                    i += 1
+                else:
+                    tar_only.append(tar_name)
+                    j += 1
+            src_only.extend(src.names[i:src_end])
+            tar_only.extend(tar.names[j:tar_end])
+            if src_only:
+                exclusive_files.append((dir, src_only, "add_to_tar", "src_deletes"))
+            if tar_only:
+                exclusive_files.append((dir, tar_only, "add_to_src", "tar_deletes"))
+
+        for tar_id, dir in enumerate(tar.dirs):
+            if not dir in src.dir_ids:
+                was_synced = self.mirror or dir in saved_dirs
+                self.__decide_exclusive_dir(tar, tar_id, was_synced, "add_to_src", "tar_deletes")
+
+        if verify_candidates:
+            self.verify_content(verify_candidates)
+
+        if exclusive_files:
+            self.__decide_exclusive_files(exclusive_files)
+
+    def __decide_vectorised(self):
+        # Same decisions as decide_sync_actions with whole-array operations
+        src, tar = self.src_index, self.tar_index
+        new_state = self.new_state
+        saved_dirs = self.state_dict.keys()
+        diff = vector_diff.diff_indexes(src, tar, self.mirror)
+
+        for dir_id in diff.mutual_dirs:
+            new_state.mutual_dirs[dir_id] = 1
+        vector_diff.set_flags(new_state.mutual, diff.src_mutual)
+        for dir_id in diff.src_only_dirs:
+            was_synced = not self.mirror and src.dirs[dir_id] in saved_dirs
+            self.__decide_exclusive_dir(src, dir_id, was_synced, "add_to_tar", "src_deletes")
+        for dir_id in diff.tar_only_dirs:
+            was_synced = self.mirror or tar.dirs[dir_id] in saved_dirs
+            self.__decide_exclusive_dir(tar, dir_id, was_synced, "add_to_src", "tar_deletes")
+
+        verify_candidates = []
+        for dir, src_pos, tar_pos in diff.changed:
+            self.__compare_mutual(dir, src_pos, tar_pos, verify_candidates)
+        if verify_candidates:
+            self.verify_content(verify_candidates)
+
+        keys = (("add_to_tar", "src_deletes"), ("add_to_src", "tar_deletes"))
+        exclusive_files = [(dir, names) + keys[side] for dir, names, side in diff.exclusive_files]
+        if exclusive_files:
+            self.__decide_exclusive_files(exclusive_files, diff.encoder)
+
+    def __decide_exclusive_files(self, exclusive_files, encoder=None):
+        # Files only on one side of mutual dirs, tuples (dir, names, add key,
+        # delete key). Saved state is looked up with encoder (numpy engine) if given.
+        new_state = self.new_state
+        # Files of saved state are only needed for mutual dirs with exclusive files
+        prefetch = getattr(self.state_dict, "prefetch", None)
+        if prefetch:
+            prefetch([dir for dir, _, _, _ in exclusive_files])
+
+        saved = None
+        if encoder and not self.mirror:
+            saved = vector_diff.saved_flags(encoder, [(dir, names) for dir, names, _, _ in exclusive_files],
+                                            lambda dir: self.state_dict.get(dir, ()))
+
+        for item_no, (dir, names, add_key, del_key) in enumerate(exclusive_files):
+            if self.mirror:
+                # Everything only on target is deleted
+                flags = [del_key == "tar_deletes"] * len(names)
+            elif saved is not None:
+                flags = saved[item_no]
+            else:
+                saved_files = set(self.state_dict.get(dir, set()))
+                flags = [name in saved_files for name in names]
+            for name, was_synced in zip(names, flags):
+                if was_synced: # Previously existed on both sides
+                    self.sync_dict[del_key].add_file(dir, name)
+                    new_state.add_file(dir, name)
+                else: # Added since last sync
+                    self.sync_dict[add_key].add_file(dir, name)
+
+    def __compare_mutual(self, dir, src_pos, tar_pos, verify_candidates):
+        # Decides action for a mutual file given its position in both indexes
+        src, tar = self.src_index, self.tar_index
+        if src.mtime_ns[src_pos] == tar.mtime_ns[tar_pos] and (
+                not self.mirror or src.size[src_pos] == tar.size[tar_pos]):
+            return
+        src_entry, tar_entry = src.entry_at(src_pos), tar.entry_at(tar_pos)
+        rel_path = join_rel_path(dir, src.names[src_pos])
+        if (self.hash_cache and src_entry.size == tar_entry.size
+                and stat.S_ISREG(src_entry.mode) and stat.S_ISREG(tar_entry.mode)):
+            # Same size, might only be the mtime that differs
+            verify_candidates.append((rel_path, src_entry, tar_entry))
+        elif self.mirror or src_entry.mtime_ns > tar_entry.mtime_ns:
+            self.sync_dict["upd_lr"].add(rel_path)
+        else:
+            self.sync_dict["upd_rl"].add(rel_path)
+
+    def __decide_exclusive_dir(self, index, dir_id, was_synced, add_key, del_key):
+        # Entire folder exists exclusively on one side
+        dir = index.dirs[dir_id]
+        first, end = index.dir_range(dir_id)
+        names = index.names[first:end]
+        if was_synced: # Previously existed on both sides
+            self.sync_dict[del_key].add_files(dir, names)
+            self.sync_dict[del_key].add_dir(dir)
+            # Stays in state until deleted
+            self.new_state.add_dir(dir)
+            for name in names:
+                self.new_state.add_file(dir, name)
+        else: # Added since last sync
+            self.sync_dict[add_key].add_files(dir, names)
+            self.sync_dict[add_key].add_dir(dir)
+
+    def verify_content(self, candidates):
+        """Summary: Compares content of mutual files with different mtimes (see
+        content_hash.py). Identical files are put in touch_lr/touch_rl (only
+        mtime is aligned to the newer side), the rest in upd_lr/upd_rl.
 
-        for del_obj in (del_obj1, del_obj2):
+        Args:
+            candidates {list}: Tuples (rel_path, src Entry_stat, tar Entry_stat).
+        """
+        files = [(os.path.join(self.source, rel_path), src_entry) for rel_path, src_entry, _ in candidates]
+        files += [(os.path.join(self.target, rel_path), tar_entry) for rel_path, _, tar_entry in candidates]
+        # Both sides are hashed on the same pool
+        digests = self.hash_cache.get_digests(files)
+        src_digests, tar_digests = digests[:len(candidates)], digests[len(candidates):]
+
+        for (rel_path, src_entry, tar_entry), src_digest, tar_digest in zip(candidates, src_digests, tar_digests):
+            src_is_newer = self.mirror or src_entry.mtime_ns > tar_entry.mtime_ns
+            if src_digest is not None and src_digest == tar_digest:
+                self.sync_dict["touch_lr" if src_is_newer else "touch_rl"].add(rel_path)
+            else:
+                self.sync_dict["upd_lr" if src_is_newer else "upd_rl"].add(rel_path)
 
-            if not del_obj.files:
-                LOGGER.debug(f"No files to delete in {del_obj.root}")
+    def deletions_necessary(self):
+        return (bool(self.sync_dict["src_deletes"]) or 
+                bool(self.sync_dict["tar_deletes"]))
+
+    def delete_items(self):
+        """Summary: Deletes src_deletes and tar_deletes with Bulk_deleter (see
+        deletion.py). Results come per parent dir and are applied to
+        self.new_state in one batch each. Items that couldn't be deleted are
+        logged, added to self.failed_deletes and stay in the new state."""
+        engine = Bulk_deleter(DEFAULT_DELETE_WORKERS, self.print_output, self.fs)
+        for del_obj in (self.sync_dict["src_deletes"], self.sync_dict["tar_deletes"]):
+            if not del_obj:
+                LOGGER.debug(f"Nothing to delete in {del_obj.root}")
                 continue
 
-            for item in del_obj.files:
-                try:
-                    rel_path = del_obj.files[item]
-                    path = del_obj.root / rel_path
-                    path.unlink()
-                    print(f"Deleted file: {path}")
-                except Exception as err:
-                    LOGGER.error(f"Couldn't delete {item}")
-                    LOGGER.error(err)
-                else:
-                    # Following lines are to alter state in new_state_dict
-                    key = str(rel_path.parent)
-                    self.new_state_dict[key].remove(rel_path.name)
-            
+            for result in engine.run(del_obj.root, del_obj.files, del_obj.dirs):
+                for dir, names in result.files.items():
+                    for name in names:
+                        self.new_state.remove_file(dir, name)
+                        if self.journal:
+                            self.journal.remove_file(dir, name)
+                for dir in result.dirs:
+                    self.new_state.remove_dir(dir)
+                    if self.journal:
+                        self.journal.remove_dir(dir)
+                self.metrics.add("files_deleted", result.file_count())
+                self.metrics.add("dirs_deleted", len(result.dirs))
+                for rel_path, error in result.failed:
+                    LOGGER.error(f"Couldn't delete {rel_path}")
+                    LOGGER.error(error)
+                    self.failed_deletes.add(rel_path)
+                    self.metrics.error("delete")
+
     def dryrun_delete_files(self):
         del_obj1, del_obj2 = self.sync_dict["src_deletes"], self.sync_dict["tar_deletes"]
         
@@ -491,31 +654,10 @@ class Syncer:
                 LOGGER.debug(f"No files to delete in {del_obj.root}")
                 continue
 
-            for item in del_obj.files:
-                path = del_obj.root / del_obj.files[item]
+            for dir, name in del_obj.iter_files():
+                path = os.path.join(del_obj.root, join_rel_path(dir, name))
                 print(f"Deleting file (dryrun): {path}")
             
-    def delete_dirs(self):
-        del_obj1, del_obj2 = self.sync_dict["src_deletes"], self.sync_dict["tar_deletes"]
-        
-        for del_obj in (del_obj1, del_obj2):
-            if not del_obj.dirs:
-                LOGGER.debug(f"No dirs to delete in {del_obj.root}")
-                continue
-
-            dir_list = del_obj.get_dir_list()
-
-            for item in dir_list:
-                try:
-                    path = del_obj.root / item
-                    path.rmdir()
-                    print(f"Deleted directory: {path}")
-                except Exception as err:
-                    LOGGER.error(f"Couldn't delete {str(item)}")
-                    LOGGER.error(err)
-                else:
-                    del self.new_state_dict[str(item)]
-    
     def dryrun_delete_dirs(self):
         del_obj1, del_obj2 = self.sync_dict["src_deletes"], self.sync_dict["tar_deletes"]
         
@@ -527,17 +669,19 @@ class Syncer:
             dir_list = del_obj.get_dir_list()
 
             for item in dir_list:
-                path = del_obj.root / item
+                path = os.path.join(del_obj.root, item)
                 print(f"Deleting directory (dryrun): {path}")
             
     def delete(self):
-        if self.delete:
-            if self.dryrun:
-                self.dryrun_delete_files()
-                self.dryrun_delete_dirs()
-            else:
-                self.delete_files()
-                self.delete_dirs()
+        # Without deletions enabled the items stay in the new state (see point 3
+        # in folder_sync_documentation/sync_behavior.txt) and are planned again next sync
+        if not self.deletions:
+            return
+        if self.dryrun:
+            self.dryrun_delete_files()
+            self.dryrun_delete_dirs()
+        else:
+            self.delete_items()
 
     def sync_necessary(self):
         return (bool(self.sync_dict["upd_lr"]) or 
@@ -557,35 +701,22 @@ class Syncer:
         if not self.deletions:
             intersection_set = intersection_set | intersections2 | intersections3
         elif (intersections2 or intersections3) and not self.dryrun:
-            # Deletions should be performed!
-            intersection4 = set()
-            src_items = self.sync_dict["src_deletes"].get_item_set()
-            tar_items = self.sync_dict["tar_deletes"].get_item_set()
-
-            for item in src_items:
-                path = pathlib.Path(self.source) / item
-                if path.exists():
-                    intersection4.add(item)
-
-            for item in tar_items:
-                path = pathlib.Path(self.target) / item
-                if path.exists():
-                    intersection4.add(item)
-            
-            intersection_set = intersection_set | intersection4
+            # Deletions have been performed! Items that still exist are
+            # exactly the ones whose deletion failed.
+            intersection_set = intersection_set | self.failed_deletes
                 
         if intersection_set:
             src_duplicates = Items(self.source)
             tar_duplicates = Items(self.target)
             for rel_item in intersection_set:
-                src_item = pathlib.Path(self.source) / rel_item
-                tar_item = pathlib.Path(self.target) / rel_item
-
-                for item, dupl_obj in ((src_item, src_duplicates), (tar_item, tar_duplicates)):
-                    if item.is_file() or item.is_symlink():
-                        dupl_obj.add_file(item)
-                    elif item.is_dir():
-                        dupl_obj.add_dir(item)
+                # Type of item on each side is taken from the scan
+                dir, name = split_rel_path(rel_item)
+                for index, dupl_obj in ((self.src_index, src_duplicates),
+                                        (self.tar_index, tar_duplicates)):
+                    if index.find(dir, name) >= 0:
+                        dupl_obj.add_file(dir, name)
+                    elif rel_item in index:
+                        dupl_obj.add_dir(rel_item)
                     else:
                         LOGGER.error("Duplicate that is neither dir nor file!?")
 
@@ -593,153 +724,351 @@ class Syncer:
 
         return None
 
-    def create_textfiles(self):
-        # Private method to create textfiles necessary for rsync call.
-        config_dir = SCRIPT_PATH / ".folder_sync_config"
-
-        def create_file_and_attr(sync_dict, prp_name, file_name):
-            if sync_dict:
-                setattr(self, prp_name, (config_dir / file_name))
-                with getattr(self, prp_name).open("w") as the_file:
-                    the_file.writelines([line + '\n' for line in sync_dict])
-            else:
-                setattr(self, prp_name, None)
-
-        timepoint = round(time())
-        create_file_and_attr(self.sync_dict["upd_lr"], "txtfile_lr", f"lr_sync_{timepoint}.tmp")
-        create_file_and_attr(self.sync_dict["upd_rl"], "txtfile_rl", f"rl_sync_{timepoint}.tmp")
-        create_file_and_attr(self.sync_dict["add_to_tar"].get_item_set(), "txtfile_tar_adds", f"tar_adds_{timepoint}.tmp")
-        create_file_and_attr(self.sync_dict["add_to_src"].get_item_set(), "txtfile_src_adds", f"src_adds_{timepoint}.tmp")
-
-    def remove_textfiles(self):
-        for item in (self.txtfile_lr, self.txtfile_rl, self.txtfile_tar_adds, 
-                    self.txtfile_src_adds):
-            if item:
-                try:
-                    item.unlink()
-                except Exception:
-                    LOGGER.debug("Couldn't remove textfile")
-
-    def add_items_to_state(self, items_obj):
-        # Adds succesfully added filew to self.new_state_dict
-        if not isinstance(items_obj, Items):
-            raise TypeError("Argument must be an instance of the Items class")
-        
-        for dir_string in items_obj.dirs:
-            self.new_state_dict[dir_string] = set()
-        
-        for file_path in items_obj.files.values():
-            dir_string = str(file_path.parent)
-            self.new_state_dict[dir_string].add(file_path.name)
-    
     def get_new_state_dict(self):
-        new_state_dict = {}
-        for key in self.new_state_dict:
-            new_state_dict[key] = list(self.new_state_dict[key])
-        
-        return new_state_dict
+        """Returns new state (Pair_state, see tree_index.py) which can be used
+        as a dictionary with dirs as keys and lists of files as values."""
+        return self.new_state
+
+    def add_paths_to_state(self, items_obj, paths):
+        # Adds succesfully added paths (subset of items_obj) to self.new_state
+        # (and to the journal)
+        journal = self.journal
+        for path in paths:
+            if path in items_obj.dirs:
+                self.new_state.add_dir(path)
+                if journal:
+                    journal.add_dir(path)
+            else:
+                dir, name = split_rel_path(path)
+                self.new_state.add_file(dir, name)
+                if journal:
+                    journal.add_file(dir, name)
 
-    def __run_rsync(self, initial_arglist, txt_path, source, target):
-        """Used by sync method to call rsync with rsync_arglist. Will always use
-        --from-file and --itemize-changes.
+    def remove_transferred(self, transferred):
+        """Summary: Takes items that were already transferred while scanning
+        (see pipeline.py) out of sync_dict, so they aren't transferred again.
+        Succeeded additions are added to self.new_state like after a sync.
 
         Args:
-            initial_arglist {list}: list of args for rsync call
-            txt_path  {pathlib.Path}: pathlib.Path instance to txtfile
-            source {string}: string corresponding to rsync source
-            target {string}: string corresponding to rsync target
-            print_output {boolean}: Wether to print any output or not
+            transferred {dictionary}: sync_dict key as key and tuple (paths,
+            succeeded) of sets of relative paths as value.
+
         Returns:
-            [type]: [description]
+            {int}: Number of transferred paths that aren't in the plan.
         """
+        unplanned = 0
+        for key, (paths, succeeded) in transferred.items():
+            planned = self.sync_dict[key]
+            if isinstance(planned, Items):
+                planned_paths = planned.get_item_set()
+                unplanned += len(paths - planned_paths)
+                self.add_paths_to_state(planned, succeeded & planned_paths)
+                planned.remove_paths(paths & planned_paths)
+            else:
+                unplanned += len(paths - planned)
+                planned -= paths
+        return unplanned
 
-        already_synced = 50
-        from_file_without_valid_filepath = 51
+    def skip_items(self, rel_paths):
+        """Summary: Takes rel_paths and everything below them out of the
+        additions in sync_dict, they aren't synced (see watcher.py).
 
-        if txt_path:
-            if not txt_path.exists():
-                return from_file_without_valid_filepath
-            arglist = initial_arglist[:]
-            arglist.append(("--files-from=" + str(txt_path)))
-            arglist.append(source)
-            arglist.append(target)
-        else:
-            return already_synced
+        Args:
+            rel_paths {set}: Relative paths of files and dirs.
+        """
+        def is_skipped(rel_path):
+            while rel_path:
+                if rel_path in rel_paths:
+                    return True
+                rel_path = os.path.dirname(rel_path)
+            return False
 
-        obj_return = subprocess.run(arglist, text=True, capture_output=True)
+        for key in ("add_to_tar", "add_to_src"):
+            planned = self.sync_dict[key]
+            planned.remove_paths({rel_path for rel_path in planned.get_item_set() if is_skipped(rel_path)})
+
+    def __sync_jobs(self):
+        add_to_tar, add_to_src = self.sync_dict["add_to_tar"], self.sync_dict["add_to_src"]
+        return (
+            # (paths, new dirs, sending side, receiving side, Items for state update)
+            (self.sync_dict["upd_lr"], (), self.source, self.target, None),
+            (self.sync_dict["upd_rl"], (), self.target, self.source, None),
+            (add_to_tar.get_item_set(), add_to_tar.dirs, self.source, self.target, add_to_tar),
+            (add_to_src.get_item_set(), add_to_src.dirs, self.target, self.source, add_to_src),
+        )
+
+    def __print_plan(self):
+        """Prints what sync would do, directly from sync_dict and the scan
+        metadata (no rsync --dry-run, no extra stat calls). Lines look the same
+        as formatted rsync output with the size of each file added.
 
-        if obj_return.stdout:
+        Returns:
+            {list}: Same returncodes as a real sync would give when nothing
+            goes wrong (0 or already_synced = 50 per list).
+        """
+        return_values = []
+        total_items, total_bytes = 0, 0
+        for paths, new_dirs, sender, receiver, items_obj in self.__sync_jobs():
+            if not paths:
+                return_values.append(rsync_runner.ALREADY_SYNCED)
+                continue
+            return_values.append(0)
+
+            index = self.src_index if sender == self.source else self.tar_index
+            # Lists without Items are updates of files existing on both sides
+            is_update = items_obj is None
+            lines = {"created": [], "modified": []}
+            job_bytes = 0
+            for rel_path in paths:
+                if rel_path in new_dirs:
+                    lines["created"].append(format_rsync_line(f"cd+++++++++ {rel_path}/")[1])
+                    continue
+
+                entry = index.entry(*split_rel_path(rel_path))
+                if stat.S_ISLNK(entry.mode):
+                    prefix = "cL.t......." if is_update else "cL+++++++++"
+                elif stat.S_ISREG(entry.mode):
+                    prefix = ">f.st......" if is_update else ">f+++++++++"
+                    job_bytes += entry.size
+                else:
+                    prefix = "cS+++++++++"
+                category, line = format_rsync_line(f"{prefix} {rel_path}")
+                lines[category].append(f"{line}  ({format_size(entry.size)})")
+
+            total_items += len(paths)
+            total_bytes += job_bytes
             if self.print_output:
-                print(format_rsync_output(obj_return.stdout), end="")
-        else:
-            if not obj_return.stderr:
-                return already_synced
+                print(f"\n{sender} --> {receiver}")
+                print(os.linesep.join(sorted(lines["created"]) + sorted(lines["modified"])))
 
-        if obj_return.stderr:
-            # TODO maybe write to logfile if print_output=False
-            print(obj_return.stderr)
+        if self.print_output and total_items:
+            print(f"\nWould transfer {total_items} items ({format_size(total_bytes)})")
+        return return_values
 
-        if not obj_return.returncode == 0:
-            # TODO maybe write to logfile if print_output=False
-            print("Something went wrong in rsync call!")
+    def stale_items(self):
+        """Summary: Checks that the items in sync_dict are unchanged since the
+        scan. Only the planned items are lstat'ed (no new scan), so it is cheap
+        compared to planning again. Used when a plan shown to the user has
+        waited a long time before being applied.
 
-        return obj_return.returncode
+        Returns:
+            {list}: Relative paths that changed. Empty if plan is still valid.
+        """
+        # (root, Tree_index, rel_path) where Tree_index None means a dir
+        checks = []
+        for rel_path in (self.sync_dict["upd_lr"] | self.sync_dict["upd_rl"] |
+                         self.sync_dict["touch_lr"] | self.sync_dict["touch_rl"]):
+            checks.append((self.source, self.src_index, rel_path))
+            checks.append((self.target, self.tar_index, rel_path))
+        for key, root, index in (("add_to_tar", self.source, self.src_index),
+                                 ("src_deletes", self.source, self.src_index),
+                                 ("add_to_src", self.target, self.tar_index),
+                                 ("tar_deletes", self.target, self.tar_index)):
+            items_obj = self.sync_dict[key]
+            checks.extend((root, index, rel_path) for rel_path in items_obj.get_file_set())
+            checks.extend((root, None, rel_path) for rel_path in items_obj.dirs)
+
+        stale = []
+        for root, index, rel_path in checks:
+            try:
+                st = self.fs.lstat(os.path.join(root, rel_path))
+            except OSError:
+                stale.append(rel_path)
+                continue
+            if index is None:
+                if not stat.S_ISDIR(st.st_mode):
+                    stale.append(rel_path)
+                continue
+            entry = index.entry(*split_rel_path(rel_path))
+            if st.st_size != entry.size or st.st_mtime_ns != entry.mtime_ns:
+                stale.append(rel_path)
+
+        # Additions must not have appeared on the receiving side
+        for key, receiver in (("add_to_tar", self.target), ("add_to_src", self.source)):
+            for rel_path in self.sync_dict[key].get_item_set():
+                if self.fs.lexists(os.path.join(receiver, rel_path)):
+                    stale.append(rel_path)
+
+        return stale
+
+    def verify_transferred(self):
+        """Summary: Checks the target against the plan after a real sync from
+        source to target (see mirror). Only the planned items are lstat'ed on
+        target and compared with the scan of source: type always, size and
+        mtime for regular files. Additions that match are put in
+        self.new_state even when the transfer reported an error for their
+        shard, additions that don't match are taken out of it. Target deletes
+        that failed stay in the new state, so they are deleted next sync.
 
-    def sync(self):
-        """Summary: Sync files in lr_items and rl_items using rsync as subprocess.
-        Requires internal variables
+        Returns:
+            {list}: Sorted tuples (relative path, reason) of items where target
+            doesn't match source.
+        """
+        mismatches = []
+        add_to_tar = self.sync_dict["add_to_tar"]
+        checks = [(rel_path, True) for rel_path in add_to_tar.get_item_set()]
+        checks += [(rel_path, False) for rel_path in self.sync_dict["upd_lr"]]
+        for rel_path, is_addition in checks:
+            dir, name = split_rel_path(rel_path)
+            reason = None
+            try:
+                st = self.fs.lstat(os.path.join(self.target, rel_path))
+            except OSError as error:
+                reason = f"missing on target ({error.strerror})"
+            else:
+                if rel_path in add_to_tar.dirs:
+                    if not stat.S_ISDIR(st.st_mode):
+                        reason = "not a directory on target"
+                else:
+                    entry = self.src_index.entry(dir, name)
+                    if stat.S_IFMT(st.st_mode) != stat.S_IFMT(entry.mode):
+                        reason = "type differs"
+                    elif stat.S_ISREG(entry.mode) and (st.st_size != entry.size or
+                                                       st.st_mtime_ns != entry.mtime_ns):
+                        reason = "size or modification time differs"
+
+            if reason is not None:
+                mismatches.append((rel_path, reason))
+                if is_addition and rel_path in add_to_tar.dirs:
+                    self.new_state.remove_dir(rel_path)
+                elif is_addition:
+                    self.new_state.remove_file(dir, name)
+            elif is_addition:
+                self.add_paths_to_state(add_to_tar, (rel_path,))
+
+        mismatches.extend((rel_path, "couldn't be deleted from target") for rel_path in self.failed_deletes)
+        return sorted(mismatches)
+
+    def __touch_files(self):
+        """Aligns mtime of files with identical content (touch_lr and touch_rl)
+        to the newer side. Only prints them if self.dryrun.
 
-        Args:
-            delete {bool}: Wether to delete files in target that doesnt exist in source.
-            dryrun {bool}: If true run rsync ones with --dry-run flag. If true ignores user_interaction=True.
-            prin_output {bool}: If true prints output.
+        Returns:
+            {int}: Number of files touched (or to be touched if dryrun).
+        """
+        touched = 0
+        for key, sender_index, receiver in (("touch_lr", self.src_index, self.target),
+                                            ("touch_rl", self.tar_index, self.source)):
+            for rel_path in sorted(self.sync_dict[key]):
+                if self.print_output:
+                    print(f"{'Updated time: ':<30}{rel_path}")
+                if self.dryrun:
+                    touched += 1
+                    continue
+                mtime_ns = sender_index.entry(*split_rel_path(rel_path)).mtime_ns
+                path = os.path.join(receiver, rel_path)
+                try:
+                    self.fs.set_mtime(path, mtime_ns)
+                    touched += 1
+                except OSError as error:
+                    LOGGER.error(f"Couldn't set modification time of {path}: {error}")
+                    self.metrics.error("transfer")
+        if not self.dryrun:
+            self.metrics.add("files_touched", touched)
+        return touched
+
+    def __sync_rsync(self):
+        arglist = rsync_runner.TRANSFER_ARGLIST
+
+        with ThreadPoolExecutor(max_workers=max(1, self.rsync_workers)) as executor:
+            job_futures = []
+            for paths, new_dirs, sender, receiver, items_obj in self.__sync_jobs():
+                shard_futures = []
+                for shard in rsync_runner.create_shards(paths, new_dirs, self.rsync_workers):
+                    future = executor.submit(rsync_runner.run_rsync, arglist, shard, sender,
+                                             receiver, self.print_output, self.stream_output,
+                                             self.metrics)
+                    shard_futures.append((shard, future))
+                job_futures.append((items_obj, sender, shard_futures))
+
+            return_values = []
+            for items_obj, sender, shard_futures in job_futures:
+                shard_returns = []
+                for shard, future in shard_futures:
+                    return_code, succeeded = future.result()
+                    shard_returns.append(return_code)
+                    # State is updated per item, from what rsync reported (see rsync_runner)
+                    self.metrics.add("items_transferred", len(succeeded))
+                    self.metrics.add("bytes_transferred", self.__paths_size(succeeded, sender))
+                    if items_obj:
+                        self.add_paths_to_state(items_obj, succeeded)
+                    if len(succeeded) < len(shard):
+                        self.metrics.error("transfer", len(shard) - len(succeeded))
+                        if items_obj:
+                            LOGGER.error(f"rsync returned {return_code}. {len(shard) - len(succeeded)} "
+                                         f"of {len(shard)} items are left out of saved state.")
+                return_values.append(rsync_runner.aggregate_returncodes(shard_returns))
+
+        return return_values
+
+    def __sync_native(self):
+        engine = Native_transfer(self.rsync_workers, False, self.print_output, self.signature_cache,
+                                 self.journal)
+        return_values = []
+        for paths, _, sender, receiver, items_obj in self.__sync_jobs():
+            # State is updated (and journaled) per item as soon as it is transferred
+            if items_obj:
+                def on_transferred(path, items_obj=items_obj):
+                    self.add_paths_to_state(items_obj, (path,))
+            else:
+                on_transferred = None
+            return_code, succeeded = engine.run(list(paths), sender, receiver, on_transferred)
+            self.metrics.add("items_transferred", len(succeeded))
+            if len(succeeded) < len(paths):
+                self.metrics.error("transfer", len(paths) - len(succeeded))
+            return_values.append(return_code)
+
+        # Unchanged blocks of delta updates count as transferred, not as written
+        self.metrics.add("bytes_transferred", engine.bytes_copied + engine.bytes_skipped)
+        self.metrics.add("bytes_written", engine.bytes_copied)
+        if engine.delta_files:
+            self.metrics.add("delta_files", engine.delta_files)
+            self.metrics.add("delta_bytes_saved", engine.bytes_skipped)
+            LOGGER.debug(f"Delta updates of {engine.delta_files} files skipped "
+                         f"{format_size(engine.bytes_skipped)} of unchanged blocks")
+        LOGGER.debug(f"Native transfer copied {engine.bytes_copied} bytes")
+        return return_values
+
+    def __paths_size(self, paths, sender):
+        # Size (from the scan) of the files in paths
+        index = self.src_index if sender == self.source else self.tar_index
+        size = 0
+        for rel_path in paths:
+            entry = index.entry(*split_rel_path(rel_path))
+            if entry and stat.S_ISREG(entry.mode):
+                size += entry.size
+        return size
+
+    def sync(self):
+        """Summary: Sync files in sync_dict with the transfer backend in
+        self.transfer_backend. The 4 lists are lr updates, rl updates, target
+        adds and source adds. If self.dryrun the plan is only printed (see
+        __print_plan), no backend is run. Files with identical content (touch_lr
+        and touch_rl) only get their mtime aligned first.
+
+        "rsync": Each list is split into shards (see create_shards in rsync_runner)
+        and all shards are run concurrently by self.rsync_workers rsync processes.
+        File lists are passed over stdin. Additions are added to self.new_state
+        per shard, so a failing shard only keeps its own items out of the saved state.
+
+        "native": Items are copied in this process by Native_transfer (see transfer.py)
+        with self.rsync_workers threads. Only for local folder pairs. Additions
+        are added to self.new_state per item. With self.signature_cache large
+        files existing on both sides get delta updates (see delta.py).
         
         Returns:
-            Most often propagates returncode from rsync call itself.
+            {list}: One returncode per list (see aggregate_returncodes in rsync_runner).
             Below are implementations specific return codes:
             already_synced = 50
-            from_file_without_valid_filepath = 51
         """
-        
-        if not self.textfiles_created:
-            self.create_textfiles()
-            self.textfiles_created = True
-
-        return_values = []
-        arglist = ["rsync", "-a", "--itemize-changes"]
 
+        touched = self.__touch_files()
         if self.dryrun:
-            arglist.append("--dry-run")
-
-        # These lines calls rsync 4 times.
-        return_values.append(self.__run_rsync(arglist, self.txtfile_lr,
-                            self.source, self.target))
-        return_values.append(self.__run_rsync(arglist, self.txtfile_rl,
-                            self.target, self.source))
-        tar_adds_return = self.__run_rsync(arglist, self.txtfile_tar_adds,
-                            self.source, self.target)
-        src_adds_return = self.__run_rsync(arglist, self.txtfile_src_adds,
-                            self.target, self.source)
-
-        return_values.append(tar_adds_return)
-        return_values.append(src_adds_return)
-
-        if not self.dryrun:
-            if tar_adds_return == 0:
-                self.add_items_to_state(self.sync_dict["add_to_tar"])
-            elif tar_adds_return == 50:
-                pass # No additions necessary
-            else:
-                # TODO how to handle erroneus additions? Maybe add logic outside of class (sync_functions?)
-                pass
-
-            if src_adds_return == 0:
-                self.add_items_to_state(self.sync_dict["add_to_src"])
-            elif src_adds_return == 50:
-                pass # No additions necessary
-            else:
-                # TODO how to handle erroneus additions? Maybe add logic outside of class (sync_functions?)
-                pass
+            return_values = self.__print_plan()
+        elif self.transfer_backend == "native":
+            return_values = self.__sync_native()
+        else:
+            return_values = self.__sync_rsync()
 
         if self.print_output:
             has_synced = False
@@ -747,7 +1076,7 @@ class Syncer:
                 if value != 50:
                     has_synced = True
                     break
-            if not has_synced:
+            if not has_synced and not touched:
                 LOGGER.info("No additions or updates necessary. Folders are in sync!")
 
-        return return_values
\ No newline at end of file
+        return return_values
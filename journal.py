@@ -0,0 +1,100 @@
+"""This module contains the sync journal, which makes an interrupted sync
+resumable.
+
+The state of a folder pair is only saved when a sync is done (see
+two_way_sync in sync_functions). Without a journal a sync interrupted by
+Ctrl-C, a crash or a reboot loses everything it did: items added on the
+other side aren't in the saved state, and items deleted are still in it. The
+next sync then decides from a state that doesn't match what happened.
+
+While syncing, every addition and deletion that succeeded is appended to
+table sync_journal (write-ahead, before the state is saved). Entries are
+collected in memory and written with group commits, one transaction per
+JOURNAL_GROUP_SIZE entries or JOURNAL_COMMIT_SECONDS, so the journal costs a
+few commits per sync instead of one per item. At most the last group is lost
+if the process dies.
+
+Files updated in place by a delta update (see delta.py and transfer.py) are
+journaled too, with their absolute path: committed before the first block is
+written and again when the update is done. A file that was started but not
+done when the sync was interrupted is half written, replay_journal sets its
+mtime to 0 so the next sync replaces it with the other side.
+
+When the state of a finished sync is saved the journal is cleared in the same
+transaction. A journal that is still there when the next sync starts was left
+by an interrupted sync. It is replayed into the saved state first (see
+replay_journal in db_helpers), and the scan and plan then only find the work
+that remains.
+"""
+import logging
+import os
+from time import perf_counter
+from db_helpers import append_journal
+
+LOGGER = logging.getLogger(__name__)
+
+# Entries per group commit, and the longest time entries wait for one
+JOURNAL_GROUP_SIZE = 5000
+JOURNAL_COMMIT_SECONDS = 2.0
+
+
+class Sync_journal:
+    """
+    Summary:
+        Appends state changes of a sync in progress to table sync_journal with
+        group commits. Only used from the thread running the sync (the one
+        owning the cursor).
+
+    Properties:
+        self.cur {object} = Cursor of db
+        self.id {int} = id of folder pair
+        self.pending {list} = Tuples (op, dir, name) not committed yet
+        self.last_commit {float} = perf_counter of last group commit
+        self.entries {int} = Number of entries committed so far
+    """
+
+    def __init__(self, cur, folder_pair_id):
+        self.cur = cur
+        self.id = folder_pair_id
+        self.pending = []
+        self.last_commit = perf_counter()
+        self.entries = 0
+
+    def __repr__(self):
+        return f"Sync_journal({self.id}, committed: {self.entries}, pending: {len(self.pending)})"
+
+    def add_dir(self, dir):
+        self.__append("add", dir, None)
+
+    def add_file(self, dir, name):
+        self.__append("add", dir, name)
+
+    def remove_dir(self, dir):
+        self.__append("remove", dir, None)
+
+    def remove_file(self, dir, name):
+        self.__append("remove", dir, name)
+
+    def start_update(self, path):
+        self.__append("update", *os.path.split(path))
+
+    def finish_update(self, path):
+        self.__append("updated", *os.path.split(path))
+
+    def __append(self, op, dir, name):
+        self.pending.append((op, dir, name))
+        if (len(self.pending) >= JOURNAL_GROUP_SIZE or
+                perf_counter() - self.last_commit >= JOURNAL_COMMIT_SECONDS):
+            self.commit()
+
+    def commit(self):
+        """Writes pending entries in one transaction."""
+        pending, self.pending = self.pending, []
+        self.last_commit = perf_counter()
+        if not pending:
+            return
+        # On failure the entries are lost, which is what an interrupted sync
+        # without journal loses. The state saved at the end is still complete.
+        if append_journal(self.cur, self.id, pending) == 0:
+            self.entries += len(pending)
+            LOGGER.debug(f"Journaled {len(pending)} state changes of folder pair {self.id}")
@@ -0,0 +1,119 @@
+"""This module contains the metrics registry of a sync run.
+
+two_way_sync creates one Metrics_registry per run and passes it on to Syncer
+and the rsync runner, which report timers (seconds per phase), counters (files
+scanned, bytes transferred, rsync calls, deletions...) and errors per phase
+into it. After the run the metrics are saved in table sync_runs (see
+save_sync_run in db_helpers) and optionally written as a Prometheus textfile
+(for the node_exporter textfile collector).
+"""
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from time import perf_counter, time
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Metrics_registry:
+    """
+    Summary:
+        Thread safe collection of the metrics of one sync run.
+
+    Properties:
+        self.started_at {float} = Unix time when registry was created
+        self.timers {dictionary} = Phase as key and seconds as value
+        self.counters {dictionary} = Name as key and count (or bytes) as value
+        self.errors {dictionary} = Phase as key and number of errors as value
+        self.profiler {Profiler} = Optional. Is told when timed phases start
+            and end (see profiler.py)
+    """
+
+    def __init__(self, profiler=None):
+        self.profiler = profiler
+        self.started_at = time()
+        self.__start = perf_counter()
+        self.__lock = threading.Lock()
+        self.timers = {}
+        self.counters = {}
+        self.errors = {}
+
+    def __repr__(self):
+        return f"Metrics_registry(timers: {self.timers}, counters: {self.counters}, errors: {self.errors})"
+
+    def add(self, name, value=1):
+        with self.__lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def error(self, phase, count=1):
+        with self.__lock:
+            self.errors[phase] = self.errors.get(phase, 0) + count
+
+    def add_time(self, phase, seconds):
+        with self.__lock:
+            self.timers[phase] = self.timers.get(phase, 0) + seconds
+
+    @contextmanager
+    def timer(self, phase):
+        """Adds time spent in with block to phase (time accumulates if the
+        same phase is timed more than once)."""
+        if self.profiler:
+            self.profiler.start_phase(phase)
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(phase, perf_counter() - start)
+            if self.profiler:
+                self.profiler.end_phase(phase)
+
+    def as_dict(self):
+        with self.__lock:
+            return {
+                "started_at": self.started_at,
+                "duration": perf_counter() - self.__start,
+                "timers": dict(self.timers),
+                "counters": dict(self.counters),
+                "errors": dict(self.errors),
+            }
+
+
+def format_prometheus(pair_id, metrics_dict):
+    """Returns metrics_dict (see Metrics_registry.as_dict) in the Prometheus
+    text exposition format."""
+    label = f'pair="{pair_id}"'
+    lines = [
+        "# HELP folder_sync_last_run_timestamp_seconds Start of last sync run.",
+        "# TYPE folder_sync_last_run_timestamp_seconds gauge",
+        f"folder_sync_last_run_timestamp_seconds{{{label}}} {metrics_dict['started_at']:.3f}",
+        "# HELP folder_sync_run_duration_seconds Duration of last sync run.",
+        "# TYPE folder_sync_run_duration_seconds gauge",
+        f"folder_sync_run_duration_seconds{{{label}}} {metrics_dict['duration']:.6f}",
+        "# HELP folder_sync_phase_seconds Duration of each phase of last sync run.",
+        "# TYPE folder_sync_phase_seconds gauge",
+    ]
+    lines += [f'folder_sync_phase_seconds{{{label},phase="{phase}"}} {seconds:.6f}'
+              for phase, seconds in sorted(metrics_dict["timers"].items())]
+    lines += ["# HELP folder_sync_count Counters of last sync run (files, bytes, calls...).",
+              "# TYPE folder_sync_count gauge"]
+    lines += [f'folder_sync_count{{{label},name="{name}"}} {value}'
+              for name, value in sorted(metrics_dict["counters"].items())]
+    lines += ["# HELP folder_sync_errors Errors per phase of last sync run.",
+              "# TYPE folder_sync_errors gauge"]
+    lines += [f'folder_sync_errors{{{label},phase="{phase}"}} {count}'
+              for phase, count in sorted(metrics_dict["errors"].items())]
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus_textfile(directory, pair_id, metrics_dict):
+    """Writes folder_sync_pair_<pair_id>.prom in directory. The file is
+    replaced atomically so the collector never reads half a file."""
+    path = os.path.join(directory, f"folder_sync_pair_{pair_id}.prom")
+    tmp_path = path + f".{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "w") as prom_file:
+            prom_file.write(format_prometheus(pair_id, metrics_dict))
+        os.replace(tmp_path, path)
+    except OSError as error:
+        LOGGER.error(f"Couldn't write metrics to {path}: {error}")
@@ -0,0 +1,351 @@
+"""This module contains the pipelined sync (--pipeline in folder_sync.py).
+
+Normally both trees are scanned completely before Syncer decides anything, so
+the first file is copied only after the last dir is listed. In pipelined mode
+decisions are made per dir while the scan is running, as soon as the listings
+of a dir from both sides have arrived (see on_listing of scan_trees in
+scanner.py). Decided updates and additions are collected in batches and fed
+through bounded queues to transfer workers, so copying overlaps scanning.
+When a queue is full the coordinator waits for its worker (backpressure) while
+the scan threads keep listing.
+
+Only actions that don't depend on the rest of the tree are taken early:
+- updates of files existing on both sides (except files compared by content
+  or getting delta updates, see content_hash.py and delta.py)
+- additions of files and dirs that are new since last sync, in dirs existing
+  on both sides and in new subtrees
+Deletions, names that are a file on one side and a dir on the other, and dirs
+deleted on one side since last sync are left to Syncer. It plans the whole
+sync from the complete scan when the scan is done, as usual, and the items
+already transferred are taken out of its plan (see Syncer.remove_transferred).
+
+Everything in a dir goes to the same worker, after the dir itself when it is
+new. A parent of a new dir can be created implicitly by two workers at once,
+which rsync and Native_transfer both tolerate.
+
+If Syncer aborts after the scan (ie doubles, see delete_and_sync in
+sync_functions) the items transferred early stay transferred. They exist on
+both sides and are mutual items next sync.
+"""
+import logging
+import os
+import stat
+import threading
+from queue import Queue
+from time import perf_counter
+import rsync_runner
+from scanner import scan_trees, DEFAULT_SCAN_WORKERS
+from transfer import Native_transfer
+
+LOGGER = logging.getLogger(__name__)
+
+# Paths per batch. Smaller batches are sent when their worker is idle.
+PIPELINE_BATCH_SIZE = 500
+# Batches waiting per worker before the coordinator has to wait
+QUEUE_DEPTH = 2
+
+# sync_dict keys (see Syncer in helpers) per sending side
+UPDATE_KEYS = {"source": "upd_lr", "target": "upd_rl"}
+ADD_KEYS = {"source": "add_to_tar", "target": "add_to_src"}
+
+
+def join_rel(dir, name):
+    # Same as join_rel_path in helpers (helpers imports transfer which is imported here)
+    return name if dir == "." else dir + os.path.sep + name
+
+
+class Transfer_batch:
+    """
+    Summary:
+        Paths of one sync_dict key sent to one transfer worker.
+
+    Properties:
+        self.key {string} = sync_dict key, ie "upd_lr" or "add_to_tar"
+        self.paths {list} = Relative paths
+        self.size {int} = Bytes of the regular files in paths (from the scan)
+    """
+
+    __slots__ = ["key", "paths", "size"]
+
+    def __init__(self, key):
+        self.key = key
+        self.paths = []
+        self.size = 0
+
+    def __repr__(self):
+        return f"Transfer_batch({self.key}, paths: {len(self.paths)})"
+
+
+class Pipeline:
+    """
+    Summary:
+        Decides and transfers updates and additions per dir while source and
+        target are scanned (see module docstring). Start with run().
+
+    Properties:
+        self.roots {dictionary} = "source" and "target" as keys, paths as values
+        self.scanners {dictionary} = Same keys, Tree_scanner as values
+        self.saved_state {Saved_state} = Saved state of last sync (see db_helpers)
+        self.workers {int} = Number of transfer workers
+        self.kinds {dictionary} = Relative dir as key and "mutual", "skip" or
+            ("new", side) as value. Undecided dirs are missing
+        self.sub_dirs {dictionary} = Side as key, {relative dir: sub dirs} as value
+        self.pending {dictionary} = (sync_dict key, worker) as key and
+            Transfer_batch not yet sent as value
+        self.transferred {dictionary} = sync_dict key as key and tuple (paths,
+            succeeded) of sets of relative paths as value
+    """
+
+    def __init__(self, source, target, src_scanner, tar_scanner, saved_state, workers,
+                 transfer_backend, print_output, stream_output, metrics, verify_content=False,
+                 delta_min_size=0):
+        self.roots = {"source": source, "target": target}
+        self.scanners = {"source": src_scanner, "target": tar_scanner}
+        self.saved_state = saved_state
+        self.workers = max(1, workers)
+        self.transfer_backend = transfer_backend
+        self.print_output = print_output
+        self.stream_output = stream_output
+        self.metrics = metrics
+        self.verify_content = verify_content
+        self.delta_min_size = delta_min_size
+        self.kinds = {".": "mutual"}
+        self.sub_dirs = {"source": {}, "target": {}}
+        self.decided = set()
+        self.pending = {}
+        self.transferred = {}
+        self.queues = [Queue(maxsize=QUEUE_DEPTH) for _ in range(self.workers)]
+        self.busy = [False] * self.workers
+        self.__lock = threading.Lock()
+        self.__start = None
+
+    def __repr__(self):
+        return f"Pipeline(workers: {self.workers}, decided dirs: {len(self.decided)})"
+
+    def run(self, scan_workers=DEFAULT_SCAN_WORKERS, on_listing=None):
+        """Scans source and target and transfers while scanning. Returns when
+        every batch is transferred. on_listing is optional and also called for
+        every listed dir (see scan_trees).
+
+        Returns:
+            {list}: Tree_index of source and target (see scan_trees).
+        """
+        self.__start = perf_counter()
+        threads = [threading.Thread(target=self.__work, args=(worker,), daemon=True)
+                   for worker in range(self.workers)]
+        for thread in threads:
+            thread.start()
+
+        def listed(scanner, basedir, sub_dirs):
+            self.on_listing(scanner, basedir, sub_dirs)
+            on_listing(scanner, basedir, sub_dirs)
+
+        scanned = False
+        try:
+            with self.metrics.timer("scan"):
+                indexes = scan_trees([self.scanners["source"], self.scanners["target"]],
+                                     scan_workers, listed if on_listing else self.on_listing)
+            scanned = True
+        finally:
+            # Transfers still running when the scan is done
+            with self.metrics.timer("pipeline_drain"):
+                if scanned:
+                    for key, worker in list(self.pending):
+                        self.__flush(key, worker)
+                for queue in self.queues:
+                    queue.put(None)
+                for thread in threads:
+                    thread.join()
+
+        LOGGER.debug(f"Pipeline decided {len(self.decided)} dirs while scanning, transferred "
+                     f"{sum(len(paths) for paths, _ in self.transferred.values())} items")
+        return indexes
+
+    def on_listing(self, scanner, basedir, sub_dirs):
+        """Called by scan_trees (in the thread running run) for every listed dir."""
+        side = "source" if scanner is self.scanners["source"] else "target"
+        self.sub_dirs[side][basedir] = sub_dirs
+        self.__decide(basedir)
+        # Full batches are sent, and anything pending to a worker with nothing to do
+        for key, worker in list(self.pending):
+            if (len(self.pending[(key, worker)].paths) >= PIPELINE_BATCH_SIZE or
+                    (not self.busy[worker] and self.queues[worker].empty())):
+                self.__flush(key, worker)
+
+    def __decide(self, rel_dir):
+        # Decides rel_dir if its kind and the listings it needs are known, then
+        # the sub dirs whose listings arrived before rel_dir was decided
+        stack = [rel_dir]
+        while stack:
+            rel_dir = stack.pop()
+            kind = self.kinds.get(rel_dir)
+            if kind is None or kind == "skip" or rel_dir in self.decided:
+                continue
+            if kind == "mutual":
+                if not (rel_dir in self.sub_dirs["source"] and rel_dir in self.sub_dirs["target"]):
+                    continue
+                children = self.__decide_mutual(rel_dir)
+            else:
+                side = kind[1]
+                if not rel_dir in self.sub_dirs[side]:
+                    continue
+                children = self.__decide_new(rel_dir, side)
+            self.decided.add(rel_dir)
+            stack.extend(children)
+
+    def __decide_mutual(self, rel_dir):
+        # Same rules as Syncer.decide_sync_actions for a dir existing on both sides
+        src, tar = self.scanners["source"].index, self.scanners["target"].index
+        src_first, src_end = src.dir_range(src.dir_ids[rel_dir])
+        tar_first, tar_end = tar.dir_range(tar.dir_ids[rel_dir])
+        sub_names = {side: {os.path.basename(sub_dir) for sub_dir in self.sub_dirs[side][rel_dir]}
+                     for side in ("source", "target")}
+
+        exclusive = [] # (side, index, position)
+        i, j = src_first, tar_first
+        while i < src_end and j < tar_end:
+            src_name, tar_name = src.names[i], tar.names[j]
+            if src_name == tar_name:
+                if src.mtime_ns[i] != tar.mtime_ns[j]:
+                    self.__update(rel_dir, i, j)
+                i += 1
+                j += 1
+            elif src_name < tar_name:
+                exclusive.append(("source", src, i))
+                i += 1
+            else:
+                exclusive.append(("target", tar, j))
+                j += 1
+        exclusive.extend(("source", src, position) for position in range(i, src_end))
+        exclusive.extend(("target", tar, position) for position in range(j, tar_end))
+
+        if exclusive:
+            saved_files = self.saved_state.get(rel_dir, set())
+            for side, index, position in exclusive:
+                name = index.names[position]
+                other_sub_names = sub_names["target" if side == "source" else "source"]
+                # A dir on the other side (double) or deleted there since last sync
+                if name in other_sub_names or name in saved_files:
+                    continue
+                self.__queue(ADD_KEYS[side], join_rel(rel_dir, name), rel_dir,
+                             self.__file_size(index, position))
+
+        file_names = {"source": set(src.names[src_first:src_end]),
+                      "target": set(tar.names[tar_first:tar_end])}
+        children = []
+        for side, other in (("source", "target"), ("target", "source")):
+            for name in sub_names[side]:
+                sub_dir = join_rel(rel_dir, name)
+                if name in sub_names[other]:
+                    if side == "target":
+                        continue # Already added as source sub dir
+                    self.kinds[sub_dir] = "mutual"
+                elif name in file_names[other] or sub_dir in self.saved_state:
+                    self.kinds[sub_dir] = "skip"
+                else:
+                    self.kinds[sub_dir] = ("new", side)
+                    self.__queue(ADD_KEYS[side], sub_dir, sub_dir, 0)
+                children.append(sub_dir)
+        return children
+
+    def __decide_new(self, rel_dir, side):
+        # Everything in a dir new since last sync is added to the other side
+        index = self.scanners[side].index
+        first, end = index.dir_range(index.dir_ids[rel_dir])
+        for position in range(first, end):
+            self.__queue(ADD_KEYS[side], join_rel(rel_dir, index.names[position]), rel_dir,
+                         self.__file_size(index, position))
+
+        children = []
+        for sub_dir in self.sub_dirs[side][rel_dir]:
+            if sub_dir in self.saved_state:
+                # Syncer decides every dir on its own
+                self.kinds[sub_dir] = "skip"
+            else:
+                self.kinds[sub_dir] = ("new", side)
+                self.__queue(ADD_KEYS[side], sub_dir, sub_dir, 0)
+            children.append(sub_dir)
+        return children
+
+    def __update(self, rel_dir, src_pos, tar_pos):
+        src, tar = self.scanners["source"].index, self.scanners["target"].index
+        both_regular = stat.S_ISREG(src.mode[src_pos]) and stat.S_ISREG(tar.mode[tar_pos])
+        if self.verify_content and both_regular and src.size[src_pos] == tar.size[tar_pos]:
+            return # Compared by content by Syncer
+
+        side = "source" if src.mtime_ns[src_pos] > tar.mtime_ns[tar_pos] else "target"
+        index, position = (src, src_pos) if side == "source" else (tar, tar_pos)
+        size = self.__file_size(index, position)
+        if self.delta_min_size and both_regular and size >= self.delta_min_size:
+            return # Delta update by Syncer
+        self.__queue(UPDATE_KEYS[side], join_rel(rel_dir, src.names[src_pos]), rel_dir, size)
+
+    def __file_size(self, index, position):
+        return index.size[position] if stat.S_ISREG(index.mode[position]) else 0
+
+    def __queue(self, key, rel_path, group, size):
+        # Everything of a group (a dir) goes to the same worker. A new dir is in
+        # its own group, so it is transferred before its contents.
+        worker = hash(group) % self.workers
+        batch = self.pending.get((key, worker))
+        if batch is None:
+            batch = self.pending[(key, worker)] = Transfer_batch(key)
+        batch.paths.append(rel_path)
+        batch.size += size
+
+    def __flush(self, key, worker):
+        batch = self.pending.pop((key, worker))
+        if self.__start is not None:
+            self.metrics.add_time("first_transfer", perf_counter() - self.__start)
+            self.__start = None
+        # Blocks while the worker's queue is full
+        self.queues[worker].put(batch)
+
+    def __work(self, worker):
+        """Runs in a transfer worker thread until it gets None."""
+        engine = Native_transfer(1, False, self.print_output) if self.transfer_backend == "native" else None
+        queue = self.queues[worker]
+        while True:
+            batch = queue.get()
+            if batch is None:
+                break
+            self.busy[worker] = True
+            try:
+                succeeded = self.__transfer(batch, engine)
+            except Exception as error:
+                LOGGER.exception(f"Transfer of {batch} failed: {error}")
+                self.metrics.error("transfer")
+                succeeded = []
+            finally:
+                self.busy[worker] = False
+            with self.__lock:
+                paths, done = self.transferred.setdefault(batch.key, (set(), set()))
+                paths.update(batch.paths)
+                done.update(succeeded)
+
+        if engine:
+            self.metrics.add("bytes_transferred", engine.bytes_copied)
+            self.metrics.add("bytes_written", engine.bytes_copied)
+
+    def __transfer(self, batch, engine):
+        if batch.key in ("upd_lr", "add_to_tar"):
+            sender, receiver = self.roots["source"], self.roots["target"]
+        else:
+            sender, receiver = self.roots["target"], self.roots["source"]
+
+        if engine:
+            _, succeeded = engine.run(batch.paths, sender, receiver)
+            if len(succeeded) < len(batch.paths):
+                self.metrics.error("transfer", len(batch.paths) - len(succeeded))
+        else:
+            return_code, succeeded = rsync_runner.run_rsync(rsync_runner.TRANSFER_ARGLIST, batch.paths,
+                                                            sender, receiver, self.print_output,
+                                                            self.stream_output, self.metrics)
+            if len(succeeded) == len(batch.paths):
+                self.metrics.add("bytes_transferred", batch.size)
+            else:
+                self.metrics.error("transfer", len(batch.paths) - len(succeeded))
+                LOGGER.error(f"rsync returned {return_code}. {len(batch.paths) - len(succeeded)} "
+                             f"of {len(batch.paths)} items are left out of saved state.")
+        self.metrics.add("items_transferred", len(succeeded))
+        return succeeded
@@ -0,0 +1,184 @@
+"""This module contains the profiling mode of a sync run (--profile).
+
+A Profiler records three things while a folder pair is synced:
+
+- CPU: a cProfile of the thread running the sync. Worker threads (scanning,
+  rsync and copy threads) aren't profiled, their time shows up as waiting in
+  scan_trees and the transfer functions. The raw pstats dump can be opened
+  with python -m pstats or snakeviz.
+- Memory: tracemalloc is running during the whole sync. For every phase timed
+  with Metrics_registry.timer (see metrics.py) the peak of traced memory and
+  the lines that allocated most during the phase are recorded.
+- Scan cost: the time spent listing and lstat'ing each dir (see scan_trees in
+  scanner.py) and its number of entries, summed up per subtree. The subtrees
+  ranked first are the ones to exclude or split into folder pairs of their
+  own (Lightroom previews, caches, node_modules...).
+
+tracemalloc makes the sync a few times slower, so timers of a profiled run
+are only comparable with each other. Reports are written to a dir of their
+own per run under .folder_sync_config/profiles.
+"""
+import cProfile
+import logging
+import os
+import pstats
+import tracemalloc
+from time import perf_counter, strftime
+from db_helpers import SCRIPT_PATH
+from helpers import format_size
+
+LOGGER = logging.getLogger(__name__)
+
+PROFILES_PATH = SCRIPT_PATH / ".folder_sync_config" / "profiles"
+
+# Frames kept per allocation, more frames give better tracebacks but cost more
+TRACE_FRAMES = 1
+TOP_FUNCTIONS = 40
+TOP_ALLOCATIONS = 10
+TOP_DIRS = 25
+
+
+class Profiler:
+    """
+    Summary:
+        Profiles one sync run. start() before the sync, stop() when it is done
+        (also when it failed), which writes the reports.
+
+    Properties:
+        self.profile_dir {Path} = Dir the reports are written to
+        self.cpu {Profile} = cProfile of the thread calling start
+        self.phases {list} = Tuples (phase, seconds, peak, top_allocations) in
+            the order the phases ended. peak is bytes, top_allocations a list of
+            tracemalloc StatisticDiff
+        self.scanners {list} = Tree_scanner instances whose dir costs are
+            reported (see watch_scanners)
+    """
+
+    def __init__(self, folder_pair_id, profiles_path=PROFILES_PATH):
+        self.profile_dir = profiles_path / f"pair_{folder_pair_id}_{strftime('%Y%m%d_%H%M%S')}"
+        self.cpu = cProfile.Profile()
+        self.phases = []
+        self.scanners = []
+        self.__open_phases = []
+
+    def __repr__(self):
+        return f"Profiler({self.profile_dir})"
+
+    def start(self):
+        tracemalloc.start(TRACE_FRAMES)
+        self.cpu.enable()
+
+    def stop(self):
+        """Stops profiling and writes the reports.
+
+        Returns:
+            {Path}: Dir with the reports. None if they couldn't be written.
+        """
+        self.cpu.disable()
+        tracemalloc.stop()
+        try:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            self.cpu.dump_stats(self.profile_dir / "cpu.pstats")
+            with open(self.profile_dir / "cpu.txt", "w") as report:
+                stats = pstats.Stats(self.cpu, stream=report)
+                stats.sort_stats("cumulative").print_stats(TOP_FUNCTIONS)
+                stats.sort_stats("tottime").print_stats(TOP_FUNCTIONS)
+            with open(self.profile_dir / "memory.txt", "w") as report:
+                report.write(self.format_phases())
+            with open(self.profile_dir / "scan_dirs.txt", "w") as report:
+                report.write(self.format_scan_costs())
+        except OSError as error:
+            LOGGER.error(f"Couldn't write profile to {self.profile_dir}: {error}")
+            return None
+        LOGGER.info(f"Profile written to {self.profile_dir}")
+        return self.profile_dir
+
+    def start_phase(self, phase):
+        # Called by Metrics_registry.timer before the phase is timed
+        if not tracemalloc.is_tracing():
+            return
+        self.cpu.disable()
+        tracemalloc.reset_peak()
+        self.__open_phases.append((phase, perf_counter(), take_snapshot()))
+        self.cpu.enable()
+
+    def end_phase(self, phase):
+        # Called by Metrics_registry.timer after the phase is timed
+        if not self.__open_phases or self.__open_phases[-1][0] != phase:
+            return
+        self.cpu.disable()
+        _, start, start_snapshot = self.__open_phases.pop()
+        seconds = perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        top = [diff for diff in take_snapshot().compare_to(start_snapshot, "lineno")
+               if diff.size_diff > 0][:TOP_ALLOCATIONS]
+        self.phases.append((phase, seconds, peak, top))
+        self.cpu.enable()
+
+    def watch_scanners(self, scanners):
+        """Records the cost of every dir scanned by scanners. Replaces the
+        scanners watched before (the last scan of a run is reported)."""
+        for scanner in scanners:
+            scanner.dir_costs = []
+        self.scanners = list(scanners)
+
+    def format_phases(self):
+        lines = ["Peak of traced memory and top allocating lines per phase",
+                 "(seconds include tracemalloc overhead)", ""]
+        for phase, seconds, peak, top in self.phases:
+            lines.append(f"{phase}: {seconds:.3f} s, peak {format_size(peak)}")
+            for diff in top:
+                frame = diff.traceback[0]
+                lines.append(f"    {format_size(diff.size_diff):>10} {diff.count_diff:>+9} blocks  "
+                             f"{frame.filename}:{frame.lineno}")
+            lines.append("")
+        return "\n".join(lines)
+
+    def format_scan_costs(self):
+        lines = []
+        for scanner in self.scanners:
+            subtrees = subtree_costs(scanner.dir_costs)
+            total_seconds, total_entries = subtrees.get(".", (0, 0, 0, 0))[:2]
+            lines += [f"{scanner.top_dir}: {len(scanner.dir_costs)} dirs, {total_entries} entries, "
+                      f"{total_seconds:.3f} s listing and lstat'ing (summed over scan workers)", ""]
+            subtrees.pop(".", None)
+            for title, key in (("Subtrees by scan time", 0), ("Subtrees by entries", 1)):
+                lines.append(f"{title}:")
+                lines.append(f"{'seconds':>9} {'entries':>9} {'own s':>9} {'own entries':>12}  dir")
+                ranked = sorted(subtrees.items(), key=lambda item: item[1][key], reverse=True)
+                for rel_dir, (seconds, entries, own_seconds, own_entries) in ranked[:TOP_DIRS]:
+                    lines.append(f"{seconds:>9.3f} {entries:>9} {own_seconds:>9.3f} {own_entries:>12}  {rel_dir}")
+                lines.append("")
+        return "\n".join(lines)
+
+
+def take_snapshot():
+    # Allocations of tracemalloc and the profiler itself are left out
+    return tracemalloc.take_snapshot().filter_traces(
+        (tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)))
+
+
+def subtree_costs(dir_costs):
+    """Sums up the cost of each dir with the costs of the dirs below it.
+
+    Args:
+        dir_costs {list}: Tuples (rel_dir, seconds, entries) of scanned dirs.
+
+    Returns:
+        {dictionary}: Relative dir as key and (seconds, entries, own_seconds,
+        own_entries) as value.
+    """
+    totals = {}
+    for rel_dir, seconds, entries in dir_costs:
+        own = totals.setdefault(rel_dir, [0, 0, 0, 0])
+        own[2] += seconds
+        own[3] += entries
+        a_dir = rel_dir
+        while True:
+            total = totals.setdefault(a_dir, [0, 0, 0, 0])
+            total[0] += seconds
+            total[1] += entries
+            if a_dir == ".":
+                break
+            a_dir = os.path.dirname(a_dir) or "."
+    return {rel_dir: tuple(costs) for rel_dir, costs in totals.items()}
@@ -0,0 +1,366 @@
+"""This module runs rsync as subprocess for Syncer.
+
+File lists are fed to rsync over stdin (--files-from=- with --from0) instead of
+temporary textfiles. Large lists are split into shards that several rsync
+processes run concurrently.
+
+Output of --itemize-changes is parsed into Itemized records in one pass (see
+parse_itemize_line). The records drive both the display and the result of a
+call: rsync is run with -ii so every path gets a record (unchanged ones too),
+and error messages on stderr are mapped back to the paths they name. When
+rsync only partly succeeds (returncode 23 or 24) the paths that were
+itemized and have no error are still reported as transferred, so one failing
+file doesn't keep the whole shard out of the saved state.
+
+In streaming mode output is read line by line while rsync runs. Each line is
+parsed, printed and counted at once, so memory use doesn't grow with the
+number of transferred files and output shows up immediately.
+"""
+import heapq
+import logging
+import os
+import re
+import subprocess
+import threading
+from collections import deque, namedtuple
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_RSYNC_WORKERS = 4
+# Lists shorter than this are never split (process startup isn't worth it)
+MIN_SHARD_SIZE = 1000
+
+ALREADY_SYNCED = 50
+# Some files weren't transferred (23) or vanished on the sending side (24)
+PARTIAL_RETURNCODES = (23, 24)
+
+# Arguments of transfers run by Syncer and Pipeline. -ii itemizes unchanged
+# paths too, so every path of the list gets a record.
+TRANSFER_ARGLIST = ["rsync", "-a", "-ii"]
+
+# Output from concurrent rsync processes is printed one process at a time
+OUTPUT_LOCK = threading.Lock()
+
+# One line of --itemize-changes output (see parse_itemize_line)
+Itemized = namedtuple("Itemized", ["update", "file_type", "attrs", "path", "name", "category", "line"])
+
+ITEMIZE_UPDATES = "<>ch."
+QUOTED = re.compile(r'"([^"]*)"')
+# Temporary file rsync writes before renaming it into place (.name.XXXXXX)
+TEMP_NAME = re.compile(r"^\.(.+)\.[A-Za-z0-9]{6}$")
+
+
+def parse_itemize_line(line):
+    """Parses one line of rsync --itemize-changes output.
+
+    Returns:
+        {Itemized}: update is the first letter of the change string (<, > or h
+        when data is transferred, c when created locally, . when unchanged),
+        file_type the second (f, d, L, D or S) and attrs the rest. path is
+        relative, without " -> target" of symlinks and the trailing "/" of
+        dirs. name is the rest of the line as printed. category is "created",
+        "modified", "unchanged" or "message" (everything else, ie "*deleting",
+        with path None).
+    """
+    if len(line) > 12 and line[11] == " ":
+        # Change string has 11 letters. Unchanged attributes can be spaces.
+        changes, name = line[:11], line[12:]
+    else:
+        # Older rsync versions (shorter change string)
+        changes, _, name = line.partition(" ")
+    if len(changes) < 2 or not name or not changes[0] in ITEMIZE_UPDATES:
+        return Itemized(changes[:1], "", "", None, None, "message", line)
+
+    update, file_type, attrs = changes[0], changes[1], changes[2:]
+    path = name
+    if file_type == "L":
+        path = path.partition(" -> ")[0]
+    elif update == "h":
+        path = path.partition(" => ")[0]
+    if path.endswith("/") and len(path) > 1:
+        path = path[:-1]
+
+    if update == "<" or update == ">":
+        category = "created" if attrs and not attrs.strip("+") else "modified"
+    elif update == "c" or update == "h":
+        category = "created"
+    else:
+        category = "unchanged"
+    return Itemized(update, file_type, attrs, path, name, category, line)
+
+
+def error_paths(line, roots):
+    """Returns relative paths named (quoted) in an rsync error line. Paths
+    below one of roots (sending and receiving side) are made relative and
+    temporary files are mapped to the file they were written for."""
+    rel_paths = []
+    for quoted in QUOTED.findall(line):
+        for root in roots:
+            if quoted.startswith(root):
+                quoted = quoted[len(root):]
+                break
+        else:
+            if os.path.isabs(quoted):
+                continue
+        dir, name = os.path.split(quoted.rstrip("/"))
+        match = TEMP_NAME.match(name)
+        if match:
+            name = match.group(1)
+        if name:
+            rel_paths.append(os.path.join(dir, name) if dir else name)
+    return rel_paths
+
+
+class Rsync_summary:
+    """
+    Summary:
+        What an rsync call reported. With roots the itemized paths and the
+        paths named in error lines are kept, to tell which paths of the call
+        were transferred (see succeeded).
+
+    Properties:
+        self.roots {tuple} = Sending and receiving side (with trailing separator)
+            or None if paths aren't kept
+        self.lines {int} = Number of lines read from stdout
+        self.created, self.modified, self.messages {int} = Lines per category
+            (see parse_itemize_line)
+        self.errors {int} = Number of lines read from stderr
+        self.last_errors {deque} = The last MAX_KEPT_ERRORS lines from stderr
+        self.itemized {set} = Relative paths with a record (if roots)
+        self.failed {set} = Relative paths named in error lines (if roots)
+        self.unmatched_errors {int} = Error lines naming no path (if roots)
+    """
+    MAX_KEPT_ERRORS = 50
+
+    __slots__ = ["roots", "lines", "created", "modified", "messages", "errors", "last_errors",
+                 "itemized", "failed", "unmatched_errors"]
+
+    def __init__(self, roots=None):
+        self.roots = tuple(root.rstrip(os.path.sep) + os.path.sep for root in roots) if roots else None
+        self.lines = 0
+        self.created = 0
+        self.modified = 0
+        self.messages = 0
+        self.errors = 0
+        self.last_errors = deque(maxlen=self.MAX_KEPT_ERRORS)
+        self.itemized = set()
+        self.failed = set()
+        self.unmatched_errors = 0
+
+    def __repr__(self):
+        return (f"Rsync_summary(created: {self.created}, modified: {self.modified}, "
+                f"messages: {self.messages}, errors: {self.errors})")
+
+    def changes(self):
+        # Lines reporting that something was done (not unchanged paths)
+        return self.created + self.modified + self.messages
+
+    def add_item(self, item):
+        self.lines += 1
+        if item.category == "created":
+            self.created += 1
+        elif item.category == "modified":
+            self.modified += 1
+        elif item.category == "message":
+            self.messages += 1
+        if self.roots and item.path is not None:
+            self.itemized.add(item.path)
+
+    def add_error(self, line):
+        self.errors += 1
+        self.last_errors.append(line)
+        if not self.roots:
+            return
+        rel_paths = error_paths(line, self.roots)
+        if rel_paths:
+            self.failed.update(rel_paths)
+        elif not line.startswith("rsync error:"): # Summary line of the returncode
+            self.unmatched_errors += 1
+
+    def succeeded(self, paths, returncode):
+        """Returns the paths (of the call) that were transferred. All of them
+        if rsync succeeded. If it partly succeeded, the itemized paths that
+        (with their parent dirs) aren't named in an error line, unless an
+        error couldn't be mapped to a path. None of them otherwise."""
+        if returncode in (0, ALREADY_SYNCED):
+            return list(paths)
+        if not returncode in PARTIAL_RETURNCODES or self.unmatched_errors or not self.roots:
+            return []
+
+        def failed(rel_path):
+            while rel_path:
+                if rel_path in self.failed:
+                    return True
+                rel_path = os.path.dirname(rel_path)
+            return False
+
+        return [rel_path for rel_path in paths
+                if rel_path in self.itemized and not (self.failed and failed(rel_path))]
+
+
+def stream_rsync(arglist, paths=None, print_output=True, roots=None):
+    """Runs rsync with a complete arglist and handles output line by line as
+    it arrives. If paths is given it is written to stdin from a separate thread
+    (use with --files-from=- --from0). stderr is drained by another thread
+    so rsync never blocks on a full pipe. roots (sending and receiving side)
+    are passed to Rsync_summary.
+
+    Returns:
+        {tuple}: (returncode, Rsync_summary)
+    """
+    # helpers imports this module, hence the late import
+    from helpers import format_itemized
+    summary = Rsync_summary(roots)
+    stdin = subprocess.PIPE if paths is not None else subprocess.DEVNULL
+    process = subprocess.Popen(arglist, stdin=stdin, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE, text=True, bufsize=1)
+
+    def write_paths():
+        try:
+            for path in paths:
+                process.stdin.write(path + "\0")
+        except BrokenPipeError:
+            pass # rsync exited early. Error is reported by rsync itself.
+        finally:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    def read_errors():
+        for line in process.stderr:
+            line = line.rstrip("\n")
+            with OUTPUT_LOCK:
+                summary.add_error(line)
+                # TODO maybe write to logfile if print_output=False
+                print(line)
+
+    threads = [threading.Thread(target=read_errors, daemon=True)]
+    if paths is not None:
+        threads.append(threading.Thread(target=write_paths, daemon=True))
+    for thread in threads:
+        thread.start()
+
+    for line in process.stdout:
+        item = parse_itemize_line(line.rstrip("\n"))
+        summary.add_item(item)
+        formatted = format_itemized(item)
+        if formatted and print_output:
+            with OUTPUT_LOCK:
+                print(formatted[1])
+
+    returncode = process.wait()
+    for thread in threads:
+        thread.join()
+    return returncode, summary
+
+
+def run_rsync(initial_arglist, paths, source, target, print_output=True, stream_output=False,
+              metrics=None):
+    """Calls rsync once with paths passed over stdin.
+
+    Args:
+        initial_arglist {list}: list of args for rsync call (without paths)
+        paths {list}: paths relative to source to sync
+        source {string}: string corresponding to rsync source
+        target {string}: string corresponding to rsync target
+        print_output {boolean}: Wether to print any output or not
+        stream_output {boolean}: Handle output line by line (see stream_rsync)
+        metrics {Metrics_registry}: Optional. Counts rsync calls and output (see metrics.py)
+
+    Returns:
+        {tuple}: (returncode, succeeded) where returncode is from rsync
+        (ALREADY_SYNCED (50) if nothing was done) and succeeded {list} contains
+        the paths that were transferred (see Rsync_summary.succeeded).
+    """
+    if not paths:
+        return ALREADY_SYNCED, []
+
+    arglist = initial_arglist + ["--files-from=-", "--from0", source, target]
+    if metrics:
+        metrics.add("rsync_calls")
+
+    if stream_output:
+        returncode, summary = stream_rsync(arglist, paths, print_output, (source, target))
+    else:
+        obj_return = subprocess.run(arglist, input="\0".join(paths), text=True, capture_output=True)
+        returncode = obj_return.returncode
+        summary = Rsync_summary((source, target))
+        items = [parse_itemize_line(line) for line in obj_return.stdout.splitlines()]
+        for item in items:
+            summary.add_item(item)
+        for line in obj_return.stderr.splitlines():
+            summary.add_error(line)
+
+        from helpers import format_itemized_output
+        with OUTPUT_LOCK:
+            if print_output and summary.changes():
+                print(format_itemized_output(items))
+            if obj_return.stderr:
+                # TODO maybe write to logfile if print_output=False
+                print(obj_return.stderr)
+
+    if metrics:
+        metrics.add("rsync_output_lines", summary.lines)
+        metrics.add("rsync_error_lines", summary.errors)
+    if not summary.changes() and not summary.errors and returncode == 0:
+        return ALREADY_SYNCED, list(paths)
+    if not returncode == 0:
+        with OUTPUT_LOCK:
+            print("Something went wrong in rsync call!")
+    return returncode, summary.succeeded(paths, returncode)
+
+
+def create_shards(paths, new_dirs=(), shard_count=DEFAULT_RSYNC_WORKERS):
+    """Splits paths into at most shard_count lists of roughly equal length.
+
+    A new dir (one that doesn't exist on the receiving side yet) is always
+    put in the same shard as everything below it, so that two rsync processes
+    never create the same dir. Other paths are grouped by parent dir.
+
+    Args:
+        paths {iterable}: Relative paths (strings).
+        new_dirs {set}: Relative paths of dirs in paths that are new.
+        shard_count {int}: Max number of shards.
+
+    Returns:
+        {list}: List of lists of paths. Empty list if paths is empty.
+    """
+    paths = list(paths)
+    shard_count = min(shard_count, -(-len(paths) // MIN_SHARD_SIZE))
+    if shard_count <= 1:
+        return [paths] if paths else []
+
+    groups = {}
+    for path in paths:
+        key = os.path.dirname(path)
+        # Topmost new dir containing path (or path itself) decides the group
+        parts = path.split(os.path.sep)
+        for index in range(1, len(parts) + 1):
+            ancestor = os.path.sep.join(parts[:index])
+            if ancestor in new_dirs:
+                key = ancestor
+                break
+        groups.setdefault(key, []).append(path)
+
+    # Largest groups first, each to the currently smallest shard
+    shards = [[] for _ in range(shard_count)]
+    heap = [(0, index) for index in range(shard_count)]
+    for group in sorted(groups.values(), key=len, reverse=True):
+        size, index = heapq.heappop(heap)
+        shards[index].extend(group)
+        heapq.heappush(heap, (size + len(group), index))
+
+    return [shard for shard in shards if shard]
+
+
+def aggregate_returncodes(returncodes):
+    """Combines returncodes of the shards of one list into one returncode.
+    0 if every shard succeeded, ALREADY_SYNCED if nothing was done (or there
+    were no shards) and otherwise the first error code."""
+    errors = [code for code in returncodes if code not in (0, ALREADY_SYNCED)]
+    if errors:
+        return errors[0]
+    if 0 in returncodes:
+        return 0
+    return ALREADY_SYNCED
@@ -0,0 +1,196 @@
+"""This module contains the parallel tree scanner that creates the Tree_index
+(see tree_index.py) of a directory tree.
+
+Directory listings are fanned out over a thread pool so that stat latency
+(network shares, usb disks, huge Lightroom preview folders) overlaps instead of
+adding up. Several trees (normally source and target) can share one pool and
+are then scanned at the same time.
+
+Directories whose metadata (mtime, ctime and inode) is unchanged since the
+previous scan reuse the listing saved in the dir_cache instead of being listed
+again. Adding, removing or renaming an entry always updates the mtime and ctime
+of the parent dir, so the cached listing is still valid for those directories.
+
+Listing and lstat go through the filesystem of the scanner (the real disk
+unless another one is given, see filesystem.py).
+"""
+import os
+import logging
+from time import time_ns, perf_counter
+from queue import SimpleQueue
+from concurrent.futures import ThreadPoolExecutor
+from tree_index import Tree_index, Entry_stat
+from filesystem import LOCAL_FILESYSTEM, scan_dir
+
+LOGGER = logging.getLogger(__name__)
+DEFAULT_SCAN_WORKERS = 8
+
+# Directories modified this close to the scan could be modified again within
+# the timestamp granularity of the filesystem (2 seconds on FAT) without the
+# mtime changing. They are therefore never cached.
+RACY_WINDOW_NS = 2 * 10**9
+
+
+class Tree_scanner:
+    """
+    Summary:
+        Holds input and result of the scan of one directory tree. Run one or
+        more instances with scan_trees.
+
+    Properties:
+        self.top_dir {string} = Absolute path to top directory
+        self.excl_obj {Excluder} = Excluder instance (see helpers) or None
+        self.old_cache {dictionary} = dir_cache from previous scan (can be empty)
+        self.index {Tree_index} = Result, names and metadata of all non
+            excluded files per dir (see tree_index.py)
+        self.dir_cache {dictionary} = New cache. Relative dir as key and
+            [mtime_ns, ctime_ns, inode, files, dirs] as value. Listings are
+            stored before excludes are applied.
+        self.cached_dirs {int} = Number of dirs whose cached listing was reused
+        self.fs {object} = Filesystem the tree is on (see filesystem.py)
+        self.dir_costs {list} = None unless profiled (see profiler.py). Tuples
+            (rel_dir, seconds, entries) of each dir listed by scan_trees
+    """
+
+    def __init__(self, top_dir, excl_obj=None, dir_cache=None, filesystem=LOCAL_FILESYSTEM):
+        self.top_dir = os.path.abspath(top_dir)
+        self.excl_obj = excl_obj
+        self.old_cache = dir_cache if dir_cache else {}
+        self.index = Tree_index()
+        self.dir_cache = {}
+        self.cached_dirs = 0
+        self.dir_costs = None
+        self.fs = filesystem
+        self.scan_start = time_ns()
+
+    def __repr__(self):
+        return f"Tree_scanner({self.top_dir})"
+
+    def abs_path(self, basedir):
+        if basedir == ".":
+            return self.top_dir
+        return os.path.join(self.top_dir, basedir)
+
+    def list_dir(self, basedir):
+        """Lists basedir, applies file excludes and lstats the remaining files.
+        Runs in worker threads. Only reads self.old_cache and self.excl_obj
+        which are never modified during a scan.
+
+        Returns:
+            {tuple}: (file_stats, dirs, raw_listing, from_cache). file_stats {dictionary}
+            has an Entry_stat for each non excluded file (only kept until the
+            listing is added to the index). raw_listing is what is
+            stored in dir_cache. None if dir couldn't be listed.
+        """
+        abs_dir = self.abs_path(basedir)
+        try:
+            dir_stat = self.fs.lstat(abs_dir)
+            dir_meta = [dir_stat.st_mtime_ns, dir_stat.st_ctime_ns, dir_stat.st_ino]
+        except OSError:
+            dir_meta = None
+
+        cached = self.old_cache.get(basedir)
+        if dir_meta and cached and cached[:3] == dir_meta:
+            files, dirs, entries = cached[3], cached[4], None
+            from_cache = True
+        else:
+            listing = self.fs.scan_dir(abs_dir)
+            if listing is None:
+                return None
+            files, dirs, entries = listing
+            from_cache = False
+
+        excl_obj = self.excl_obj
+        if excl_obj:
+            file_set = excl_obj.get_non_excl_file_set(basedir, files)
+        else:
+            file_set = files
+
+        # Files removed since listing are left out, ie treated as never seen
+        file_stats = {name: Entry_stat(stat.st_size, stat.st_mtime_ns, stat.st_mode,
+                                       stat.st_ino, stat.st_dev)
+                      for name, stat in self.fs.lstat_files(abs_dir, file_set, entries).items()}
+
+        raw_listing = dir_meta + [files, dirs] if dir_meta else None
+        return file_stats, dirs, raw_listing, from_cache
+
+    def add_listing(self, basedir, listing):
+        """Adds listing of basedir to result and returns the subdirs to scan.
+        Only called from the thread running scan_trees.
+        """
+        file_stats, dirs, raw_listing, from_cache = listing
+
+        if from_cache:
+            self.cached_dirs += 1
+        if raw_listing and self.scan_start - raw_listing[0] > RACY_WINDOW_NS:
+            self.dir_cache[basedir] = raw_listing
+
+        self.index.add_dir(basedir, file_stats)
+        return self.sub_dirs(basedir, dirs)
+
+    def sub_dirs(self, basedir, dirs):
+        # Relative paths of the subdirs (names in dirs) of basedir to scan
+        excl_obj = self.excl_obj
+        sub_dirs = []
+        for a_dir in dirs:
+            sub_dir = a_dir if basedir == "." else os.path.join(basedir, a_dir)
+            # Excluded dirs are pruned, nothing below them is listed
+            if excl_obj and excl_obj.excludes(sub_dir):
+                continue
+            sub_dirs.append(sub_dir)
+        return sub_dirs
+
+
+def scan_trees(scanners, workers=DEFAULT_SCAN_WORKERS, on_listing=None):
+    """Scans one or more directory trees concurrently on a shared thread pool.
+
+    Args:
+        scanners {list}: List of Tree_scanner instances.
+        workers {int}: Number of threads listing directories.
+        on_listing {function}: Optional. Called as on_listing(scanner, basedir,
+        sub_dirs) in the calling thread when basedir has been added to the
+        index of scanner (see pipeline.py).
+
+    Returns:
+        {list}: One Tree_index per scanner (same order as scanners). Each
+        scanner also keeps its index and new dir_cache as properties.
+    """
+    results = SimpleQueue()
+
+    def list_dir(scanner, basedir):
+        start = perf_counter()
+        try:
+            listing = scanner.list_dir(basedir)
+        except Exception as error:
+            LOGGER.error(f"Unexpected error when scanning {scanner.abs_path(basedir)}: {error}")
+            listing = None
+        if scanner.dir_costs is not None:
+            entries = len(listing[0]) + len(listing[1]) if listing else 0
+            scanner.dir_costs.append((basedir, perf_counter() - start, entries))
+        results.put((scanner, basedir, listing))
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        outstanding = 0
+        for scanner in scanners:
+            executor.submit(list_dir, scanner, ".")
+            outstanding += 1
+
+        while outstanding:
+            scanner, basedir, listing = results.get()
+            outstanding -= 1
+            if listing is None:
+                continue
+
+            sub_dirs = scanner.add_listing(basedir, listing)
+            for sub_dir in sub_dirs:
+                executor.submit(list_dir, scanner, sub_dir)
+                outstanding += 1
+            if on_listing:
+                on_listing(scanner, basedir, sub_dirs)
+
+    for scanner in scanners:
+        if scanner.old_cache:
+            LOGGER.debug(f"Reused cached listing for {scanner.cached_dirs} of "
+                         f"{len(scanner.index)} dirs in {scanner.top_dir}")
+
+    return [scanner.index for scanner in scanners]
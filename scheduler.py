@@ -0,0 +1,201 @@
+"""This module syncs several registered folder pairs in one run (batch mode,
+folder_sync.py without source and target).
+
+Folder pairs are synced concurrently on a thread pool. How many pairs may use
+the same block device (st_dev of source and target dirs) at once is limited
+separately, so pairs on different disks run in parallel while pairs sharing a
+disk don't make it seek back and forth between them. A pair is started first
+when every device it uses has a free slot. Pairs are never interactive in
+batch mode and the run ends with a summary of all pairs.
+"""
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from time import perf_counter
+import db_helpers
+import sync_functions
+from helpers import format_size
+from scanner import DEFAULT_SCAN_WORKERS
+from rsync_runner import DEFAULT_RSYNC_WORKERS
+from transfer import DEFAULT_BACKEND
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_BATCH_WORKERS = 4
+DEFAULT_PAIRS_PER_DEVICE = 1
+
+
+class Pair_job:
+    """
+    Summary:
+        One folder pair of a batch run and its result.
+
+    Properties:
+        self.pair_id {int} = id in folder_pairs
+        self.source {string} = Source dir
+        self.target {string} = Target dir
+        self.devices {set} = st_dev of source and target. Empty if unavailable
+        self.status {string} = "pending", "ok", "failed" or "skipped"
+        self.message {string} = Reason when failed or skipped
+        self.duration {float} = Seconds spent syncing
+        self.metrics {dictionary} = Metrics of the run (see Metrics_registry.as_dict)
+    """
+
+    def __init__(self, pair_id, source, target):
+        self.pair_id = pair_id
+        self.source = source
+        self.target = target
+        self.devices = set()
+        self.status = "pending"
+        self.message = ""
+        self.duration = 0
+        self.metrics = None
+        try:
+            if not (os.path.isdir(source) and os.path.isdir(target)):
+                raise OSError("source or target isn't a directory")
+            self.devices = {os.stat(source).st_dev, os.stat(target).st_dev}
+        except OSError as error:
+            # Ie a disk that isn't mounted. Other pairs are synced anyway.
+            self.status = "skipped"
+            self.message = str(error)
+
+    def __repr__(self):
+        return f"Pair_job(id: {self.pair_id}, status: {self.status}, devices: {self.devices})"
+
+
+class Batch_scheduler:
+    """
+    Summary:
+        Syncs jobs (Pair_job objects) with at most workers pairs at a time
+        and at most per_device pairs using the same block device at a time.
+
+    Properties:
+        self.jobs {list} = Pair_job objects in the order they were registered
+        self.workers {int} = Max number of pairs synced concurrently
+        self.per_device {int} = Max number of concurrent pairs per device
+        self.sync_kwargs {dictionary} = Keyword arguments to two_way_sync
+        self.active {dictionary} = Device as key and number of running pairs as value
+    """
+
+    def __init__(self, jobs, workers=DEFAULT_BATCH_WORKERS, per_device=DEFAULT_PAIRS_PER_DEVICE,
+                 **sync_kwargs):
+        self.jobs = jobs
+        self.workers = max(1, workers)
+        self.per_device = max(1, per_device)
+        self.sync_kwargs = sync_kwargs
+        self.active = {}
+
+    def __repr__(self):
+        return f"Batch_scheduler(jobs: {len(self.jobs)}, workers: {self.workers}, per_device: {self.per_device})"
+
+    def can_start(self, job):
+        return all(self.active.get(dev, 0) < self.per_device for dev in job.devices)
+
+    def run(self):
+        """Syncs all pending jobs. Returns number of jobs not synced ok."""
+        pending = [job for job in self.jobs if job.status == "pending"]
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while pending or running:
+                # Pairs keep their order unless their devices are busy
+                for job in list(pending):
+                    if len(running) >= self.workers:
+                        break
+                    if self.can_start(job):
+                        pending.remove(job)
+                        for dev in job.devices:
+                            self.active[dev] = self.active.get(dev, 0) + 1
+                        running[executor.submit(self.sync_job, job)] = job
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = running.pop(future)
+                    for dev in job.devices:
+                        self.active[dev] -= 1
+                    self.finish_job(job, future)
+
+        return sum(1 for job in self.jobs if job.status != "ok")
+
+    def sync_job(self, job):
+        """Runs in a worker thread with its own database connection."""
+        LOGGER.info(f"Syncing folder pair {job.pair_id}: {job.source} <--> {job.target}")
+        start = perf_counter()
+        con, cur = db_helpers.connect_db()
+        try:
+            return sync_functions.two_way_sync(cur, job.pair_id, job.source, job.target,
+                                               interactive=False, **self.sync_kwargs)
+        finally:
+            con.close()
+            job.duration = perf_counter() - start
+
+    def finish_job(self, job, future):
+        try:
+            job.metrics = future.result()
+            if job.metrics and sum(job.metrics["errors"].values()):
+                job.status = "failed"
+                job.message = "errors: " + ", ".join(f"{phase} {count}" for phase, count
+                                                     in sorted(job.metrics["errors"].items()))
+            else:
+                job.status = "ok"
+        except SystemExit as exit_error:
+            # two_way_sync exits when a pair can't be synced (ie no saved state)
+            job.status = "failed"
+            job.message = f"exited with code {exit_error.code}"
+        except Exception as error:
+            LOGGER.exception(f"Sync of folder pair {job.pair_id} failed")
+            job.status = "failed"
+            job.message = f"{type(error).__name__}: {error}"
+
+
+def print_summary(jobs, duration):
+    print(f"\nBATCH SUMMARY ({len(jobs)} folder pairs in {duration:.1f} s)")
+    totals = {"files_scanned": 0, "items_transferred": 0, "bytes_transferred": 0}
+    for job in jobs:
+        counters = job.metrics["counters"] if job.metrics else {}
+        for name in totals:
+            totals[name] += counters.get(name, 0)
+        line = f"{job.pair_id:>4} {job.status:<7} {job.duration:>7.1f} s  {job.source} <--> {job.target}"
+        if job.metrics:
+            line += (f"\n{'':13}{counters.get('files_scanned', 0)} files scanned, "
+                     f"{counters.get('items_transferred', 0)} items transferred "
+                     f"({format_size(counters.get('bytes_transferred', 0))})")
+        if job.message:
+            line += f"\n{'':13}{job.message}"
+        print(line)
+
+    statuses = [job.status for job in jobs]
+    print(f"\nOk: {statuses.count('ok')}, failed: {statuses.count('failed')}, "
+          f"skipped: {statuses.count('skipped')}. {totals['files_scanned']} files scanned, "
+          f"{totals['items_transferred']} items transferred ({format_size(totals['bytes_transferred'])})")
+
+
+def batch_sync(cur, pair_ids=None, workers=DEFAULT_BATCH_WORKERS, per_device=DEFAULT_PAIRS_PER_DEVICE,
+               delete=False, dry_run=False, verbose=True, scan_workers=DEFAULT_SCAN_WORKERS,
+               rsync_workers=DEFAULT_RSYNC_WORKERS, stream_output=False,
+               transfer_backend=DEFAULT_BACKEND, verify_content=False, metrics_dir=None,
+               delta_min_size=0, pipeline=False):
+    """Syncs registered folder pairs (all or the ones in pair_ids) and prints
+    a summary. Returns number of pairs that failed or were skipped."""
+    folder_pairs = db_helpers.get_folder_pairs(cur, pair_ids)
+    if pair_ids is not None:
+        unknown = set(pair_ids) - {pair[0] for pair in folder_pairs}
+        if unknown:
+            print(f"No folder pairs with id: {', '.join(str(pair_id) for pair_id in sorted(unknown))}")
+            sys.exit(2)
+    if not folder_pairs:
+        print("No folder pairs registered. Run with source and target to add one!")
+        return 0
+
+    start = perf_counter()
+    jobs = [Pair_job(*pair) for pair in folder_pairs]
+    scheduler = Batch_scheduler(jobs, workers, per_device, delete=delete, dry_run=dry_run,
+                                verbose=verbose, scan_workers=scan_workers,
+                                rsync_workers=rsync_workers, stream_output=stream_output,
+                                transfer_backend=transfer_backend, verify_content=verify_content,
+                                metrics_dir=metrics_dir, delta_min_size=delta_min_size,
+                                pipeline=pipeline)
+    LOGGER.debug(f"{scheduler}, devices: {len(set().union(*(job.devices for job in jobs)))}")
+    failed = scheduler.run()
+    print_summary(jobs, perf_counter() - start)
+    return failed
@@ -1,8 +1,18 @@
 from time import time
 from helpers import *
-from db_helpers import save_folder_state
+from db_helpers import (save_folder_state, read_dir_cache, Saved_state, save_sync_run, add_folder_pair,
+                        replay_journal, clear_journal, read_dir_digests)
+from scanner import Tree_scanner, scan_trees, DEFAULT_SCAN_WORKERS
+from rsync_runner import DEFAULT_RSYNC_WORKERS
+from transfer import DEFAULT_BACKEND
+from filesystem import LOCAL_FILESYSTEM
+from content_hash import Hash_cache
+from delta import Signature_cache
+from pipeline import Pipeline
+from journal import Sync_journal
+from dir_digest import Digest_check, index_digests
+from metrics import Metrics_registry, write_prometheus_textfile
 import os
-import subprocess
 import logging
 import json
 
@@ -11,56 +21,285 @@ import json
 
 LOGGER = logging.getLogger(__name__)
 
-def two_way_sync(pair_id, source, target, delete, dry_run, verbose, interactive=True):
-
-    start_time = time()
+# Plans confirmed later than this (seconds) are checked with Syncer.stale_items
+STALE_PLAN_SECONDS = 60
+
+def two_way_sync(cur, pair_id, source, target, delete, dry_run, verbose, interactive=True,
+                scan_workers=DEFAULT_SCAN_WORKERS, rsync_workers=DEFAULT_RSYNC_WORKERS,
+                stream_output=False, transfer_backend=DEFAULT_BACKEND, verify_content=False,
+                metrics_dir=None, delta_min_size=0, pipeline=False, profiler=None,
+                on_synced=None, on_doubles=None):
+
+    # Timers, counters and errors of this run (saved in sync_runs, see metrics.py).
+    # A profiler (see profiler.py) is told when each phase starts and ends.
+    metrics = Metrics_registry(profiler)
+
+    # Only dir names are read here. Files are read by Syncer for the dirs it needs.
+    # A journal left by an interrupted sync is applied first (see journal.py).
+    with metrics.timer("state_load"):
+        replayed = replay_journal(cur, pair_id)
+        saved_state = Saved_state(cur, pair_id)
+    if replayed:
+        LOGGER.info(f"Resuming interrupted sync: {replayed} journaled changes applied to saved state")
+        metrics.add("journal_replayed", replayed)
+    if not saved_state:
+        LOGGER.critical("Couldn't read previous sync state")
+        LOGGER.critical(f"No saved state for folder pair {pair_id} in database")
+        print("\n")
+        sys.exit(1)
     
-    excl_src = Excluder.create_excluder(source, pair_id)
-    excl_tar = Excluder.create_excluder(target, pair_id)
+    with metrics.timer("excluder"):
+        excl_src = Excluder.create_excluder(source, pair_id)
+        excl_tar = Excluder.create_excluder(target, pair_id)
+    src_cache = read_dir_cache(cur, pair_id, "source")
+    tar_cache = read_dir_cache(cur, pair_id, "target")
+
+    # Pairs that didn't change since a sync that found nothing to do are done
+    # after the scan (see dir_digest.py)
+    saved_digests = [read_dir_digests(cur, pair_id, "source"), read_dir_digests(cur, pair_id, "target")]
+
+    # Mutual files with equal size but different mtime are compared by content
+    hash_cache = Hash_cache(cur, scan_workers) if verify_content else None
+    signature_cache = create_signature_cache(cur, transfer_backend, delta_min_size)
+    journal = Sync_journal(cur, pair_id) if not dry_run else None
+
+    def plan_sync(pipelined=False, check_digests=False):
+        # Returns Syncer None if check_digests and every dir matched its saved digest
+        src_scanner = Tree_scanner(source, excl_src, src_cache)
+        tar_scanner = Tree_scanner(target, excl_tar, tar_cache)
+        if profiler:
+            profiler.watch_scanners((src_scanner, tar_scanner))
+        digest_check = None
+        if check_digests and all(saved_digests):
+            digest_check = Digest_check((src_scanner, tar_scanner), saved_digests)
+        on_listing = digest_check.on_listing if digest_check else None
+        if pipelined:
+            # Updates and additions are transferred while scanning (see pipeline.py)
+            early = Pipeline(source, target, src_scanner, tar_scanner, saved_state, rsync_workers,
+                             transfer_backend, verbose, stream_output, metrics, verify_content,
+                             signature_cache.min_size if signature_cache else 0)
+            src_index, tar_index = early.run(scan_workers, on_listing)
+        else:
+            with metrics.timer("scan"):
+                # Source and target are scanned at the same time on a shared thread pool
+                src_index, tar_index = scan_trees([src_scanner, tar_scanner], scan_workers, on_listing)
+        for scanner in (src_scanner, tar_scanner):
+            metrics.add("dirs_scanned", len(scanner.index))
+            metrics.add("dirs_from_cache", scanner.cached_dirs)
+            metrics.add("files_scanned", scanner.index.file_count())
+        if digest_check:
+            metrics.add("dirs_checked", digest_check.dirs_checked)
+            if digest_check.unchanged():
+                return src_scanner, tar_scanner, None
+
+        with metrics.timer("syncer"):
+            sync_obj = Syncer(pair_id, source, target, src_index, tar_index,
+                        delete, dry_run, verbose, saved_state, rsync_workers, stream_output,
+                        transfer_backend, hash_cache, metrics, signature_cache=signature_cache,
+                        journal=journal)
+            if pipelined:
+                unplanned = sync_obj.remove_transferred(early.transferred)
+                if unplanned:
+                    LOGGER.warning(f"{unplanned} items transferred while scanning aren't in the plan")
+        return src_scanner, tar_scanner, sync_obj
+
+    # The plan can't be shown before transferring in pipelined mode
+    pipelined = pipeline and not (interactive or dry_run)
+    if pipeline and not pipelined:
+        LOGGER.info("Pipelined sync is only used when not interactive and not a dry run")
+    try:
+        src_scanner, tar_scanner, sync_obj = plan_sync(pipelined, check_digests=True)
+
+        if sync_obj is None:
+            pass
+        elif interactive:
+            src_scanner, tar_scanner, sync_obj = confirm_and_sync(plan_sync, (src_scanner, tar_scanner, sync_obj))
+        else: # If not interactive mode only delete and sync once
+            delete_and_sync(sync_obj, on_doubles)
+    finally:
+        # What was done so far survives an interruption (Ctrl-C, abort on doubles)
+        if journal:
+            journal.commit()
+
+    if sync_obj is None:
+        LOGGER.info("Nothing changed since last sync. Folders are in sync!")
+        return finish_sync_run(cur, pair_id, metrics, dry_run, metrics_dir)
+
+    # Watch mode (see watcher.py) wants to know what was written and deleted
+    if on_synced and not sync_obj.dryrun:
+        on_synced(sync_obj)
 
-    LOGGER.debug(f"Time for excluder_objects creation {round(time() - start_time, 2)}")
-    time_point = time()
+    if not sync_obj.dryrun:
+        with metrics.timer("state_save"):
+            state_dict = sync_obj.get_new_state_dict()
+            dir_caches = [("source", src_scanner.dir_cache, src_scanner.old_cache),
+                          ("target", tar_scanner.dir_cache, tar_scanner.old_cache)]
+            # Scans are only what both sides look like now if nothing was done
+            dir_digests = None
+            if sync_obj.in_sync and not metrics.errors:
+                dir_digests = [("source", index_digests(src_scanner.index)),
+                               ("target", index_digests(tar_scanner.index))]
+            # Journal is cleared with the state it was written for
+            cur.execute("BEGIN")
+            if save_folder_state(cur, pair_id, state_dict, dir_caches, dir_digests):
+                if cur.connection.in_transaction:
+                    cur.execute("ROLLBACK")
+                metrics.error("state_save")
+            else:
+                clear_journal(cur, pair_id)
+                cur.execute("COMMIT")
+
+    return finish_sync_run(cur, pair_id, metrics, sync_obj.dryrun, metrics_dir)
+
+
+def finish_sync_run(cur, pair_id, metrics, dryrun, metrics_dir=None):
+    # Saves metrics of a (non dryrun) sync run and returns them as dictionary
+    metrics_dict = metrics.as_dict()
+    if not dryrun:
+        save_sync_run(cur, pair_id, metrics_dict)
+        if metrics_dir:
+            write_prometheus_textfile(metrics_dir, pair_id, metrics_dict)
+
+    LOGGER.debug("Time per phase: " + ", ".join(f"{phase} {round(seconds, 2)}"
+                                                 for phase, seconds in metrics.timers.items()))
+    return metrics_dict
+    
 
-    source_files = create_file_dict(source, excl_src)
-    target_files = create_file_dict(target, excl_tar)
+def bootstrap_pair(cur, source, target, interactive=True, scan_workers=DEFAULT_SCAN_WORKERS,
+                   rsync_workers=DEFAULT_RSYNC_WORKERS, stream_output=False,
+                   transfer_backend=DEFAULT_BACKEND, delta_min_size=0):
+    """Summary: Initial sync of a new folder pair. Target is made a copy of
+    source (like rsync -a --delete) and the folder pair is added with its
+    first saved state.
+
+    Source and target are scanned once, concurrently. The plan is made by
+    Syncer in mirror mode and applied like a regular sync, so only differing
+    items are transferred. The state is built from the scans and checked with
+    Syncer.verify_transferred, which only lstats the transferred items on
+    target. Items that don't match source are printed per path and left out
+    of the saved state (they are synced again next time) instead of failing
+    the whole setup.
 
-    LOGGER.debug(f"Time for create_file_dicts {round(time() - time_point, 2)}")
-    time_point = time()
-    
-    sync_obj = Syncer(pair_id, source, target, source_files, target_files,
-                delete, dry_run, verbose)
-    LOGGER.debug(f"Time to create Syncer {round(time() - time_point, 2)}")
-    
+    Returns:
+        {int}: id of the new folder pair. 0 if aborted by user or it couldn't be saved.
+    """
+    metrics = Metrics_registry()
+    signature_cache = create_signature_cache(cur, transfer_backend, delta_min_size)
+
+    def plan_sync():
+        with metrics.timer("scan"):
+            src_scanner = Tree_scanner(source)
+            tar_scanner = Tree_scanner(target)
+            src_index, tar_index = scan_trees([src_scanner, tar_scanner], scan_workers)
+        for scanner in (src_scanner, tar_scanner):
+            metrics.add("dirs_scanned", len(scanner.index))
+            metrics.add("files_scanned", scanner.index.file_count())
+
+        with metrics.timer("syncer"):
+            # No saved state yet, mirror decides everything from the scans
+            sync_obj = Syncer(None, source, target, src_index, tar_index, True, False, True, {},
+                              rsync_workers, stream_output, transfer_backend, None, metrics,
+                              mirror=True, signature_cache=signature_cache)
+        return src_scanner, tar_scanner, sync_obj
+
+    src_scanner, tar_scanner, sync_obj = plan_sync()
     if interactive:
+        src_scanner, tar_scanner, sync_obj = confirm_and_sync(plan_sync, (src_scanner, tar_scanner, sync_obj))
+        if sync_obj.dryrun:
+            print("Exiting program...")
+            return 0
+    else:
+        delete_and_sync(sync_obj)
+
+    with metrics.timer("verify"):
+        mismatches = sync_obj.verify_transferred()
+    if mismatches:
+        metrics.error("verify", len(mismatches))
+        print(f"\n{len(mismatches)} items on target don't match source. They are left out of "
+              "saved state and synced again next time:")
+        for rel_path, reason in mismatches:
+            print(f"{reason + ': ':<40}{rel_path}")
+
+    with metrics.timer("state_save"):
+        dir_caches = [("source", src_scanner.dir_cache, src_scanner.old_cache),
+                      ("target", tar_scanner.dir_cache, tar_scanner.old_cache)]
+        cur.execute("BEGIN")
+        pair_id = add_folder_pair(cur, source, target)
+        if not pair_id or save_folder_state(cur, pair_id, sync_obj.get_new_state_dict(), dir_caches):
+            cur.execute("ROLLBACK")
+            print("Couldn't save folder pair and its state. Target is synced, but the folder "
+                  "pair will have to be added again before next sync!")
+            return 0
+        save_sync_run(cur, pair_id, metrics.as_dict())
+        cur.execute("COMMIT")
+
+    LOGGER.debug("Time per phase: " + ", ".join(f"{phase} {round(seconds, 2)}"
+                                                 for phase, seconds in metrics.timers.items()))
+    return pair_id
+
+
+def create_signature_cache(cur, transfer_backend, delta_min_size):
+    # Delta updates (see delta.py) are only done by the native backend
+    if delta_min_size and transfer_backend == "native":
+        return Signature_cache(cur, delta_min_size)
+    return None
+
+
+def confirm_and_sync(plan_sync, plan):
+    """Summary: Prints the plan of a Syncer (trial run) and syncs for real if
+    the user confirms. A plan confirmed after STALE_PLAN_SECONDS whose items
+    changed meanwhile (see Syncer.stale_items) is made again with plan_sync
+    and shown again.
+
+    Args:
+        plan_sync {function}: Scans and plans, returns (src_scanner, tar_scanner, sync_obj).
+        plan {tuple}: Return value of plan_sync.
+
+    Returns:
+        {tuple}: Return value of plan_sync of the last plan. Its Syncer has
+        dryrun False if it was synced, True if the user declined.
+    """
+    src_scanner, tar_scanner, sync_obj = plan
+    while True:
+        # Trial run only prints the plan (see Syncer.sync)
         sync_obj.dryrun = True
         delete_and_sync(sync_obj)
+        plan_time = time()
         user_input = ""
         while not user_input in {"y", "yes", "n", "no"}:
             user_input = input(f"\nThis was only a trial run. Do you want to sync for real? (y/yes, n/no)\n--> ")
             user_input = user_input.lower() 
-        if user_input in {"y", "yes"}:
-            sync_obj.dryrun = False
-            delete_and_sync(sync_obj)
-
-    else: # If not interactive mode only delete and sync once
+        if not user_input in {"y", "yes"}:
+            break
+
+        if time() - plan_time > STALE_PLAN_SECONDS:
+            stale = sync_obj.stale_items()
+            if stale:
+                print(f"\n{len(stale)} planned items (ie {stale[0]}) changed while waiting. "
+                      "Scanning again...")
+                src_scanner, tar_scanner, sync_obj = plan_sync()
+                continue
+
+        sync_obj.dryrun = False
         delete_and_sync(sync_obj)
-    
-    sync_obj.remove_textfiles()
-    
-    if not sync_obj.dryrun:
-        state_dict = sync_obj.get_new_state_dict()
-        save_folder_state(source, target, state_dict, pair_id)
+        break
 
-    return
-    
+    return src_scanner, tar_scanner, sync_obj
 
-def delete_and_sync(sync_obj):
-    time_point = time()
-    sync_obj.delete()
-    LOGGER.debug(f"Time to delete: {round(time() - time_point, 2)}")
+
+def delete_and_sync(sync_obj, on_doubles=None):
+    # Trial runs (dryrun) only print the plan and are timed as such. on_doubles
+    # is optional, it is called with sync_obj and the doubles instead of
+    # aborting, and the sync goes on with what it leaves of the plan.
+    metrics = sync_obj.metrics
+    with metrics.timer("plan" if sync_obj.dryrun else "delete"):
+        sync_obj.delete()
 
     doubles = sync_obj.remove_doubles()
-    if doubles:
+    if doubles and on_doubles:
+        metrics.error("doubles", len(doubles[0].get_item_set() | doubles[1].get_item_set()))
+        on_doubles(sync_obj, doubles)
+    elif doubles:
         # This happens if dir on one side is added, since last saved state, 
         # simultaneously as file on other side was added.
         LOGGER.critical("\nNon identified doubles exists! This most likely" +
@@ -71,156 +310,26 @@ def delete_and_sync(sync_obj):
         print()
         sys.exit(4)
             
-    sync_obj.sync()
+    with metrics.timer("plan" if sync_obj.dryrun else "transfer"):
+        sync_obj.sync()
 
 
-def create_file_dict(top_directory, excl_obj=None):
-    """Uses os.walk to go through top_directory including subdirectory to
-    create file_dict. 
+def create_file_dict(top_directory, excl_obj=None, workers=DEFAULT_SCAN_WORKERS, filesystem=LOCAL_FILESYSTEM):
+    """Uses the parallel scanner (see scanner.py) to go through top_directory
+    including subdirectories to create file_dict.
     - file_dict uses root directory (path relative
-    to top_directory) as key and has inner_dict as value. 
+    to top_directory) as key and has a set of file names as value. Symlinks to
+    dirs are included as files.
 
     Args:
         top_directory {string}: path to top directory. Can be relative or absolute.
+        excl_obj {Excluder}: Optional. Excluded files and dirs are left out.
+        workers {int}: Number of threads listing directories.
+        filesystem {object}: Filesystem the tree is on (see filesystem.py).
 
     Returns:
         file_dict {dictionary}: see above
     """
 
-    top_directory = os.path.abspath(top_directory)
-    working_dir = os.getcwd()
-    os.chdir(top_directory)
-    file_dict = {}
-
-    for basedir, dirs, files in os.walk(top_directory, topdown=True):
-
-        basedir = os.path.relpath(basedir,top_directory)
-
-        # Seems this part is needed to copy symlink to dirs
-        # TODO Maybe delete this part? Too much overhead?
-        for a_dir in dirs:
-            rel_file_path = os.path.join(basedir, a_dir)
-            if os.path.islink(rel_file_path):
-                files.append(a_dir)
-
-        if excl_obj and excl_obj.excl_dict:
-            file_dict[basedir] = excl_obj.get_non_excl_file_set(basedir, files)
-        else:
-            file_dict[basedir] = set(files)
-
-        if excl_obj and excl_obj.dirs:
-            # Keeps os.walk from going into excluded dirs!
-            dirs[:] = [d for d in dirs if os.path.join(basedir, d) not in excl_obj.dirs]
-
-    os.chdir(working_dir)
-    return file_dict
-
-
-def get_existing_items(source, target, del_obj_src=None, del_obj_tar=None):
-    """Function generates a list of items (files or dirs) that exist in both
-    source and target dir after syncing.  
-    """
-    # TODO this function is now overly simplified only usable after a complete
-    # rsync with delete active. Does not take failed deletions or addtions
-    # into account.
-
-    src_items = create_file_dict(source)
-    tar_items = create_file_dict(target)
-
-    # Below operation returns a set after intersection is made.
-    src_dirs, tar_dirs = set(src_items.keys()), set(tar_items.keys())
-
-    sym_diff_dirs = src_dirs ^ tar_dirs
-    if sym_diff_dirs:
-        return "error"
-    
-    mutual_dirs = src_dirs & tar_dirs
-    item_dict = {}
-
-    for dir in mutual_dirs:
-        src_files = src_items.get(dir, set())
-        tar_files = tar_items.get(dir, set())
-        sym_diff_files = src_files ^ tar_files
-        if sym_diff_files:
-            return "error"
-        
-        item_dict[dir] = list(src_files & tar_files)
-
-    print()
-    return item_dict
-
-
-def rsync(source, target, delete=False, dryrun=False, print_output=True, user_interaction=True):
-    """Summary: Sync using rsync as subprocess. This function greatly simplifies
-    rsync because of default flag behavior, see below. Use original rsync 
-    if greater flexibility is needed.
-    To run function interactively keep defaults except possibly set delete=True.
-    To run automated (ie with chron) use print_output=False and user_interaction=False.
-
-    Args:
-        source {string}: String to source directory/file.
-        target {string}: String to target directory/file.
-        delete {bool}: Wether to delete files in target that doesnt exist in source.
-        dryrun {bool}: If true run rsync ones with --dry-run flag. If true ignores user_interaction=True.
-        prin_output {bool}: If true prints output.
-        user_interaction: If true and dryrun=False --> runs 1 inital dryrun and gives user choose to continue or not.
-    
-    Returns:
-        Most often propagates returncode from rsync call itself.
-        Have the following function specified returncodes (not from rsync)
-        aborted_by_user = 49
-        already_synced = 50
-    """
-    
-    def run_rsync(rsync_arglist):
-        obj_return = subprocess.run(rsync_arglist, text=True, capture_output=True)
-
-        if obj_return.stdout:
-            if print_output:
-                print(format_rsync_output(obj_return.stdout))
-        else:
-            if not obj_return.stderr:
-                if print_output:
-                    print("Folders are already completely synced!")
-
-                already_synced = 50
-                return already_synced
-
-        if obj_return.stderr:
-            # TODO maybe write to logfile if print_output=False
-            print(obj_return.stderr)
-
-        if not obj_return.returncode == 0:
-            # TODO maybe write to logfile if print_output=False
-            print("Something went wrong in rsync call!")
-
-        return obj_return.returncode
-        
-    rsync_arglist = ["rsync", "-a", "--itemize-changes"]
-
-    if delete:
-        rsync_arglist.append("--delete")
-
-    rsync_arglist.append(source)
-    rsync_arglist.append(target)
-
-    # User interaction only takes place if user_interaction=True AND dryrun=False
-    if user_interaction and not dryrun: 
-        return_code = run_rsync(rsync_arglist + ["--dry-run"])
-        if return_code != 0:
-            return return_code
-        
-        print("\nAbove output was only a dry run. Nothing has happended. If the result looks desirable choose yes in next step!")
-
-        user_input = ""
-        while not user_input in {"y", "yes", "n", "no"}:
-            user_input = input(f"\nDo you want to continue (sync for real)? (y/yes, n/no)\n--> ")
-            user_input = user_input.strip().lower()
-        if user_input == "n" or user_input == "no":
-            print("Exiting program...")
-            aborted_by_user = 49
-            return aborted_by_user        
-    elif dryrun:
-        rsync_arglist.append("--dry-run")
-
-    return run_rsync(rsync_arglist)
\ No newline at end of file
+    return scan_trees([Tree_scanner(top_directory, excl_obj, filesystem=filesystem)],
+                      workers)[0].as_file_dict()
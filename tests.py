@@ -3,6 +3,10 @@ import json
 import os
 import sys
 import pathlib
+import random
+import shutil
+import stat
+import tempfile
 from helpers import Excluder
 from time import time
 
@@ -24,12 +28,6 @@ def excluder_test(excl_list):
     excl_obj = Excluder(excl_list)
     print(excl_obj)
 
-def test_get_existing_items_no_delete_objects():
-    source = "/home/ged/Documents/testdir/"
-    target = "/home/ged/Documents/testdir_copy/"
-    
-    _, _ = sync_functions.get_existing_items(source, target)
-
 def test_json(top_dir):
     time_point = time()
     file_dict = sync_functions.create_file_dict(top_dir)
@@ -131,8 +129,738 @@ def compare_create_dict_funcs(test_dir):
     
     compare_dicts(dict1, dict2)
 
+def create_random_tree(top_dir, seed=1, n_dirs=50, n_files=500):
+    """Creates a reproducible tree with files, dirs, symlinks and odd permissions.
+    Returns list of all created paths relative to top_dir."""
+    rng = random.Random(seed)
+    dirs, created = [""], []
+    for index in range(n_dirs):
+        rel_dir = os.path.join(rng.choice(dirs), f"dir {index}")
+        os.mkdir(os.path.join(top_dir, rel_dir), rng.choice((0o755, 0o700, 0o555)))
+        dirs.append(rel_dir)
+        created.append(rel_dir)
+    for index in range(n_files):
+        rel_dir = rng.choice(dirs)
+        parent = os.path.join(top_dir, rel_dir)
+        os.chmod(parent, 0o755)
+        rel_path = os.path.join(rel_dir, f"file_{index}.bin")
+        path = os.path.join(top_dir, rel_path)
+        if index % 25 == 0:
+            os.symlink(f"../target_{index}", path)
+        else:
+            with open(path, "wb") as a_file:
+                a_file.write(rng.randbytes(rng.choice((0, 1, 4096, 100000))))
+            os.chmod(path, rng.choice((0o644, 0o600, 0o755, 0o444)))
+        mtime_ns = rng.randrange(10**18, 16 * 10**17)
+        os.utime(path, ns=(mtime_ns, mtime_ns), follow_symlinks=False)
+        created.append(rel_path)
+    for rel_dir in dirs[1:]:
+        os.utime(os.path.join(top_dir, rel_dir), ns=(10**18, 10**18))
+    return created
+
+def tree_metadata(top_dir):
+    """Returns {relative path: comparable metadata} for everything below top_dir."""
+    result = {}
+    for root, dirs, files in os.walk(top_dir):
+        for name in dirs + files:
+            path = os.path.join(root, name)
+            st = os.lstat(path)
+            meta = [stat.S_IFMT(st.st_mode), stat.S_IMODE(st.st_mode), st.st_mtime_ns]
+            if stat.S_ISLNK(st.st_mode):
+                meta.append(os.readlink(path))
+            elif stat.S_ISREG(st.st_mode):
+                with open(path, "rb") as a_file:
+                    meta.append(a_file.read())
+            result[os.path.relpath(path, top_dir)] = meta
+    return result
+
+def test_native_transfer_against_rsync(seed=1):
+    """Differential test: copies the same generated tree (a random subset of
+    its paths) with rsync (rsync_runner) and Native_transfer (transfer.py) and
+    compares the results."""
+    from rsync_runner import run_rsync
+    from transfer import Native_transfer
+
+    if shutil.which("rsync") is None:
+        print("rsync isn't installed, native transfer not compared")
+        return
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        source = os.path.join(tmp_dir, "source")
+        rsync_target = os.path.join(tmp_dir, "rsync_target")
+        native_target = os.path.join(tmp_dir, "native_target")
+        for a_dir in (source, rsync_target, native_target):
+            os.mkdir(a_dir)
+
+        paths = create_random_tree(source, seed)
+        paths = random.Random(seed).sample(paths, len(paths) // 2)
+
+        # Pre existing (older) versions of some files on both targets
+        for rel_path in paths[:20]:
+            if os.path.isfile(os.path.join(source, rel_path)) and not os.path.islink(os.path.join(source, rel_path)):
+                for a_target in (rsync_target, native_target):
+                    os.makedirs(os.path.dirname(os.path.join(a_target, rel_path)), exist_ok=True)
+                    with open(os.path.join(a_target, rel_path), "w") as a_file:
+                        a_file.write("old version")
+
+        rsync_return, _ = run_rsync(["rsync", "-a", "--itemize-changes"], paths,
+                                 source + os.sep, rsync_target + os.sep, print_output=False)
+        native_return, succeeded = Native_transfer(4, print_output=False).run(
+                                 paths, source + os.sep, native_target + os.sep)
+
+        rsync_meta, native_meta = tree_metadata(rsync_target), tree_metadata(native_target)
+        differences = [rel_path for rel_path in rsync_meta.keys() | native_meta.keys()
+                       if rsync_meta.get(rel_path) != native_meta.get(rel_path)]
+
+        # Dirs that only exist as parents (implied dirs) may differ in mtime
+        differences = [rel_path for rel_path in differences if rel_path in paths
+                       or not os.path.isdir(os.path.join(source, rel_path))]
+
+        print(f"rsync returned {rsync_return}, native returned {native_return}, "
+              f"{len(succeeded)} of {len(paths)} paths transferred natively")
+        for rel_path in sorted(differences):
+            print(f"Differs: {rel_path}\n  rsync:  {rsync_meta.get(rel_path, '-')!s:.200}"
+                  f"\n  native: {native_meta.get(rel_path, '-')!s:.200}")
+        assert not differences, f"{len(differences)} paths differ between rsync and native transfer"
+    print("\nNATIVE TRANSFER MATCHES RSYNC!\n")
+
+def create_random_indexes(rng):
+    """Creates the scans (Tree_index) of both sides and a saved state for a
+    random folder pair: dirs missing on one side, files added, deleted and
+    modified on either side, saved state with files that are gone."""
+    from tree_index import Tree_index, Entry_stat
+
+    dirs = ["."] + [f"d{index}" for index in range(rng.randint(0, 8))]
+    dirs += [f"{a_dir}/s{index}" for a_dir in list(dirs) for index in range(rng.randint(0, 2))]
+    names = [f"f{index}" for index in range(12)]
+
+    def create_index():
+        index = Tree_index()
+        for a_dir in dirs:
+            if a_dir != "." and rng.random() < 0.15:
+                continue
+            index.add_dir(a_dir, {name: Entry_stat(rng.choice((1, 2)), rng.choice((5, 5, 5, 7)),
+                                                   0o100644, 1, 1)
+                                  for name in rng.sample(names, rng.randint(0, 8))})
+        return index
+
+    saved_state = {a_dir: set(rng.sample(names + ["gone"], rng.randint(0, 8)))
+                   for a_dir in dirs if rng.random() < 0.7}
+    return create_index(), create_index(), saved_state
+
+def syncer_decisions(sync_obj):
+    # Everything Syncer decided: sync_dict (item order included) and new state
+    decisions = {}
+    for key, planned in sync_obj.sync_dict.items():
+        if isinstance(planned, set):
+            decisions[key] = sorted(planned)
+        else:
+            decisions[key] = (list(planned.files.items()), sorted(planned.dirs))
+    new_state = sync_obj.new_state
+    decisions["new_state"] = (bytes(new_state.mutual), bytes(new_state.mutual_dirs),
+                              sorted((a_dir, sorted(files)) for a_dir, files in new_state.extra.items()))
+    return decisions
+
+def test_diff_engines(seeds=1000):
+    """Differential test: the python and numpy diff engines of Syncer (see
+    vector_diff.py) must make the same decisions for random folder pairs.
+    Every fourth pair is planned as mirror (saved state not used)."""
+    import contextlib
+    import io
+    from helpers import Syncer
+    from vector_diff import numpy_available
+
+    if not numpy_available():
+        print("numpy isn't installed, diff engines not compared")
+        return
+    for seed in range(seeds):
+        src_index, tar_index, saved_state = create_random_indexes(random.Random(seed))
+        mirror = seed % 4 == 0
+        decisions = []
+        for engine in ("python", "numpy"):
+            with contextlib.redirect_stdout(io.StringIO()):
+                sync_obj = Syncer(1, "/source", "/target", src_index, tar_index, True, True, False,
+                                  {} if mirror else saved_state, mirror=mirror, diff_engine=engine)
+            decisions.append(syncer_decisions(sync_obj))
+        assert decisions[0] == decisions[1], f"Engines differ for seed {seed}"
+    print(f"\nDIFF ENGINES MATCH FOR {seeds} FOLDER PAIRS!\n")
+
+def write_files(top_dir, rel_paths):
+    # Creates files (and their parent dirs) below top_dir
+    for rel_path in rel_paths:
+        path = os.path.join(top_dir, rel_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as a_file:
+            a_file.write(rel_path)
+
+def plan_on_disk(source, target, saved_state, deletions=True, **syncer_args):
+    # Scans both sides and returns the Syncer planning their sync
+    from helpers import Syncer
+    from scanner import Tree_scanner, scan_trees
+
+    src_index, tar_index = scan_trees([Tree_scanner(source), Tree_scanner(target)])
+    return Syncer(1, source, target, src_index, tar_index, deletions, False, False, saved_state,
+                  **syncer_args)
+
+def test_delete_planned_subtree():
+    """A subtree deleted on source since last sync is deleted on target with
+    deletions enabled (-d) and left alone otherwise. Deleted items leave the
+    new state."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        source, target = os.path.join(tmp_dir, "source"), os.path.join(tmp_dir, "target")
+        write_files(source, ["keep.txt"])
+        write_files(target, ["keep.txt", "old/a", "old/sub/b", "old/sub/deeper/c"])
+        saved_state = {".": {"keep.txt"}, "old": {"a"}, "old/sub": {"b"}, "old/sub/deeper": {"c"}}
+
+        sync_obj = plan_on_disk(source, target, saved_state, deletions=False)
+        assert sync_obj.sync_dict["tar_deletes"].dirs == {"old", "old/sub", "old/sub/deeper"}
+        sync_obj.delete()
+        assert os.path.isfile(os.path.join(target, "old/sub/deeper/c"))
+        assert sorted(sync_obj.new_state["old/sub"]) == ["b"]
+
+        sync_obj = plan_on_disk(source, target, saved_state)
+        sync_obj.delete()
+        assert not os.path.lexists(os.path.join(target, "old"))
+        assert os.path.isfile(os.path.join(target, "keep.txt"))
+        assert not sync_obj.failed_deletes
+        assert sorted(sync_obj.new_state) == ["."]
+        assert sync_obj.new_state["."] == ["keep.txt"]
+        assert sync_obj.remove_doubles() is None
+    print("\nPLANNED SUBTREE DELETED!\n")
+
+def test_failed_delete_stays_in_state():
+    """A dir replaced by a file on source, whose deletion on target fails (a
+    file appeared in it after the scan), stays in the new state and the
+    addition of the file is left out (remove_doubles)."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        source, target = os.path.join(tmp_dir, "source"), os.path.join(tmp_dir, "target")
+        write_files(source, ["x"])
+        write_files(target, ["x/a", "gone.txt"])
+        saved_state = {".": {"gone.txt"}, "x": {"a"}}
+
+        sync_obj = plan_on_disk(source, target, saved_state)
+        assert sync_obj.sync_dict["add_to_tar"].get_item_set() == {"x"}
+        assert sync_obj.sync_dict["tar_deletes"].get_item_set() == {"x", "x/a", "gone.txt"}
+        write_files(target, ["x/new"])
+        sync_obj.delete()
+
+        assert sync_obj.failed_deletes == {"x"}
+        assert not os.path.lexists(os.path.join(target, "x/a"))
+        assert not os.path.lexists(os.path.join(target, "gone.txt"))
+        new_state = sync_obj.new_state
+        assert "x" in new_state and new_state["x"] == []
+        assert "gone.txt" not in new_state["."]
+
+        src_duplicates, tar_duplicates = sync_obj.remove_doubles()
+        assert src_duplicates.get_file_set() == {"x"}
+        assert tar_duplicates.get_dir_set() == {"x"}
+    print("\nFAILED DELETE KEPT IN STATE!\n")
+
+def test_delete_does_not_follow_symlinked_dir():
+    """A planned dir replaced by a symlink to a dir after the scan is not
+    descended into (O_NOFOLLOW): nothing is deleted through the symlink and
+    the planned items stay in the new state."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        source, target = os.path.join(tmp_dir, "source"), os.path.join(tmp_dir, "target")
+        outside = os.path.join(tmp_dir, "outside")
+        os.mkdir(source)
+        write_files(target, ["sub/f"])
+        write_files(outside, ["f"])
+        saved_state = {".": set(), "sub": {"f"}}
+
+        sync_obj = plan_on_disk(source, target, saved_state)
+        shutil.rmtree(os.path.join(target, "sub"))
+        os.symlink(outside, os.path.join(target, "sub"))
+        sync_obj.delete()
+
+        assert os.path.isfile(os.path.join(outside, "f"))
+        assert os.path.islink(os.path.join(target, "sub"))
+        assert sync_obj.failed_deletes == {"sub", "sub/f"}
+        assert sync_obj.new_state["sub"] == ["f"]
+    print("\nSYMLINKED DIR NOT FOLLOWED!\n")
+
+def read_state(cur, folder_pair_id):
+    # Saved state of folder pair as dictionary with sets of files as values
+    from db_helpers import Saved_state
+
+    saved_state = Saved_state(cur, folder_pair_id)
+    return {a_dir: set(saved_state.get(a_dir)) for a_dir in saved_state.keys()}
+
+def test_journal_replay():
+    """A sync interrupted after transferring and deleting (state not saved)
+    leaves a journal. Replaying it gives the state the finished sync would
+    have saved."""
+    import sqlite3
+    from create_db import create_db
+    from db_helpers import Saved_state, replay_journal, save_folder_state
+    from helpers import Syncer
+    from journal import Sync_journal
+    from scanner import Tree_scanner, scan_trees
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        source, target = os.path.join(tmp_dir, "source"), os.path.join(tmp_dir, "target")
+        write_files(source, ["a.txt", "new_dir/b", "new_dir/sub/c", "gone/x"])
+        write_files(target, ["a.txt", "old.txt", "d.txt"])
+        for top_dir in (source, target):
+            os.utime(os.path.join(top_dir, "a.txt"), ns=(10**18, 10**18))
+
+        con = sqlite3.connect(":memory:", isolation_level=None)
+        cur = con.cursor()
+        create_db(cur)
+        cur.execute("INSERT INTO folder_pairs (source, target) VALUES (?, ?);", (source, target))
+        pair_id = cur.lastrowid
+        save_folder_state(cur, pair_id, {".": ["a.txt", "old.txt"], "gone": ["x"]})
+
+        src_index, tar_index = scan_trees([Tree_scanner(source), Tree_scanner(target)])
+        journal = Sync_journal(cur, pair_id)
+        sync_obj = Syncer(pair_id, source, target, src_index, tar_index, True, False, False,
+                          Saved_state(cur, pair_id), transfer_backend="native", journal=journal)
+        sync_obj.delete()
+        sync_obj.sync()
+        journal.commit()
+        # Interrupted here, before save_folder_state
+
+        assert read_state(cur, pair_id) == {".": {"a.txt", "old.txt"}, "gone": {"x"}}
+        assert replay_journal(cur, pair_id) == journal.entries > 0
+        cur.execute("SELECT COUNT(*) FROM sync_journal WHERE folder_pair_id = ?;", (pair_id,))
+        assert cur.fetchone()[0] == 0
+        replayed = read_state(cur, pair_id)
+
+        save_folder_state(cur, pair_id, sync_obj.get_new_state_dict())
+        assert replayed == read_state(cur, pair_id)
+        assert replayed == {".": {"a.txt", "d.txt"}, "new_dir": {"b"}, "new_dir/sub": {"c"}}
+        con.close()
+    print("\nJOURNAL REPLAY MATCHES SAVED STATE!\n")
+
+def test_failed_delta_update():
+    """A delta update failing partway leaves a half written file on target.
+    It must not look newer than source: the next plan copies source again.
+    An update interrupted by a crash is reset by replaying the journal."""
+    import errno
+    import sqlite3
+    from create_db import create_db
+    from delta import BLOCK_SIZE, Signature_cache
+    from db_helpers import replay_journal
+    from journal import Sync_journal
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        source, target = os.path.join(tmp_dir, "source"), os.path.join(tmp_dir, "target")
+        os.mkdir(source)
+        os.mkdir(target)
+        src_path, tar_path = os.path.join(source, "big.bin"), os.path.join(target, "big.bin")
+        with open(src_path, "wb") as a_file:
+            a_file.write(b"n" * 4 * BLOCK_SIZE)
+        with open(tar_path, "wb") as a_file:
+            a_file.write(b"o" * 4 * BLOCK_SIZE)
+        os.utime(tar_path, ns=(10**18, 10**18))
+        os.utime(src_path, ns=(10**18 + 1, 10**18 + 1))
+
+        con = sqlite3.connect(":memory:", isolation_level=None)
+        cur = con.cursor()
+        create_db(cur)
+        cur.execute("INSERT INTO folder_pairs (source, target) VALUES (?, ?);", (source, target))
+        pair_id = cur.lastrowid
+        saved_state = {".": {"big.bin"}}
+        journal = Sync_journal(cur, pair_id)
+        sync_obj = plan_on_disk(source, target, saved_state, transfer_backend="native",
+                                signature_cache=Signature_cache(cur, 1), journal=journal)
+        assert sync_obj.sync_dict["upd_lr"] == {"big.bin"}
+
+        pwrite, calls = os.pwrite, []
+        def failing_pwrite(fd, data, offset):
+            calls.append(offset)
+            if len(calls) == 2:
+                raise OSError(errno.ENOSPC, "No space left on device")
+            return pwrite(fd, data, offset)
+
+        os.pwrite = failing_pwrite
+        try:
+            sync_obj.sync()
+        finally:
+            os.pwrite = pwrite
+        journal.commit()
+        with open(tar_path, "rb") as a_file:
+            assert a_file.read(2 * BLOCK_SIZE) == b"n" * BLOCK_SIZE + b"o" * BLOCK_SIZE
+        assert plan_on_disk(source, target, saved_state).sync_dict["upd_lr"] == {"big.bin"}
+
+        # Crash after the first block: mtime of target is the time of the write
+        os.utime(tar_path, ns=(10**18 + 2, 10**18 + 2))
+        assert plan_on_disk(source, target, saved_state).sync_dict["upd_rl"] == {"big.bin"}
+        assert replay_journal(cur, pair_id) == 1
+        assert plan_on_disk(source, target, saved_state).sync_dict["upd_lr"] == {"big.bin"}
+
+        # Finished updates aren't reset
+        sync_obj = plan_on_disk(source, target, saved_state, transfer_backend="native",
+                                signature_cache=Signature_cache(cur, 1), journal=journal)
+        sync_obj.sync()
+        journal.commit()
+        assert replay_journal(cur, pair_id) == 2
+        assert os.lstat(tar_path).st_mtime_ns == os.lstat(src_path).st_mtime_ns
+        with open(tar_path, "rb") as a_file:
+            assert a_file.read() == b"n" * 4 * BLOCK_SIZE
+        con.close()
+    print("\nFAILED DELTA UPDATES ARE REPLACED NEXT SYNC!\n")
+
+# Lines of rsync -a -ii output and the record parse_itemize_line makes of them:
+# (update, file_type, attrs, path, category)
+ITEMIZE_SAMPLES = [
+    (">f.st...... photos/a b.jpg", (">", "f", ".st......", "photos/a b.jpg", "modified")),
+    (">f+++++++++ new file.txt", (">", "f", "+++++++++", "new file.txt", "created")),
+    ("<f+++++++++ sent.txt", ("<", "f", "+++++++++", "sent.txt", "created")),
+    ("cd+++++++++ new dir/", ("c", "d", "+++++++++", "new dir", "created")),
+    ("cd+++++++++ new dir/sub dir/", ("c", "d", "+++++++++", "new dir/sub dir", "created")),
+    (".d..t...... ./", (".", "d", "..t......", ".", "unchanged")),
+    (".f          same.txt", (".", "f", "         ", "same.txt", "unchanged")),
+    ("cL+++++++++ link -> ../target dir/", ("c", "L", "+++++++++", "link", "created")),
+    ("hf+++++++++ hard link => other file", ("h", "f", "+++++++++", "hard link", "created")),
+    ("*deleting   old file.txt", ("*", "", "", None, "message")),
+    ("sent 1,234 bytes  received 56 bytes", ("s", "", "", None, "message")),
+]
+
+def test_parse_itemize_line():
+    from rsync_runner import parse_itemize_line
+
+    for line, expected in ITEMIZE_SAMPLES:
+        item = parse_itemize_line(line)
+        assert (item.update, item.file_type, item.attrs, item.path, item.category) == expected, line
+        assert item.line == line
+    assert parse_itemize_line("cd+++++++++ new dir/").name == "new dir/"
+    print("\nITEMIZE LINES PARSED!\n")
+
+def test_rsync_error_paths():
+    from rsync_runner import error_paths
+
+    roots = ("/data/source/", "/data/target/")
+    samples = [
+        ('rsync: [sender] send_files failed to open "/data/source/dir a/f 1.txt": Permission denied (13)',
+         ["dir a/f 1.txt"]),
+        # Temporary file of the receiver is mapped to the file it was written for
+        ('rsync: [receiver] write failed on "/data/target/dir a/.big.bin.aB3dE9": No space left on device (28)',
+         ["dir a/big.bin"]),
+        ('rsync: [generator] failed to set times on "/data/target/new dir/": Operation not permitted (1)',
+         ["new dir"]),
+        ('rsync: link_stat "relative/gone.txt" failed: No such file or directory (2)', ["relative/gone.txt"]),
+        ('rsync: [sender] failed to open "/elsewhere/file": Permission denied (13)', []),
+        ("rsync error: some files/attrs were not transferred (see previous errors) (code 23)", []),
+    ]
+    for line, expected in samples:
+        assert error_paths(line, roots) == expected, line
+    print("\nERROR PATHS FOUND!\n")
+
+def test_rsync_summary_succeeded():
+    """Paths of a partly failed rsync call (returncode 23 or 24) that were
+    itemized and aren't named (nor their parent dir) in an error line are
+    transferred, the others aren't."""
+    from rsync_runner import Rsync_summary, parse_itemize_line
+
+    stdout = ["cd+++++++++ new dir/", ">f+++++++++ new dir/a b.txt", ">f.st...... c.txt",
+              ">f+++++++++ locked.txt", "cd+++++++++ sub/", ">f+++++++++ sub/x", "*deleting   old.txt",
+              "cL+++++++++ link -> c.txt"]
+    stderr = ['rsync: [sender] send_files failed to open "/data/source/locked.txt": Permission denied (13)',
+              'rsync: [generator] failed to set times on "/data/target/sub": Operation not permitted (1)',
+              "rsync error: some files/attrs were not transferred (see previous errors) (code 23) "
+              "at main.c(1338) [sender=3.2.7]"]
+    # vanished.txt isn't itemized (vanished on the sending side)
+    paths = ["new dir", "new dir/a b.txt", "c.txt", "locked.txt", "sub", "sub/x", "link", "vanished.txt"]
+
+    summary = Rsync_summary(("/data/source", "/data/target/"))
+    for line in stdout:
+        summary.add_item(parse_itemize_line(line))
+    for line in stderr:
+        summary.add_error(line)
+    assert (summary.created, summary.modified, summary.messages) == (6, 1, 1)
+    assert summary.failed == {"locked.txt", "sub"}
+    assert summary.unmatched_errors == 0
+
+    transferred = ["new dir", "new dir/a b.txt", "c.txt", "link"]
+    assert summary.succeeded(paths, 23) == transferred
+    assert summary.succeeded(paths, 24) == transferred
+    assert summary.succeeded(paths, 0) == paths
+    assert summary.succeeded(paths, 50) == paths
+    assert summary.succeeded(paths, 11) == []
+
+    # An error that can't be mapped to a path fails the whole call
+    summary.add_error("rsync: connection unexpectedly closed (0 bytes received so far) [sender]")
+    assert summary.succeeded(paths, 23) == []
+    # Without roots no paths are kept
+    assert Rsync_summary().succeeded(paths, 23) == []
+    print("\nRSYNC SUMMARY SUCCEEDED SETS MATCH!\n")
+
+# (exclude line, relative path, excluded). Lines are relative to top_dir
+# ("anchored"), only "**" matches at any depth.
+EXCLUDE_CASES = [
+    ("*.tmp", "a.tmp", True),
+    ("*.tmp", "dir/a.tmp", False),
+    ("*", "anything", True),
+    ("*", "dir/anything", False),
+    ("dir/*", "dir/a", True),
+    ("dir/*", "dir/sub/a", False),
+    ("?.tmp", "a.tmp", True),
+    ("?.tmp", "ab.tmp", False),
+    ("[ab].txt", "b.txt", True),
+    ("[!ab].txt", "b.txt", False),
+    ("notes [[]1].txt", "notes [1].txt", True),
+    ("**/*.tmp", "a.tmp", True),
+    ("**/*.tmp", "dir/sub/a.tmp", True),
+    ("**/*.tmp", "dir/a.tmp.txt", False),
+    ("**/build", "build", True),
+    ("**/build", "docs/build", True),
+    ("**/build", "docs/build/readme", False),
+    ("src/**", "src", True),
+    ("src/**", "src/deep/a.txt", True),
+    ("src/**", "srcs/a.txt", False),
+    ("src/**/keep.txt", "src/keep.txt", True),
+    ("src/**/keep.txt", "src/a/b/keep.txt", True),
+    ("**", "dir/sub/a", True),
+    # Trailing "/" and "./" don't change what is matched
+    ("cache/", "cache", True),
+    ("./cache", "cache", True),
+    ("cache/", "dir/cache", False),
+    # Top level names (never matched before excludes were compiled)
+    ("build", "build", True),
+    ("build", "docs/build", False),
+    (".hidden", ".hidden", True),
+    ("a.txt", "a.txt", True),
+    ("a.txt", "a.txt.bak", False),
+    ("dir/a.txt", "dir/a.txt", True),
+    # Characters special in regular expressions are literal
+    ("a+b (1).txt", "a+b (1).txt", True),
+    ("a+b (1).txt", "aab (1).txt", False),
+]
+
+def test_exclude_patterns():
+    """Table driven: compiled exclude lines match the paths pathlib glob
+    matches relative to top_dir. Absolute lines below top_dir are anchored
+    there, others are ignored."""
+    top_dir = "/data/top"
+    for line, rel_path, expected in EXCLUDE_CASES:
+        assert Excluder(top_dir, [line]).excludes(rel_path) == expected, (line, rel_path)
+
+    excl_obj = Excluder(top_dir, ["/data/top/cache", "/data/other/build", "/data"])
+    assert excl_obj.excludes("cache")
+    assert not excl_obj.excludes("build")
+    assert not excl_obj.excludes("dir/cache")
+    assert not Excluder(top_dir, ["/data/other"])
+    assert not Excluder(top_dir, [])
+    print("\nEXCLUDE PATTERNS MATCH!\n")
+
+def test_exclude_matches_glob():
+    """Differential test: for every exclude line the paths the scanner leaves
+    out (a match or below a matching dir) are the ones the old excluder left
+    out, which expanded lines with pathlib glob on the tree."""
+    rel_paths = ["a.tmp", "keep.txt", ".hidden", "notes [1].txt", "build/out.o", "build/sub/x.tmp",
+                 "src/a.tmp", "src/deep/b.tmp", "src/deep/keep.txt", "src/keep.txt",
+                 "cache/data", "docs/build/readme", "docs/a.tmp"]
+    lines = ["*.tmp", "**/*.tmp", "build", "build/", "**/build", "src/**", "src/**/keep.txt",
+             "?.tmp", "src/*/b.tmp", "notes [[]1].txt", "*", "**", "docs/*", ".hidden",
+             "nothing/*", "src/deep", "**/deep/*"]
+
+    with tempfile.TemporaryDirectory() as top_dir:
+        write_files(top_dir, rel_paths)
+        top_path = pathlib.Path(top_dir)
+        all_paths = set(rel_paths)
+        for rel_path in rel_paths:
+            parent = os.path.dirname(rel_path)
+            while parent:
+                all_paths.add(parent)
+                parent = os.path.dirname(parent)
+
+        def below(rel_path, matched):
+            # rel_path or one of its parent dirs (top dir included) matched
+            while True:
+                if rel_path in matched:
+                    return True
+                if not rel_path or rel_path == ".":
+                    return False
+                rel_path = os.path.dirname(rel_path) or "."
+
+        for line in lines + [os.path.join(top_dir, "src/deep")]:
+            path = pathlib.Path(line)
+            if (top_path / path).exists():
+                globbed = {str((top_path / path).relative_to(top_path))}
+            else:
+                globbed = {str(match.relative_to(top_path)) for match in top_path.glob(line)}
+            excl_obj = Excluder(top_dir, [line])
+            matched = {rel_path for rel_path in all_paths if excl_obj.excludes(rel_path)}
+            for rel_path in sorted(all_paths):
+                assert below(rel_path, globbed) == below(rel_path, matched), (line, rel_path)
+    print("\nEXCLUDES MATCH GLOB!\n")
+
+def test_exclude_cache():
+    """Compiled excludes are cached in folder_pair_<id>.cache.json per top dir
+    and rebuilt when the exclude file or the compiler version changes."""
+    import helpers
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        excludes_dir = os.path.join(tmp_dir, ".folder_sync_config", "folder_pair_excludes")
+        os.makedirs(excludes_dir)
+        exclude_path = os.path.join(excludes_dir, "folder_pair_7.txt")
+        cache_path = os.path.join(excludes_dir, "folder_pair_7.cache.json")
+        source, target = os.path.join(tmp_dir, "source"), os.path.join(tmp_dir, "target")
+
+        def read_cache():
+            with open(cache_path) as cache_file:
+                return json.load(cache_file)
+
+        def write_cache(cache):
+            with open(cache_path, "w") as cache_file:
+                json.dump(cache, cache_file)
+
+        script_path, compiler_version = helpers.SCRIPT_PATH, Excluder.COMPILER_VERSION
+        helpers.SCRIPT_PATH = pathlib.Path(tmp_dir)
+        try:
+            assert Excluder.create_excluder(source, 7) is None # No exclude file
+            with open(exclude_path, "w") as exclude_file:
+                exclude_file.write("*.tmp\n\n")
+            excl_obj = Excluder.create_excluder(source, 7)
+            assert excl_obj.excludes("a.tmp") and not excl_obj.excludes("a.txt")
+            Excluder.create_excluder(target, 7)
+            cache = read_cache()
+            assert set(cache["patterns"]) == {source, target}
+
+            # Cached pattern is used as long as the exclude file is unchanged
+            cache["patterns"][source] = "cached"
+            write_cache(cache)
+            assert Excluder.create_excluder(source, 7).pattern == "cached"
+
+            # Changed exclude file invalidates the patterns of all top dirs
+            with open(exclude_path, "w") as exclude_file:
+                exclude_file.write("*.log\n")
+            excl_obj = Excluder.create_excluder(source, 7)
+            assert excl_obj.excludes("a.log") and not excl_obj.excludes("a.tmp")
+            cache = read_cache()
+            assert set(cache["patterns"]) == {source}
+
+            # So does a new compiler version
+            cache["patterns"][source] = "cached"
+            write_cache(cache)
+            Excluder.COMPILER_VERSION = compiler_version + 1
+            assert Excluder.create_excluder(source, 7).pattern != "cached"
+
+            # A broken cache is rebuilt
+            with open(cache_path, "w") as cache_file:
+                cache_file.write("{broken")
+            assert Excluder.create_excluder(source, 7).excludes("a.log")
+            assert read_cache()["patterns"][source] == excl_obj.pattern
+
+            with open(exclude_path, "w") as exclude_file:
+                exclude_file.write("\n")
+            assert Excluder.create_excluder(source, 7) is None
+        finally:
+            helpers.SCRIPT_PATH, Excluder.COMPILER_VERSION = script_path, compiler_version
+    print("\nEXCLUDE CACHE INVALIDATED!\n")
+
+def test_watcher_ignores_own_changes():
+    """Events raised by the copies and deletions of a watch mode batch don't
+    make dirs dirty again, later changes to the same items do."""
+    from watcher import Pair_watcher
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        source, target = os.path.join(tmp_dir, "source"), os.path.join(tmp_dir, "target")
+        write_files(source, ["a.txt", "new dir/b", "new dir/sub/c", "mutual/d"])
+        write_files(target, ["a.txt", "mutual/d", "mutual/gone"])
+        for top_dir in (source, target):
+            os.utime(os.path.join(top_dir, "a.txt"), ns=(10**18, 10**18))
+            os.utime(os.path.join(top_dir, "mutual/d"), ns=(10**18, 10**18 + top_dir.endswith("source")))
+
+        watcher = Pair_watcher(None, 1, source, target, True, False, transfer_backend="native")
+        try:
+            for side in watcher.roots:
+                watcher.add_watches(side, ".")
+            sync_obj = plan_on_disk(source, target, {".": {"a.txt"}, "mutual": {"d", "gone"}},
+                                    transfer_backend="native")
+            sync_obj.delete()
+            sync_obj.sync()
+            assert os.path.isfile(os.path.join(target, "new dir/sub/c"))
+            assert not os.path.lexists(os.path.join(target, "mutual/gone"))
+
+            watcher.expect_own_changes(sync_obj)
+            assert not watcher.handle_events(watcher.inotify.read_events())
+            assert not watcher.dirty
+            # New dirs written by the batch are watched
+            assert "new dir/sub" in watcher.watched_dirs["target"]
+
+            write_files(target, ["new dir/sub/c", "mutual/new"])
+            assert watcher.handle_events(watcher.inotify.read_events())
+            assert watcher.dirty == {"new dir/sub", "mutual"}
+        finally:
+            watcher.inotify.close()
+    print("\nWATCHER IGNORES ITS OWN CHANGES!\n")
+
+def test_watcher_skips_doubles():
+    """A file on one side with the name of a dir on the other doesn't stop
+    watch mode. The rest of the batch is synced and the dir of the double is
+    dirty again."""
+    import sqlite3
+    from create_db import create_db
+    from watcher import Pair_watcher
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        source, target = os.path.join(tmp_dir, "source"), os.path.join(tmp_dir, "target")
+        write_files(source, ["a.txt", "x/inner", "x/sub/deep"])
+        write_files(target, ["x", "b.txt"])
+
+        con = sqlite3.connect(":memory:", isolation_level=None)
+        cur = con.cursor()
+        create_db(cur)
+        cur.execute("INSERT INTO folder_pairs (source, target) VALUES (?, ?);", (source, target))
+        watcher = Pair_watcher(cur, cur.lastrowid, source, target, True, False, transfer_backend="native")
+        try:
+            watcher.dirty.add(".")
+            watcher.sync_dirty()
+        finally:
+            watcher.inotify.close()
+
+        assert os.path.isfile(os.path.join(target, "a.txt"))
+        assert os.path.isfile(os.path.join(source, "b.txt"))
+        assert os.path.isfile(os.path.join(target, "x"))
+        assert not os.path.lexists(os.path.join(source, "x", "x"))
+        assert watcher.dirty == {"."}
+        assert watcher.state == {".": {"a.txt", "b.txt"}}
+        cur.execute("SELECT metrics FROM sync_runs;")
+        assert json.loads(cur.fetchone()[0])["errors"] == {"doubles": 1}
+        con.close()
+    print("\nWATCHER SKIPS DOUBLES!\n")
+
+def test_digest_check():
+    """The digests checked on the listings of the scan find every change to
+    files and dirs since the digests were saved."""
+    from dir_digest import Digest_check, index_digests
+    from scanner import Tree_scanner, scan_trees
+
+    def check(saved_digests):
+        scanners = [Tree_scanner(source), Tree_scanner(target)]
+        digest_check = Digest_check(scanners, saved_digests)
+        scan_trees(scanners, on_listing=digest_check.on_listing)
+        return digest_check
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        source, target = os.path.join(tmp_dir, "source"), os.path.join(tmp_dir, "target")
+        for top_dir in (source, target):
+            write_files(top_dir, ["a.txt", "d/b", "d/e/c", "f/g"])
+        saved_digests = [index_digests(index) for index in
+                         scan_trees([Tree_scanner(source), Tree_scanner(target)])]
+
+        digest_check = check(saved_digests)
+        assert digest_check.unchanged()
+        assert digest_check.dirs_checked == 8
+
+        changes = [lambda: os.utime(os.path.join(target, "d/e/c"), ns=(10**18, 10**18)),
+                   lambda: write_files(source, ["d/new"]),
+                   lambda: os.mkdir(os.path.join(source, "d/e/new")),
+                   lambda: os.rmdir(os.path.join(source, "d/e/new")) or
+                           shutil.rmtree(os.path.join(target, "f"))]
+        for change in changes:
+            change()
+            digest_check = check(saved_digests)
+            assert not digest_check.unchanged()
+            saved_digests = [index_digests(index) for index in
+                             scan_trees([Tree_scanner(source), Tree_scanner(target)])]
+            assert check(saved_digests).unchanged()
+    print("\nDIGEST CHECK FINDS EVERY CHANGE!\n")
+
 if __name__ == "__main__":
     #compare_create_dict_funcs("/home/ged/Programmering")
+    #test_native_transfer_against_rsync()
     test_obj = Excluder.create_excluder("/home/ged/Documents", 2)
     if test_obj:
         print("its true")
\ No newline at end of file
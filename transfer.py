@@ -0,0 +1,416 @@
+"""This module contains the native (in-process) transfer engine, an alternative
+to running rsync as subprocess when both source and target are local.
+
+Regular files are copied with kernel copy offload (os.copy_file_range with
+os.sendfile as fallback) on a thread pool. Everything is written to a
+temporary file in the target directory and renamed into place, so an
+interrupted copy never leaves a half written file behind. Metadata is kept the
+same way as rsync -a does (permissions, modification times, symlinks,
+directories, devices/specials and group/owner when allowed).
+
+Files existing on both sides can be updated block by block instead (see
+delta.py), only writing the blocks that changed. Such an update is done in
+place, so a half written file can't be avoided when it fails. Its mtime is
+then set to 0, which makes the other side newer and the next sync copies the
+file again. A crash is covered by the journal: receiving files are journaled
+before they are updated and again when done, and replay_journal (db_helpers)
+sets mtime 0 on the ones that weren't done.
+
+Output is given as rsync --itemize-changes lines so that it can be formatted
+with format_rsync_line in helpers just like rsync output.
+"""
+import errno
+import logging
+import os
+import re
+import stat
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from delta import file_key, update_blocks
+
+LOGGER = logging.getLogger(__name__)
+
+BACKENDS = ("rsync", "native")
+DEFAULT_BACKEND = "rsync"
+DEFAULT_TRANSFER_WORKERS = 8
+
+# Name of a temporary file made by temp_path (.name.pid.thread.tmp)
+TEMP_NAME = re.compile(r"^\.(.+)\.\d+\.\d+\.tmp$")
+
+# Same returncodes as rsync (and rsync_runner)
+PARTIAL_TRANSFER = 23
+ALREADY_SYNCED = 50
+
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
+IS_ROOT = hasattr(os, "geteuid") and os.geteuid() == 0
+
+OUTPUT_LOCK = threading.Lock()
+
+
+def copy_file_data(src_fd, dst_fd, size):
+    """Copies size bytes between two open file descriptors. Uses
+    copy_file_range (can be done entirely by the filesystem, ie reflinks or
+    server side copy) and falls back to sendfile and finally read/write.
+
+    Returns:
+        {int}: Bytes copied.
+    """
+    copied = 0
+
+    if hasattr(os, "copy_file_range"):
+        try:
+            while copied < size:
+                count = os.copy_file_range(src_fd, dst_fd, min(COPY_CHUNK_SIZE, size - copied))
+                if count == 0:
+                    break
+                copied += count
+            return copied
+        except OSError as error:
+            if not error.errno in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+            if copied:
+                # Can't know how much of an interrupted chunk was written
+                os.lseek(src_fd, 0, os.SEEK_SET)
+                os.lseek(dst_fd, 0, os.SEEK_SET)
+                os.ftruncate(dst_fd, 0)
+                copied = 0
+
+    try:
+        while copied < size:
+            count = os.sendfile(dst_fd, src_fd, copied, min(COPY_CHUNK_SIZE, size - copied))
+            if count == 0:
+                break
+            copied += count
+        return copied
+    except OSError as error:
+        if not error.errno in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+            raise
+
+    os.lseek(src_fd, copied, os.SEEK_SET)
+    os.lseek(dst_fd, copied, os.SEEK_SET)
+    while True:
+        data = os.read(src_fd, COPY_CHUNK_SIZE)
+        if not data:
+            break
+        view = memoryview(data)
+        while view:
+            written = os.write(dst_fd, view)
+            view = view[written:]
+        copied += len(data)
+    return copied
+
+
+def temp_path(dst_path):
+    directory, name = os.path.split(dst_path)
+    return os.path.join(directory, f".{name}.{os.getpid()}.{threading.get_ident()}.tmp")
+
+
+def copy_ownership(st, path=None, fd=None):
+    """Sets group (and owner if running as root) like rsync -a. Failures to
+    set group are ignored, which is what rsync does for non root users."""
+    uid = st.st_uid if IS_ROOT else -1
+    try:
+        if fd is not None:
+            os.fchown(fd, uid, st.st_gid)
+        else:
+            os.chown(path, uid, st.st_gid, follow_symlinks=False)
+    except PermissionError:
+        pass
+
+
+class Native_transfer:
+    """
+    Summary:
+        Copies a list of relative paths from sender to receiver inside this
+        process. Used by Syncer.sync when transfer backend is "native".
+
+    Properties:
+        self.workers {int} = Number of threads copying files
+        self.dryrun {bool} = Only report what would be done
+        self.print_output {bool} = Print formatted itemize lines
+        self.signature_cache {Signature_cache} = Enables delta updates of files
+            of at least signature_cache.min_size bytes (see delta.py). None disables
+        self.bytes_copied {int} = Bytes written by all runs so far
+        self.bytes_skipped {int} = Bytes of unchanged blocks not written by delta updates
+        self.delta_files {int} = Number of files updated block by block
+        self.journal {Sync_journal} = Optional. Files updated block by block are
+            journaled before the first write and when done (see journal.py)
+    """
+
+    def __init__(self, workers=DEFAULT_TRANSFER_WORKERS, dryrun=False, print_output=True,
+                 signature_cache=None, journal=None):
+        self.workers = max(1, workers)
+        self.dryrun = dryrun
+        self.print_output = print_output
+        self.signature_cache = signature_cache
+        self.journal = journal
+        self.bytes_copied = 0
+        self.bytes_skipped = 0
+        self.delta_files = 0
+        self.__bytes_lock = threading.Lock()
+
+    def __repr__(self):
+        return f"Native_transfer(workers: {self.workers}, dryrun: {self.dryrun})"
+
+    def __report(self, itemize_line):
+        if not self.print_output:
+            return
+        # helpers imports this module, hence the late import
+        from helpers import format_rsync_line
+        formatted = format_rsync_line(itemize_line)
+        if formatted:
+            with OUTPUT_LOCK:
+                print(formatted[1])
+
+    def __ensure_parent(self, sender, receiver, rel_path, created_dirs):
+        """Creates missing parent dirs of rel_path on receiver with the
+        permissions of the corresponding dirs on sender (rsync implied dirs)."""
+        parent = os.path.dirname(rel_path)
+        missing = []
+        while parent and not os.path.isdir(os.path.join(receiver, parent)):
+            missing.append(parent)
+            parent = os.path.dirname(parent)
+        for parent in reversed(missing):
+            self.__transfer_dir(sender, receiver, parent, created_dirs)
+
+    def __transfer_dir(self, sender, receiver, rel_path, created_dirs):
+        src_st = os.lstat(os.path.join(sender, rel_path))
+        dst_path = os.path.join(receiver, rel_path)
+        mode = stat.S_IMODE(src_st.st_mode)
+        try:
+            dst_st = os.lstat(dst_path)
+        except FileNotFoundError:
+            dst_st = None
+
+        if dst_st and not stat.S_ISDIR(dst_st.st_mode):
+            raise FileExistsError(errno.EEXIST, "Not a directory on receiving side", dst_path)
+
+        if not dst_st:
+            self.__report(f"cd+++++++++ {rel_path}/")
+            if self.dryrun:
+                return
+            # Owner needs write access until contents are copied
+            try:
+                os.mkdir(dst_path, mode | stat.S_IRWXU)
+                copy_ownership(src_st, path=dst_path)
+            except FileExistsError:
+                # Created by another transfer at the same time (see pipeline.py)
+                if not os.path.isdir(dst_path):
+                    raise
+        elif self.dryrun:
+            return
+
+        # Permissions and times are set when contents are in place
+        created_dirs.append((rel_path, mode, src_st.st_atime_ns, src_st.st_mtime_ns))
+
+    def __transfer_file(self, sender, receiver, rel_path, delta=False):
+        src_path = os.path.join(sender, rel_path)
+        dst_path = os.path.join(receiver, rel_path)
+        src_st = os.lstat(src_path)
+        try:
+            dst_st = os.lstat(dst_path)
+        except FileNotFoundError:
+            dst_st = None
+
+        if dst_st and stat.S_ISDIR(dst_st.st_mode):
+            raise IsADirectoryError(errno.EISDIR, "Is a directory on receiving side", dst_path)
+
+        if stat.S_ISLNK(src_st.st_mode):
+            link_target = os.readlink(src_path)
+            prefix = "cL+++++++++" if not dst_st else "cL.t......."
+            self.__report(f"{prefix} {rel_path} -> {link_target}")
+            if self.dryrun:
+                return
+            tmp_path = temp_path(dst_path)
+            os.symlink(link_target, tmp_path)
+            try:
+                copy_ownership(src_st, path=tmp_path)
+                os.utime(tmp_path, ns=(src_st.st_atime_ns, src_st.st_mtime_ns), follow_symlinks=False)
+                os.replace(tmp_path, dst_path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+            return
+
+        if stat.S_ISREG(src_st.st_mode):
+            prefix = ">f+++++++++" if not dst_st else ">f.st......"
+            self.__report(f"{prefix} {rel_path}")
+            if self.dryrun:
+                return
+            if delta and self.__use_delta(src_st, dst_st) and self.__delta_file(src_path, dst_path):
+                return
+            tmp_path = temp_path(dst_path)
+            src_fd = os.open(src_path, os.O_RDONLY)
+            try:
+                dst_fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+                try:
+                    copied = copy_file_data(src_fd, dst_fd, src_st.st_size)
+                    copy_ownership(src_st, fd=dst_fd)
+                    os.chmod(dst_fd, stat.S_IMODE(src_st.st_mode))
+                    os.utime(dst_fd, ns=(src_st.st_atime_ns, src_st.st_mtime_ns))
+                finally:
+                    os.close(dst_fd)
+                os.replace(tmp_path, dst_path)
+            except BaseException:
+                if os.path.lexists(tmp_path):
+                    os.unlink(tmp_path)
+                raise
+            finally:
+                os.close(src_fd)
+            with self.__bytes_lock:
+                self.bytes_copied += copied
+            return
+
+        # Devices, fifos and sockets (rsync -a includes -D)
+        type_char = "D" if stat.S_ISBLK(src_st.st_mode) or stat.S_ISCHR(src_st.st_mode) else "S"
+        self.__report(f"c{type_char}+++++++++ {rel_path}")
+        if self.dryrun:
+            return
+        if dst_st:
+            os.unlink(dst_path)
+        if stat.S_ISFIFO(src_st.st_mode):
+            os.mkfifo(dst_path, stat.S_IMODE(src_st.st_mode))
+        else:
+            os.mknod(dst_path, src_st.st_mode, src_st.st_rdev)
+        copy_ownership(src_st, path=dst_path)
+        os.utime(dst_path, ns=(src_st.st_atime_ns, src_st.st_mtime_ns), follow_symlinks=False)
+
+    def __use_delta(self, src_st, dst_st):
+        # Hard linked files are copied, an update in place would change all links
+        return (self.signature_cache is not None and dst_st is not None
+                and stat.S_ISREG(dst_st.st_mode) and dst_st.st_nlink == 1
+                and src_st.st_size >= self.signature_cache.min_size)
+
+    def __delta_file(self, src_path, dst_path):
+        """Updates dst_path in place with the blocks of src_path that differ
+        (see delta.py). Returns False if dst_path can't be opened for writing,
+        the file is then copied as usual. If the update fails mtime of dst_path
+        is set to 0, so that the half written file is replaced next sync."""
+        try:
+            dst_fd = os.open(dst_path, os.O_RDWR | getattr(os, "O_NOFOLLOW", 0))
+        except PermissionError:
+            return False
+        try:
+            src_fd = os.open(src_path, os.O_RDONLY)
+            try:
+                src_st, dst_st = os.fstat(src_fd), os.fstat(dst_fd)
+                try:
+                    written, signature = update_blocks(src_fd, dst_fd, src_st.st_size, dst_st.st_size,
+                                                       self.signature_cache.get(file_key(dst_st)))
+                    copy_ownership(src_st, fd=dst_fd)
+                    os.chmod(dst_fd, stat.S_IMODE(src_st.st_mode))
+                    os.utime(dst_fd, ns=(src_st.st_atime_ns, src_st.st_mtime_ns))
+                except BaseException:
+                    try:
+                        os.utime(dst_fd, ns=(dst_st.st_atime_ns, 0))
+                    except OSError as error:
+                        LOGGER.error(f"Couldn't reset mtime of half updated {dst_path}: {error}")
+                    raise
+                # Signature is only valid if source didn't change while it was read
+                if file_key(os.fstat(src_fd)) == file_key(src_st):
+                    self.signature_cache.add((file_key(src_st), file_key(os.fstat(dst_fd))), signature)
+            finally:
+                os.close(src_fd)
+        finally:
+            os.close(dst_fd)
+
+        with self.__bytes_lock:
+            self.bytes_copied += written
+            self.bytes_skipped += src_st.st_size - written
+            self.delta_files += 1
+        return True
+
+    def run(self, paths, sender, receiver, on_transferred=None):
+        """Transfers paths (relative to sender and receiver).
+
+        Args:
+            on_transferred {function}: Optional. Called with each path that was
+            transferred, in the calling thread, while the rest is transferred.
+
+        Returns:
+            {tuple}: (returncode, succeeded) where returncode is 0, ALREADY_SYNCED
+            (nothing to do) or PARTIAL_TRANSFER (some items failed) and succeeded
+            {list} contains the paths that were transferred.
+        """
+        if not paths:
+            return ALREADY_SYNCED, []
+
+        dirs, files, failed = [], [], []
+        # File_key and path of receiving files that can be updated block by block
+        delta_keys, delta_paths = [], set()
+        for rel_path in paths:
+            try:
+                src_st = os.lstat(os.path.join(sender, rel_path))
+            except OSError as error:
+                LOGGER.error(f"Couldn't transfer {rel_path}: {error}")
+                failed.append(rel_path)
+                continue
+            is_dir = stat.S_ISDIR(src_st.st_mode)
+            (dirs if is_dir else files).append(rel_path)
+            if not is_dir and self.signature_cache is not None and not self.dryrun:
+                try:
+                    dst_st = os.lstat(os.path.join(receiver, rel_path))
+                except OSError:
+                    continue
+                if self.__use_delta(src_st, dst_st):
+                    delta_keys.append(file_key(dst_st))
+                    delta_paths.add(rel_path)
+
+        # Database is only used from this thread
+        if delta_keys:
+            self.signature_cache.load(delta_keys)
+        # Journaled (and committed) before any of them is written
+        if delta_paths and self.journal:
+            for rel_path in delta_paths:
+                self.journal.start_update(os.path.join(receiver, rel_path))
+            self.journal.commit()
+
+        # Dirs are created top down (sequentially, cheap) before any files
+        created_dirs, succeeded = [], []
+        for rel_path in sorted(dirs):
+            try:
+                self.__ensure_parent(sender, receiver, rel_path, created_dirs)
+                self.__transfer_dir(sender, receiver, rel_path, created_dirs)
+                succeeded.append(rel_path)
+                if on_transferred:
+                    on_transferred(rel_path)
+            except OSError as error:
+                LOGGER.error(f"Couldn't create directory {rel_path}: {error}")
+                failed.append(rel_path)
+
+        def transfer_file(rel_path):
+            try:
+                self.__transfer_file(sender, receiver, rel_path, rel_path in delta_paths)
+                return True
+            except OSError as error:
+                LOGGER.error(f"Couldn't transfer {rel_path}: {error}")
+                return False
+
+        for rel_path in files:
+            if not self.dryrun:
+                try:
+                    self.__ensure_parent(sender, receiver, rel_path, created_dirs)
+                except OSError as error:
+                    LOGGER.error(f"Couldn't create parent directory of {rel_path}: {error}")
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for rel_path, ok in zip(files, executor.map(transfer_file, files)):
+                (succeeded if ok else failed).append(rel_path)
+                if ok and on_transferred:
+                    on_transferred(rel_path)
+                if ok and rel_path in delta_paths and self.journal:
+                    self.journal.finish_update(os.path.join(receiver, rel_path))
+        if delta_keys:
+            self.signature_cache.save()
+
+        # Deepest dirs first so that setting times of a dir isn't undone
+        for rel_path, mode, atime_ns, mtime_ns in sorted(created_dirs, reverse=True):
+            dst_path = os.path.join(receiver, rel_path)
+            try:
+                os.chmod(dst_path, mode)
+                os.utime(dst_path, ns=(atime_ns, mtime_ns))
+            except OSError as error:
+                LOGGER.error(f"Couldn't set attributes of directory {rel_path}: {error}")
+
+        returncode = PARTIAL_TRANSFER if failed else 0
+        return returncode, succeeded
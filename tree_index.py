@@ -0,0 +1,214 @@
+"""This module contains the compact representation of scanned trees that is
+shared by the scanner, Syncer and state saving.
+
+A scanned tree is kept in one Tree_index instead of dicts of sets of names
+plus dicts of stat tuples. Every dir gets an integer id (its relative path is
+stored once) and the files of a dir are stored next to each other, sorted by
+name, with their metadata in arrays (a machine word per field instead of an
+object per file). Entry_stat tuples and relative paths are only created for
+the files that are actually looked at, ie the ones differing between source
+and target.
+
+Pair_state is the new state of a folder pair built on top of the source
+index. Files existing on both sides are flags in a bytearray instead of a
+copy of all names.
+"""
+from array import array
+from bisect import bisect_left
+from collections import namedtuple
+from itertools import compress
+
+# Metadata (from lstat) of a file found by the scanner
+Entry_stat = namedtuple("Entry_stat", ["size", "mtime_ns", "mode", "ino", "dev"])
+
+
+class Tree_index:
+    """
+    Summary:
+        Files of all scanned dirs of one tree. Entries are addressed by index,
+        the entries of dir id d are first[d] to first[d] + count[d].
+
+    Properties:
+        self.dirs {list} = Relative dir per dir id
+        self.dir_ids {dictionary} = Relative dir as key and dir id as value
+        self.first {array} = Index of first entry per dir id
+        self.count {array} = Number of entries per dir id
+        self.names {list} = File name per entry (sorted within each dir)
+        self.size, self.mtime_ns, self.mode, self.ino, self.dev {array} =
+            Metadata per entry, see Entry_stat
+    """
+
+    def __init__(self):
+        self.dirs = []
+        self.dir_ids = {}
+        self.first = array("q")
+        self.count = array("q")
+        self.names = []
+        self.size = array("q")
+        self.mtime_ns = array("q")
+        self.mode = array("L")
+        self.ino = array("Q")
+        self.dev = array("Q")
+
+    def __repr__(self):
+        return f"Tree_index(dirs: {len(self.dirs)}, files: {len(self.names)})"
+
+    def __len__(self):
+        return len(self.dirs)
+
+    def __contains__(self, rel_dir):
+        return rel_dir in self.dir_ids
+
+    def __iter__(self):
+        return iter(self.dirs)
+
+    def file_count(self):
+        return len(self.names)
+
+    def add_dir(self, rel_dir, file_stats):
+        """Adds a listed dir. Each dir can only be added once.
+
+        Args:
+            rel_dir {string}: Dir relative to top dir ("." for top dir).
+            file_stats {dictionary}: File name as key and Entry_stat as value.
+
+        Returns:
+            {int}: Dir id.
+        """
+        if rel_dir in self.dir_ids:
+            raise ValueError(f"{rel_dir} is already in index")
+        dir_id = len(self.dirs)
+        self.dirs.append(rel_dir)
+        self.dir_ids[rel_dir] = dir_id
+        self.first.append(len(self.names))
+        self.count.append(len(file_stats))
+        for name in sorted(file_stats):
+            entry = file_stats[name]
+            self.names.append(name)
+            self.size.append(entry.size)
+            self.mtime_ns.append(entry.mtime_ns)
+            self.mode.append(entry.mode)
+            self.ino.append(entry.ino)
+            self.dev.append(entry.dev)
+        return dir_id
+
+    def dir_range(self, dir_id):
+        first = self.first[dir_id]
+        return first, first + self.count[dir_id]
+
+    def names_of(self, rel_dir):
+        """Returns list of file names in rel_dir (empty if not scanned)."""
+        dir_id = self.dir_ids.get(rel_dir)
+        if dir_id is None:
+            return []
+        first, end = self.dir_range(dir_id)
+        return self.names[first:end]
+
+    def find(self, rel_dir, name):
+        """Returns index of file name in rel_dir. -1 if not in index."""
+        dir_id = self.dir_ids.get(rel_dir)
+        if dir_id is None:
+            return -1
+        first, end = self.dir_range(dir_id)
+        index = bisect_left(self.names, name, first, end)
+        if index < end and self.names[index] == name:
+            return index
+        return -1
+
+    def entry_at(self, index):
+        return Entry_stat(self.size[index], self.mtime_ns[index], self.mode[index],
+                          self.ino[index], self.dev[index])
+
+    def entry(self, rel_dir, name):
+        """Returns Entry_stat of file name in rel_dir. None if not in index."""
+        index = self.find(rel_dir, name)
+        return self.entry_at(index) if index >= 0 else None
+
+    def as_file_dict(self):
+        """Returns the tree as file_dict (dirs as keys and sets of file names
+        as values), see create_file_dict in sync_functions."""
+        return {rel_dir: set(self.names_of(rel_dir)) for rel_dir in self.dirs}
+
+
+class Pair_state:
+    """
+    Summary:
+        New state of a folder pair, used as item_dict of save_folder_state
+        (dirs as keys and lists of files existing on both sides as values).
+        Dirs and files existing on both sides when the plan was made are
+        flags over the source index. Items added while syncing (and items
+        planned for deletion) are kept in self.extra.
+
+    Properties:
+        self.index {Tree_index} = Index of source
+        self.mutual_dirs {bytearray} = 1 per source dir id existing on both sides
+        self.mutual {bytearray} = 1 per source entry existing on both sides
+        self.extra {dictionary} = Dirs as keys and sets of files not flagged as values
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.mutual_dirs = bytearray(len(index.dirs))
+        self.mutual = bytearray(len(index.names))
+        self.extra = {}
+
+    def __repr__(self):
+        return f"Pair_state(mutual dirs: {self.mutual_dirs.count(1)}, extra dirs: {len(self.extra)})"
+
+    def __mutual_dir_id(self, rel_dir):
+        dir_id = self.index.dir_ids.get(rel_dir)
+        if dir_id is not None and self.mutual_dirs[dir_id]:
+            return dir_id
+        return None
+
+    def __contains__(self, rel_dir):
+        return rel_dir in self.extra or self.__mutual_dir_id(rel_dir) is not None
+
+    def __iter__(self):
+        for dir_id in compress(range(len(self.mutual_dirs)), self.mutual_dirs):
+            yield self.index.dirs[dir_id]
+        for rel_dir in self.extra:
+            if self.__mutual_dir_id(rel_dir) is None:
+                yield rel_dir
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __getitem__(self, rel_dir):
+        dir_id = self.__mutual_dir_id(rel_dir)
+        extra = self.extra.get(rel_dir)
+        if dir_id is None:
+            if extra is None:
+                raise KeyError(rel_dir)
+            return list(extra)
+
+        first, end = self.index.dir_range(dir_id)
+        names = list(compress(self.index.names[first:end], self.mutual[first:end]))
+        if extra:
+            names.extend(extra)
+        return names
+
+    def get(self, rel_dir, default=None):
+        return self[rel_dir] if rel_dir in self else default
+
+    def add_dir(self, rel_dir):
+        self.extra.setdefault(rel_dir, set())
+
+    def add_file(self, rel_dir, name):
+        self.extra.setdefault(rel_dir, set()).add(name)
+
+    def remove_file(self, rel_dir, name):
+        extra = self.extra.get(rel_dir)
+        if extra and name in extra:
+            extra.discard(name)
+            return
+        if self.__mutual_dir_id(rel_dir) is not None:
+            index = self.index.find(rel_dir, name)
+            if index >= 0:
+                self.mutual[index] = 0
+
+    def remove_dir(self, rel_dir):
+        self.extra.pop(rel_dir, None)
+        dir_id = self.__mutual_dir_id(rel_dir)
+        if dir_id is not None:
+            self.mutual_dirs[dir_id] = 0
@@ -0,0 +1,192 @@
+"""This module contains the vectorised diff engine of Syncer (diff_engine
+"numpy", see decide_sync_actions in helpers). It is only selectable in
+benchmark.py (--diff-engine), syncs always use the default engine
+("python"). numpy is optional, the python engine doesn't need it.
+
+Both engines make the same decisions. The python engine walks the dirs of
+the source index and compares the name ranges of each dir (one list compare
+when they are equal, otherwise a merge). This engine encodes every entry of
+both indexes as an integer key and finds the differences with whole-array
+operations instead:
+
+- Dirs get a global id (source dir ids, then dirs only on target) and names
+  an id from one dict over the names of both sides. Building the dict and
+  mapping names to ids run in C (dict.fromkeys, map), not in a Python loop.
+- The key of an entry is dir id * number of names + name id. Mutual files
+  are the intersection of the sorted keys of both sides, their mtimes (and
+  sizes) are compared as arrays on top of the Tree_index arrays (no copy).
+- Exclusive files in mutual dirs are the entries not in the intersection.
+  Whether they were synced before is one isin of their keys against the
+  keys of the saved files of those dirs.
+
+Only the differences found (changed, exclusive and saved items) are turned
+into Python objects again. Sorting the keys is O(n log n) while the python
+engine is O(n) per dir, and both spend most of their time turning the
+differences into sync items. Measured on synthetic trees this engine is
+slower (1.3x to 6x), it is kept to compare against. Both engines must make
+the same decisions (see test_diff_engines in tests.py).
+"""
+import logging
+from collections import namedtuple
+from itertools import repeat
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+LOGGER = logging.getLogger(__name__)
+
+DIFF_ENGINES = ("python", "numpy")
+DEFAULT_DIFF_ENGINE = "python"
+
+# Result of diff_indexes. Positions are entries of the source/target index.
+Index_diff = namedtuple("Index_diff", [
+    "mutual_dirs",      # Source dir ids of dirs on both sides
+    "src_only_dirs",    # Source dir ids of dirs only on source
+    "tar_only_dirs",    # Target dir ids of dirs only on target
+    "src_mutual",       # Positions of mutual files in source (ascending)
+    "changed",          # Tuples (dir, src pos, tar pos) of mutual files differing
+    "exclusive_files",  # Tuples (dir, names, side) of files only on one side of a mutual dir
+    "encoder",          # Key_encoder used, see saved_flags
+])
+
+
+def numpy_available():
+    return np is not None
+
+
+class Key_encoder:
+    """
+    Summary:
+        Maps (dir, name) of both indexes to integer keys (see module docstring).
+
+    Properties:
+        self.dir_ids {dictionary} = Relative dir as key and global dir id as value
+        self.name_ids {dictionary} = File name as key and name id as value
+    """
+
+    def __init__(self, src, tar):
+        self.dir_ids = dict(zip(src.dirs, range(len(src.dirs))))
+        for rel_dir in tar.dirs:
+            self.dir_ids.setdefault(rel_dir, len(self.dir_ids))
+        names = dict.fromkeys(src.names)
+        names.update(dict.fromkeys(tar.names))
+        self.name_ids = dict(zip(names, range(len(names))))
+
+    def __repr__(self):
+        return f"Key_encoder(dirs: {len(self.dir_ids)}, names: {len(self.name_ids)})"
+
+    def index_keys(self, index, entry_dirs):
+        # Key of every entry of a Tree_index (entry_dirs see entry_dir_ids)
+        dir_ids = np.fromiter(map(self.dir_ids.__getitem__, index.dirs), np.int64, len(index.dirs))
+        name_ids = np.fromiter(map(self.name_ids.__getitem__, index.names), np.int64, len(index.names))
+        return dir_ids[entry_dirs] * len(self.name_ids) + name_ids
+
+    def keys(self, rel_dir, names):
+        # Keys of names in rel_dir. Names unknown to both indexes are left out.
+        name_ids = np.fromiter(map(self.name_ids.get, names, repeat(-1)), np.int64)
+        name_ids = name_ids[name_ids >= 0]
+        return self.dir_ids[rel_dir] * len(self.name_ids) + name_ids
+
+
+def entry_dir_ids(index):
+    # Dir id of every entry of a Tree_index
+    return np.repeat(np.arange(len(index.dirs), dtype=np.int64), np.frombuffer(index.count, np.int64))
+
+
+def exclusive_by_dir(index, positions, entry_dirs):
+    # Groups positions (ascending) of index by dir: yields (dir id, names)
+    if not len(positions):
+        return
+    dirs = entry_dirs[positions]
+    starts = np.flatnonzero(np.diff(dirs, prepend=-1))
+    ends = np.append(starts[1:], len(positions))
+    names = index.names
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        yield int(dirs[start]), [names[pos] for pos in positions[start:end].tolist()]
+
+
+def diff_indexes(src, tar, compare_size=False):
+    """Finds mutual, changed and exclusive items of two Tree_index.
+
+    Args:
+        src, tar {Tree_index}: Scans of source and target.
+        compare_size {bool}: Mutual files also differ if their sizes differ (mirror).
+
+    Returns:
+        {Index_diff}: See Index_diff. exclusive_files is in the order the python
+        engine finds them (source dir order, source side first).
+    """
+    encoder = Key_encoder(src, tar)
+    src_dirs, tar_dirs = entry_dir_ids(src), entry_dir_ids(tar)
+    src_keys, tar_keys = encoder.index_keys(src, src_dirs), encoder.index_keys(tar, tar_dirs)
+    _, src_mutual, tar_mutual = np.intersect1d(src_keys, tar_keys, assume_unique=True,
+                                               return_indices=True)
+    order = np.argsort(src_mutual, kind="stable")
+    src_mutual, tar_mutual = src_mutual[order], tar_mutual[order]
+
+    differs = (np.frombuffer(src.mtime_ns, np.int64)[src_mutual] !=
+               np.frombuffer(tar.mtime_ns, np.int64)[tar_mutual])
+    if compare_size:
+        differs |= (np.frombuffer(src.size, np.int64)[src_mutual] !=
+                    np.frombuffer(tar.size, np.int64)[tar_mutual])
+    src_changed = src_mutual[differs]
+    changed = list(zip(map(src.dirs.__getitem__, src_dirs[src_changed].tolist()),
+                       src_changed.tolist(), tar_mutual[differs].tolist()))
+
+    tar_dir_ids = [src.dir_ids.get(rel_dir, -1) for rel_dir in tar.dirs]
+    mutual_dirs = [src_id for src_id in tar_dir_ids if src_id >= 0]
+    mutual_dirs.sort()
+    src_only_dirs = [dir_id for dir_id, rel_dir in enumerate(src.dirs) if not rel_dir in tar.dir_ids]
+    tar_only_dirs = [dir_id for dir_id, src_id in enumerate(tar_dir_ids) if src_id < 0]
+
+    # Entries of mutual dirs that aren't mutual files
+    exclusive = []
+    for index, positions, entry_dirs, side, dir_of in ((src, src_mutual, src_dirs, 0, None),
+                                                       (tar, tar_mutual, tar_dirs, 1, tar_dir_ids)):
+        if dir_of is None:
+            in_mutual_dir = np.zeros(len(index.dirs), dtype=bool)
+            in_mutual_dir[mutual_dirs] = True
+        else:
+            in_mutual_dir = np.array(dir_of, dtype=np.int64) >= 0
+        candidates = in_mutual_dir[entry_dirs]
+        candidates[positions] = False
+        for dir_id, names in exclusive_by_dir(index, np.flatnonzero(candidates), entry_dirs):
+            src_id = dir_id if dir_of is None else dir_of[dir_id]
+            exclusive.append((src_id, side, index.dirs[dir_id], names))
+    exclusive.sort(key=lambda item: item[:2])
+    exclusive_files = [(rel_dir, names, side) for _, side, rel_dir, names in exclusive]
+
+    return Index_diff(mutual_dirs, src_only_dirs, tar_only_dirs, src_mutual, changed,
+                      exclusive_files, encoder)
+
+
+def saved_flags(encoder, exclusive_files, saved_files):
+    """Finds the exclusive files that are in the saved state.
+
+    Args:
+        encoder {Key_encoder}: encoder of diff_indexes.
+        exclusive_files {list}: Tuples (dir, names) of files in mutual dirs.
+        saved_files {function}: Returns the saved file names of a dir.
+
+    Returns:
+        {list}: One list of bools per item of exclusive_files, True for
+        names that are in the saved state.
+    """
+    if not exclusive_files:
+        return []
+    saved_keys = [encoder.keys(rel_dir, saved_files(rel_dir))
+                  for rel_dir in dict.fromkeys(rel_dir for rel_dir, _ in exclusive_files)]
+    keys = [encoder.keys(rel_dir, names) for rel_dir, names in exclusive_files]
+    flags = np.isin(np.concatenate(keys), np.concatenate(saved_keys)).tolist()
+    flags_by_item, start = [], 0
+    for _, names in exclusive_files:
+        flags_by_item.append(flags[start:start + len(names)])
+        start += len(names)
+    return flags_by_item
+
+
+def set_flags(flags, positions):
+    # Sets positions (array) of a bytearray to 1
+    np.frombuffer(flags, np.uint8)[positions] = 1
@@ -0,0 +1,478 @@
+"""This module contains watch mode (folder_sync.py -W True), a long running
+alternative to running folder_sync from cron.
+
+Both roots of a folder pair get inotify watches (excluded dirs are left out).
+Events only mark the directory they happened in as dirty. When no new events
+have arrived for DEBOUNCE_SECONDS (or MAX_BATCH_DELAY after the first event)
+the dirty dirs are listed on both sides and the usual Syncer decisions are
+made for those dirs only. Dirs existing on one side only are listed with
+everything below them, since Syncer adds or deletes them as a whole.
+
+The saved state of the pair is kept in memory between batches and only the
+rows of the dirs in a batch are written to the database. If the inotify queue
+overflows events are lost, so a full scan and sync (two_way_sync) is done
+instead.
+
+Copies and deletions made by a batch raise events themselves. Every item a
+sync wrote or deleted is remembered with what it should look like afterwards
+(type and mtime of the sending side, or gone). Events for such an item, or
+for a temporary file written for it, are ignored as long as the item still
+looks like that, so a batch isn't followed by a rescan of what it just
+synced. Attribute changes of dirs are always ignored, Syncer doesn't sync
+them.
+
+A file on one side with the name of a dir on the other (doubles, see
+delete_and_sync in sync_functions) aborts a sync from the command line. Here
+the doubles are logged and left out of the batch instead, the rest is synced
+and their dirs are listed again by the next batch.
+
+Linux only (inotify is called through ctypes).
+"""
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import stat
+import struct
+import sys
+from time import monotonic
+
+import sync_functions
+from helpers import Excluder, Syncer, join_rel_path, split_rel_path
+from db_helpers import Saved_state, update_folder_state, save_sync_run
+from metrics import Metrics_registry, write_prometheus_textfile
+from scanner import Tree_scanner, scan_dir, DEFAULT_SCAN_WORKERS
+from rsync_runner import DEFAULT_RSYNC_WORKERS
+import rsync_runner
+import transfer
+from transfer import DEFAULT_BACKEND
+
+LOGGER = logging.getLogger(__name__)
+
+# Batches start when no events have arrived for this long (seconds)...
+DEBOUNCE_SECONDS = 2
+# ...but never later than this after the first event of the batch
+MAX_BATCH_DELAY = 30
+
+# From <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF |
+              IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK)
+
+# struct inotify_event without the name
+EVENT_HEADER = struct.Struct("iIII")
+READ_SIZE = 64 * 1024
+
+
+class Inotify:
+    """
+    Summary:
+        Minimal wrapper around the inotify system calls.
+
+    Properties:
+        self.fd {int} = inotify file descriptor (non blocking)
+    """
+
+    def __init__(self):
+        self.__libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.__libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, f"inotify_init1: {os.strerror(error)}")
+
+    def __repr__(self):
+        return f"Inotify(fd: {self.fd})"
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self.__libc.inotify_add_watch(self.fd, os.fsencode(path), ctypes.c_uint32(mask))
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+        return wd
+
+    def rm_watch(self, wd):
+        # Fails if watch is already gone (dir deleted), which is fine
+        self.__libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self):
+        """Returns:
+            {list}: Tuples (wd, mask, cookie, name) of all queued events.
+        """
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except BlockingIOError:
+            return []
+
+        events, offset = [], 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            events.append((wd, mask, cookie, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Pair_watcher:
+    """
+    Summary:
+        Watches both sides of a folder pair and syncs dirty dirs in batches.
+        Start with run().
+
+    Properties:
+        self.roots {dictionary} = "source" and "target" as keys, paths as values
+        self.excluders {dictionary} = Same keys, Excluder (or None) as values
+        self.watches {dictionary} = Watch descriptor as key, (side, rel_dir) as value
+        self.watched_dirs {dictionary} = Side as key, {rel_dir: watch descriptor} as value
+        self.dirty {set} = Relative dirs with events since last batch
+        self.overflow {bool} = Events were lost, next batch is a full sync
+        self.state {dictionary} = Saved state of pair (dirs as keys, sets of files
+            as values) kept in sync with the database
+        self.own_changes {dictionary} = Side as key, {rel_path: expected} as value
+            for the items the last sync wrote or deleted (see expect_own_changes).
+            expected is None for a deleted item, otherwise (file type, mtime_ns)
+            with mtime_ns None for dirs
+    """
+
+    def __init__(self, cur, pair_id, source, target, delete, verbose,
+                 scan_workers=DEFAULT_SCAN_WORKERS, rsync_workers=DEFAULT_RSYNC_WORKERS,
+                 transfer_backend=DEFAULT_BACKEND, metrics_dir=None, delta_min_size=0):
+        self.cur = cur
+        self.id = pair_id
+        self.roots = {"source": source, "target": target}
+        self.excluders = {"source": Excluder.create_excluder(source, pair_id),
+                          "target": Excluder.create_excluder(target, pair_id)}
+        self.delete = delete
+        self.verbose = verbose
+        self.scan_workers = scan_workers
+        self.rsync_workers = rsync_workers
+        self.transfer_backend = transfer_backend
+        self.metrics_dir = metrics_dir
+        self.delta_min_size = delta_min_size
+        self.inotify = Inotify()
+        self.watches = {}
+        self.watched_dirs = {"source": {}, "target": {}}
+        self.dirty = set()
+        self.overflow = False
+        self.state = {}
+        self.own_changes = {"source": {}, "target": {}}
+        self.__watch_limit_reached = False
+
+    def __repr__(self):
+        return f"Pair_watcher({self.id}, watches: {len(self.watches)}, dirty: {len(self.dirty)})"
+
+    def add_watches(self, side, rel_dir, mark_dirty=False):
+        """Watches rel_dir and all non excluded dirs below it. If mark_dirty
+        (new dir) every watched dir is also marked dirty, since files may have
+        been created in it before the watch existed."""
+        root, excl_obj = self.roots[side], self.excluders[side]
+        stack = [rel_dir]
+        while stack:
+            current = stack.pop()
+            abs_dir = root if current == "." else os.path.join(root, current)
+            try:
+                wd = self.inotify.add_watch(abs_dir)
+            except OSError as error:
+                if error.errno == errno.ENOSPC and not self.__watch_limit_reached:
+                    self.__watch_limit_reached = True
+                    LOGGER.error("inotify watch limit reached, changes in some dirs will be missed. "
+                                 "Raise fs.inotify.max_user_watches.")
+                elif error.errno != errno.ENOSPC:
+                    LOGGER.debug(f"Couldn't watch {abs_dir}: {error}")
+                continue
+
+            self.watches[wd] = (side, current)
+            self.watched_dirs[side][current] = wd
+            if mark_dirty and not self.is_own_change(side, current):
+                self.dirty.add(current)
+
+            listing = scan_dir(abs_dir)
+            if listing is None:
+                continue
+            for name in listing[1]:
+                sub_dir = join_rel_path(current, name)
+                if excl_obj and excl_obj.excludes(sub_dir):
+                    continue
+                stack.append(sub_dir)
+
+    def remove_watches(self, side, rel_dir):
+        """Removes watches of rel_dir and everything below it (dir moved away)."""
+        prefix = rel_dir + os.path.sep
+        watched = self.watched_dirs[side]
+        for a_dir in [a_dir for a_dir in watched if a_dir == rel_dir or a_dir.startswith(prefix)]:
+            wd = watched.pop(a_dir)
+            self.watches.pop(wd, None)
+            self.inotify.rm_watch(wd)
+
+    def handle_events(self, events):
+        """Marks dirs of events dirty.
+
+        Returns:
+            {bool}: True if anything became dirty (or the queue overflowed).
+        """
+        changed = False
+        for wd, mask, _, name in events:
+            if mask & IN_Q_OVERFLOW:
+                LOGGER.warning("inotify queue overflowed, events were lost. Doing a full rescan.")
+                self.overflow = True
+                changed = True
+                continue
+
+            watch = self.watches.get(wd)
+            if watch is None:
+                continue
+            side, rel_dir = watch
+
+            if mask & IN_IGNORED:
+                # Watch removed by kernel (dir deleted)
+                del self.watches[wd]
+                if self.watched_dirs[side].get(rel_dir) == wd:
+                    del self.watched_dirs[side][rel_dir]
+                continue
+
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                if rel_dir == ".":
+                    LOGGER.critical(f"{self.roots[side]} was moved or deleted. Stopped watching.")
+                    sys.exit(1)
+                # The event in the parent dir makes it dirty
+                continue
+            if not name or mask & IN_ISDIR and mask & IN_ATTRIB:
+                # Attributes of a dir (the watched one if no name), not synced
+                continue
+
+            rel_path = join_rel_path(rel_dir, name)
+            excl_obj = self.excluders[side]
+            if excl_obj and excl_obj.excludes(rel_path):
+                continue
+
+            if not self.is_own_change(side, rel_path):
+                self.dirty.add(rel_dir)
+                changed = True
+            if mask & IN_ISDIR:
+                if mask & IN_MOVED_FROM:
+                    self.remove_watches(side, rel_path)
+                elif mask & (IN_CREATE | IN_MOVED_TO):
+                    self.add_watches(side, rel_path, mark_dirty=True)
+
+        return changed
+
+    def expect_own_changes(self, sync_obj):
+        """Remembers what sync_obj wrote and deleted (replacing what the
+        previous sync did), see module docstring."""
+        own_changes = {"source": {}, "target": {}}
+        sync_dict = sync_obj.sync_dict
+        for sender_index, receiver, updates in ((sync_obj.src_index, "target", ("upd_lr", "touch_lr")),
+                                                (sync_obj.tar_index, "source", ("upd_rl", "touch_rl"))):
+            items_obj = sync_dict["add_to_tar" if receiver == "target" else "add_to_src"]
+            expected = own_changes[receiver]
+            for dir, name in items_obj.iter_files():
+                entry = sender_index.entry(dir, name)
+                expected[join_rel_path(dir, name)] = (stat.S_IFMT(entry.mode), entry.mtime_ns)
+            for rel_dir in items_obj.dirs:
+                expected[rel_dir] = (stat.S_IFDIR, None)
+            for key in updates:
+                for rel_path in sync_dict[key]:
+                    entry = sender_index.entry(*split_rel_path(rel_path))
+                    expected[rel_path] = (stat.S_IFMT(entry.mode), entry.mtime_ns)
+        if sync_obj.deletions:
+            for side, key in (("source", "src_deletes"), ("target", "tar_deletes")):
+                items_obj = sync_dict[key]
+                own_changes[side].update(dict.fromkeys(items_obj.get_item_set()))
+        self.own_changes = own_changes
+
+    def is_own_change(self, side, rel_path):
+        """Returns True if the event for rel_path (or the temporary file it
+        names) comes from the last sync: rel_path was written or deleted by it
+        and still looks the way the sync left it."""
+        expected_items = self.own_changes[side]
+        if not expected_items:
+            return False
+        root = self.roots[side]
+        if not rel_path in expected_items:
+            # Temporary file of rsync or native transfer, renamed into place since
+            dir, name = split_rel_path(rel_path)
+            match = rsync_runner.TEMP_NAME.match(name) or transfer.TEMP_NAME.match(name)
+            if not match or os.path.lexists(os.path.join(root, rel_path)):
+                return False
+            rel_path = join_rel_path(dir, match.group(1))
+            if not rel_path in expected_items:
+                return False
+
+        expected = expected_items[rel_path]
+        try:
+            st = os.lstat(os.path.join(root, rel_path))
+        except OSError:
+            return expected is None
+        if expected is None:
+            return False
+        file_type, mtime_ns = expected
+        return stat.S_IFMT(st.st_mode) == file_type and mtime_ns in (None, st.st_mtime_ns)
+
+    def load_state(self):
+        saved_state = Saved_state(self.cur, self.id)
+        saved_state.prefetch(saved_state.keys())
+        self.state = {dir: set(saved_state.files.get(dir, ())) for dir in saved_state.keys()}
+
+    def full_sync(self, interactive=False):
+        source, target = self.roots["source"], self.roots["target"]
+        self.dirty.clear()
+        self.overflow = False
+        self.own_changes = {"source": {}, "target": {}}
+        sync_functions.two_way_sync(self.cur, self.id, source, target, self.delete, False,
+                                    self.verbose, interactive, self.scan_workers,
+                                    self.rsync_workers, False, self.transfer_backend,
+                                    metrics_dir=self.metrics_dir, delta_min_size=self.delta_min_size,
+                                    on_synced=self.expect_own_changes, on_doubles=self.skip_doubles)
+        self.load_state()
+
+    def skip_doubles(self, sync_obj, doubles):
+        # Called by delete_and_sync instead of aborting the sync
+        rel_paths = doubles[0].get_item_set() | doubles[1].get_item_set()
+        for rel_path in sorted(rel_paths):
+            LOGGER.error(f"{rel_path} is a file on one side and a dir on the other, it isn't "
+                         "synced until one of them is renamed or removed")
+            self.dirty.add(split_rel_path(rel_path)[0])
+        sync_obj.skip_items(rel_paths)
+
+    def scan_dirty(self):
+        """Lists the dirty dirs on both sides (see module docstring).
+
+        Returns:
+            {tuple}: (src_scanner, tar_scanner, gone) where the scanners hold
+            the Tree_index of the listed dirs and gone {list} has
+            dirty dirs that exist on neither side.
+        """
+        scanners = {side: Tree_scanner(root, self.excluders[side]) for side, root in self.roots.items()}
+        gone = []
+
+        def list_tree(scanner, rel_dir):
+            # Everything below a dir existing on one side only
+            stack = [rel_dir]
+            while stack:
+                current = stack.pop()
+                if current in scanner.index:
+                    continue
+                listing = scanner.list_dir(current)
+                if listing:
+                    stack.extend(scanner.add_listing(current, listing))
+
+        for rel_dir in sorted(self.dirty):
+            if any(rel_dir in scanner.index for scanner in scanners.values()):
+                continue
+            sub_dirs = {}
+            for side, scanner in scanners.items():
+                listing = scanner.list_dir(rel_dir)
+                sub_dirs[side] = set(scanner.add_listing(rel_dir, listing)) if listing else None
+
+            if sub_dirs["source"] is None and sub_dirs["target"] is None:
+                gone.append(rel_dir)
+                continue
+            for side, other_side in (("source", "target"), ("target", "source")):
+                for sub_dir in (sub_dirs[side] or set()) - (sub_dirs[other_side] or set()):
+                    list_tree(scanners[side], sub_dir)
+
+        return scanners["source"], scanners["target"], gone
+
+    def sync_dirty(self):
+        # Each batch is saved as a sync run of its own
+        metrics = Metrics_registry()
+        with metrics.timer("scan"):
+            src_scanner, tar_scanner, gone = self.scan_dirty()
+        self.dirty.clear()
+        for scanner in (src_scanner, tar_scanner):
+            metrics.add("dirs_scanned", len(scanner.index))
+            metrics.add("files_scanned", scanner.index.file_count())
+
+        # State of all dirs listed in this batch is replaced
+        scope = set(src_scanner.index) | set(tar_scanner.index)
+        for rel_dir in gone:
+            prefix = rel_dir + os.path.sep
+            scope |= {dir for dir in self.state if dir == rel_dir or dir.startswith(prefix)}
+
+        with metrics.timer("syncer"):
+            sync_obj = Syncer(self.id, self.roots["source"], self.roots["target"],
+                              src_scanner.index, tar_scanner.index, self.delete, False,
+                              self.verbose, self.state, self.rsync_workers, False,
+                              self.transfer_backend, metrics=metrics,
+                              signature_cache=sync_functions.create_signature_cache(
+                                  self.cur, self.transfer_backend, self.delta_min_size))
+        sync_functions.delete_and_sync(sync_obj, self.skip_doubles)
+        self.expect_own_changes(sync_obj)
+
+        with metrics.timer("state_save"):
+            new_state = sync_obj.get_new_state_dict()
+            for dir in scope:
+                if dir in new_state:
+                    self.state[dir] = set(new_state[dir])
+                else:
+                    self.state.pop(dir, None)
+            if update_folder_state(self.cur, self.id, scope, new_state):
+                metrics.error("state_save")
+
+        metrics_dict = metrics.as_dict()
+        save_sync_run(self.cur, self.id, metrics_dict)
+        if self.metrics_dir:
+            write_prometheus_textfile(self.metrics_dir, self.id, metrics_dict)
+        LOGGER.debug(f"Synced batch of {len(scope)} dirs")
+
+    def run(self, interactive=True):
+        """Syncs once (full scan, interactive if asked for) and then watches
+        for changes until interrupted."""
+        for side in self.roots:
+            self.add_watches(side, ".")
+        LOGGER.debug(f"Watching {len(self.watches)} dirs")
+        # Watches are added first so that no change during the sync is missed
+        self.full_sync(interactive)
+
+        if self.verbose:
+            print("\nWatching for changes (stop with ctrl-c)...")
+
+        first_event, deadline = None, None
+        try:
+            while True:
+                timeout = None if deadline is None else max(0, deadline - monotonic())
+                readable, _, _ = select.select([self.inotify.fd], [], [], timeout)
+                if readable and self.handle_events(self.inotify.read_events()):
+                    now = monotonic()
+                    first_event = first_event or now
+                    deadline = min(now + DEBOUNCE_SECONDS, first_event + MAX_BATCH_DELAY)
+                if deadline is None or monotonic() < deadline:
+                    continue
+
+                first_event, deadline = None, None
+                if self.overflow:
+                    self.full_sync()
+                else:
+                    self.sync_dirty()
+        except KeyboardInterrupt:
+            print("\nStopped watching.")
+        finally:
+            self.inotify.close()
+
+
+def watch_pair(cur, pair_id, source, target, delete, verbose, interactive=True,
+               scan_workers=DEFAULT_SCAN_WORKERS, rsync_workers=DEFAULT_RSYNC_WORKERS,
+               transfer_backend=DEFAULT_BACKEND, metrics_dir=None, delta_min_size=0):
+    Pair_watcher(cur, pair_id, source, target, delete, verbose, scan_workers,
+                 rsync_workers, transfer_backend, metrics_dir, delta_min_size).run(interactive)